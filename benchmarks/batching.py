@@ -0,0 +1,79 @@
+#
+# outbound micro-batching: packets sent and per-frame latency when one
+# publish hits 20 subscriptions on the same connection
+#
+# run from the repository root:
+#   python -m benchmarks.batching [rounds]
+#
+import sys
+import time
+
+from python_graphql_subscriptions import SubscriptionManager, PubSub
+
+from tests.app import create_app
+from tests.schema import Schema
+from flask_graphql_subscriptions_transport import SubscriptionServer
+from flask_graphql_subscriptions_transport.message_types import SUBSCRIPTION_DATA, BATCH
+
+WINDOWS = [None, 0, 0.001, 0.005]
+SUBSCRIPTIONS = 20
+DEFAULT_ROUNDS = 500
+PUBLISH_INTERVAL = 0.001
+REQUEST_ID = 'benchmark'
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(batch_window, rounds):
+    app = create_app()
+    ss = SubscriptionServer(app,
+                            SubscriptionManager(Schema, PubSub(), {}),
+                            batch_window=batch_window,
+                            batch_size=1000)
+    connection = ss.get_connection(REQUEST_ID)
+    if batch_window is not None:
+        connection.batch = []
+
+    packets = []
+    latencies = []
+
+    def emit_frame(frame, request_id):
+        now = time.perf_counter()
+        packets.append(frame)
+        message = ss.codec.loads(frame['data'])
+        messages = message['payload'] if message['type'] == BATCH else [message]
+        latencies.extend(now - message['payload']['sent'] for message in messages)
+
+    ss.emit_frame = emit_frame
+    start = time.perf_counter()
+    for i in range(rounds):
+        sent = time.perf_counter()
+        for sub_id in range(SUBSCRIPTIONS):
+            ss.send_message({'type': SUBSCRIPTION_DATA, 'id': sub_id, 'payload': {'sent': sent}},
+                            REQUEST_ID)
+        time.sleep(PUBLISH_INTERVAL)
+    while len(latencies) < rounds * SUBSCRIPTIONS:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    return len(packets), elapsed, latencies
+
+
+def main(rounds):
+    print('%d publishes x %d subscriptions on one connection' % (rounds, SUBSCRIPTIONS))
+    print('%-10s %10s %12s %14s %12s %12s' % ('window', 'packets', 'packets/s', 'frames/packet',
+                                              'p50 ms', 'p99 ms'))
+    for window in WINDOWS:
+        packet_count, elapsed, latencies = run(window, rounds)
+        print('%-10s %10d %12.0f %14.1f %12.3f %12.3f' % ('off' if window is None else '%gms' % (window * 1000),
+                                                          packet_count,
+                                                          packet_count / elapsed,
+                                                          len(latencies) / float(packet_count),
+                                                          percentile(latencies, 0.5) * 1000,
+                                                          percentile(latencies, 0.99) * 1000))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ROUNDS)
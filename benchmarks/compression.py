@@ -0,0 +1,67 @@
+#
+# compression of SUBSCRIPTION_DATA payloads: bytes saved against CPU spent,
+# per scheme and level, and the cost of compressing once per publish vs
+# once per recipient
+#
+# run from the repository root:
+#   python -m benchmarks.compression [subscribers]
+#
+import json
+import sys
+import timeit
+
+from flask_graphql_subscriptions_transport.compression import ZlibCompressor, ZstdCompressor
+
+from benchmarks.delta import make_result
+
+ORDER_COUNTS = [5, 50, 500]
+DEFAULT_SUBSCRIBERS = 100
+
+
+def compressors():
+    yield ZlibCompressor(1)
+    yield ZlibCompressor(6)
+    yield ZlibCompressor(9)
+    for level in [1, 3, 9]:
+        try:
+            yield ZstdCompressor(level)
+        except ImportError:
+            return
+
+
+def seconds(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+
+def main(subscribers):
+    print('%-8s %-8s %10s %10s %7s %12s %12s %12s' % ('orders', 'scheme', 'bytes', 'packed', 'ratio',
+                                                      'compress us', 'MB/s', 'decompress us'))
+    for orders in ORDER_COUNTS:
+        data = json.dumps(make_result(orders)).encode('utf-8')
+        number = max(1, 2000000 // len(data))
+        for compressor in compressors():
+            packed = compressor.compress(data)
+            took = seconds(lambda: compressor.compress(data), number)
+            print('%-8d %-8s %10d %10d %6.1fx %12.0f %12.1f %12.0f' % (
+                orders,
+                '%s-%d' % (compressor.name, compressor.level),
+                len(data),
+                len(packed),
+                len(data) / float(len(packed)),
+                took * 1e6,
+                len(data) / took / 1e6,
+                seconds(lambda: compressor.decompress(packed), number) * 1e6))
+
+    # what sharing the compressed bytes across a fan-out saves
+    compressor = ZlibCompressor(6)
+    data = json.dumps(make_result(50)).encode('utf-8')
+    per_recipient = seconds(lambda: [compressor.compress(data) for i in range(subscribers)], 1)
+    once = seconds(lambda: compressor.compress(data), 10)
+    print('')
+    print('fan-out to %d subscribers, %d bytes, zlib-6:' % (subscribers, len(data)))
+    print('  per recipient %10.0fus' % (per_recipient * 1e6))
+    print('  once          %10.0fus' % (once * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SUBSCRIBERS)
@@ -0,0 +1,94 @@
+#
+# delta delivery on realistic nested results: characters on the wire for
+# a full payload vs a patch against the previous push, and what the diff
+# costs next to encoding the full payload
+#
+# run from the repository root:
+#   python -m benchmarks.delta [orders]
+#
+import copy
+import json
+import sys
+import timeit
+
+from flask_graphql_subscriptions_transport.delta import diff
+
+DEFAULT_ORDERS = 200
+
+
+def make_result(orders):
+    """
+    an order dashboard, the kind of result a live view subscribes to
+    """
+    return {'data': {'dashboard': {
+        'updatedAt': '2024-01-01T00:00:00Z',
+        'totals': {'open': orders, 'shipped': 0, 'revenue': 0.0},
+        'orders': [{
+            'id': 'order-%d' % i,
+            'status': 'OPEN',
+            'customer': {'id': 'customer-%d' % (i % 50), 'name': 'Customer %d' % (i % 50), 'tier': 'GOLD'},
+            'shipping': {'city': 'Springfield', 'country': 'US', 'eta': None},
+            'lines': [{'sku': 'SKU-%d' % j, 'quantity': 1 + j, 'price': 9.99 * (j + 1)} for j in range(4)],
+        } for i in range(orders)],
+    }}}
+
+
+def one_status(result):
+    result = copy.deepcopy(result)
+    dashboard = result['data']['dashboard']
+    dashboard['updatedAt'] = '2024-01-01T00:00:01Z'
+    dashboard['orders'][7]['status'] = 'SHIPPED'
+    dashboard['totals']['shipped'] += 1
+    return result
+
+
+def tenth_of_prices(result):
+    result = copy.deepcopy(result)
+    for order in result['data']['dashboard']['orders'][::10]:
+        for line in order['lines']:
+            line['price'] = round(line['price'] * 1.1, 2)
+    return result
+
+
+def new_order_appended(result):
+    result = copy.deepcopy(result)
+    orders = result['data']['dashboard']['orders']
+    orders.append(dict(copy.deepcopy(orders[0]), id='order-new'))
+    return result
+
+
+def new_order_first(result):
+    """
+    the worst case: every index shifts, so the server sends in full
+    """
+    result = copy.deepcopy(result)
+    orders = result['data']['dashboard']['orders']
+    orders.insert(0, dict(copy.deepcopy(orders[0]), id='order-new'))
+    return result
+
+
+CHANGES = [one_status, tenth_of_prices, new_order_appended, new_order_first]
+
+
+def main(orders):
+    before = make_result(orders)
+    full_size = len(json.dumps(before))
+    encode_time = min(timeit.repeat(lambda: json.dumps(before), number=20, repeat=3)) / 20
+    print('%d orders, %d characters in full, %.0fus to encode' % (orders, full_size, encode_time * 1e6))
+    print('%-20s %10s %8s %10s %14s' % ('change', 'patch', 'saved', 'diff us', 'diff+encode us'))
+    for change in CHANGES:
+        after = change(before)
+        patch = json.dumps(diff(before, after))
+        diff_time = min(timeit.repeat(lambda: diff(before, after), number=20, repeat=3)) / 20
+        both_time = min(timeit.repeat(lambda: json.dumps(diff(before, after)), number=20, repeat=3)) / 20
+        # the server falls back to the full payload when the patch isn't smaller
+        saved = max(0.0, 1 - len(patch) / float(len(json.dumps(after))))
+        print('%-20s %10d %7.1f%% %10.0f %14.0f' % (change.__name__,
+                                                    len(patch),
+                                                    saved * 100,
+                                                    diff_time * 1e6,
+                                                    both_time * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ORDERS)
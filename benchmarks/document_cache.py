@@ -0,0 +1,64 @@
+#
+# SUBSCRIPTION_START rate with the document cache on and off, for a
+# client resubscribing the same valid or invalid document
+#
+# run from the repository root:
+#   python -m benchmarks.document_cache [starts]
+#
+# with the cache on, valid documents are subscribed from the cached AST,
+# so python-graphql-subscriptions never parses or validates them again
+#
+import json
+import sys
+import time
+
+from flask_socketio import SocketIOTestClient
+from python_graphql_subscriptions import SubscriptionManager, PubSub
+
+from tests.app import create_app
+from tests.schema import Schema
+from flask_graphql_subscriptions_transport import SubscriptionServer
+from flask_graphql_subscriptions_transport.message_types import SUBSCRIPTION_START
+
+DEFAULT_STARTS = 2000
+NAMESPACE = '/ws'
+DOCUMENTS = [
+    ('valid', 'subscription onTest($filter: Boolean) { test_filter_sub(filter_bool: $filter) }'),
+    ('invalid', 'query onTest { testString unknownField { id name } }'),
+]
+
+
+def run(query, document_cache_size, starts):
+    app = create_app()
+    ss = SubscriptionServer(app,
+                            SubscriptionManager(Schema, PubSub(), {}),
+                            document_cache_size=document_cache_size)
+    client = SocketIOTestClient(app, ss.socketio, namespace=NAMESPACE)
+    # the same id each time, so every start replaces the last one
+    message = json.dumps({'type': SUBSCRIPTION_START,
+                          'id': 1,
+                          'query': query,
+                          'variables': {'filter': True}})
+    start = time.perf_counter()
+    for i in range(starts):
+        client.emit('message', message, namespace=NAMESPACE)
+        client.queue = []
+    elapsed = time.perf_counter() - start
+    SocketIOTestClient.clients.pop(client.eio_sid, None)
+    return starts / elapsed, ss.document_cache.stats() if ss.document_cache else None
+
+
+def main(starts):
+    print('%-10s %-8s %12s %8s %8s' % ('document', 'cache', 'starts/s', 'hits', 'misses'))
+    for label, query in DOCUMENTS:
+        for size in (None, 100):
+            rate, stats = run(query, size, starts)
+            print('%-10s %-8s %12.0f %8s %8s' % (label,
+                                                 'on' if size else 'off',
+                                                 rate,
+                                                 stats['hits'] if stats else '-',
+                                                 stats['misses'] if stats else '-'))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_STARTS)
@@ -0,0 +1,63 @@
+#
+# string envelope ({'data': '<json text>'}) vs object envelope, measured
+# through Socket.IO packet encoding: server encode rate, client decode
+# rate and bytes on the wire per SUBSCRIPTION_DATA frame
+#
+# run from the repository root:
+#   python -m benchmarks.envelope
+#
+import json
+
+from socketio import packet
+
+from flask_graphql_subscriptions_transport.message_types import (
+    SUBSCRIPTION_DATA,
+    SUBSCRIPTION_MESSAGE,
+)
+from flask_graphql_subscriptions_transport.flask_graphql_subscriptions_transport import (
+    SUBSCRIPTION_DATA_PREFIX,
+)
+
+from benchmarks.fan_out_encoding import make_payload
+from benchmarks.json_codecs import messages_per_second
+
+PAYLOAD_SIZES = [200, 5000, 50000]
+NAMESPACE = '/ws'
+
+
+def encode_string(payload):
+    frame = {'data': '%s%s, "payload": %s}' % (SUBSCRIPTION_DATA_PREFIX, json.dumps(17), json.dumps(payload))}
+    return packet.Packet(packet.EVENT, data=[SUBSCRIPTION_MESSAGE, frame], namespace=NAMESPACE).encode()
+
+
+def encode_object(payload):
+    frame = {'type': SUBSCRIPTION_DATA, 'id': 17, 'payload': payload}
+    return packet.Packet(packet.EVENT, data=[SUBSCRIPTION_MESSAGE, frame], namespace=NAMESPACE).encode()
+
+
+def decode_string(encoded):
+    frame = packet.Packet(encoded_packet=encoded).data[1]
+    return json.loads(frame['data'])
+
+
+def decode_object(encoded):
+    return packet.Packet(encoded_packet=encoded).data[1]
+
+
+def main():
+    print('%-10s %-8s %14s %14s %10s' % ('payload', 'envelope', 'encode msg/s', 'decode msg/s', 'bytes'))
+    for size in PAYLOAD_SIZES:
+        payload = make_payload(size)
+        for name, encode, decode in (('string', encode_string, decode_string),
+                                     ('object', encode_object, decode_object)):
+            encoded = encode(payload)
+            assert decode(encoded)['payload'] == payload
+            print('%-10s %-8s %14.0f %14.0f %10d' % ('%dB' % size,
+                                                     name,
+                                                     messages_per_second(lambda: encode(payload)),
+                                                     messages_per_second(lambda: decode(encoded)),
+                                                     len(encoded.encode('utf-8'))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#
+# encoding cost of one publish fanned out to many subscribers:
+# a full json.dumps per recipient vs one encoded payload spliced into
+# every frame
+#
+# run from the repository root:
+#   python -m benchmarks.fan_out_encoding [subscribers]
+#
+import json
+import sys
+import timeit
+
+from flask_graphql_subscriptions_transport.message_types import SUBSCRIPTION_DATA
+from flask_graphql_subscriptions_transport.flask_graphql_subscriptions_transport import (
+    SUBSCRIPTION_DATA_PREFIX,
+)
+
+PAYLOAD_SIZES = [100, 1000, 10000, 100000]
+DEFAULT_SUBSCRIBERS = 100
+
+
+def make_payload(size):
+    """
+    a list of small objects, roughly size bytes once encoded
+    """
+    item = {'id': 12345, 'name': 'item name', 'price': 10.5, 'active': True}
+    item_size = len(json.dumps(item)) + 2
+    return {'data': {'items': [dict(item, id=i) for i in range(max(1, size // item_size))]}}
+
+
+def per_recipient(subscribers, payload):
+    for sub_id in subscribers:
+        json.dumps({'type': SUBSCRIPTION_DATA, 'id': sub_id, 'payload': payload})
+
+
+def encode_once(subscribers, payload):
+    encoded_payload = json.dumps(payload)
+    for sub_id in subscribers:
+        '%s%s, "payload": %s}' % (SUBSCRIPTION_DATA_PREFIX, json.dumps(sub_id), encoded_payload)
+
+
+def main(subscriber_count):
+    subscribers = list(range(subscriber_count))
+    print('%d subscribers per publish' % subscriber_count)
+    print('%-10s %16s %16s %9s' % ('payload', 'per-recipient', 'encode-once', 'speedup'))
+    for size in PAYLOAD_SIZES:
+        payload = make_payload(size)
+        number = max(1, 200000 // (size * subscriber_count))
+        slow = min(timeit.repeat(lambda: per_recipient(subscribers, payload), number=number, repeat=3)) / number
+        fast = min(timeit.repeat(lambda: encode_once(subscribers, payload), number=number, repeat=3)) / number
+        print('%-10s %14.1fus %14.1fus %8.1fx' % ('%dB' % len(json.dumps(payload)),
+                                                  slow * 1e6,
+                                                  fast * 1e6,
+                                                  slow / fast))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SUBSCRIBERS)
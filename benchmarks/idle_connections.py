@@ -0,0 +1,76 @@
+#
+# memory per idle connection on the asyncio transport: connections are
+# opened in process through the ASGI app, each with one subscription,
+# and left idle
+#
+# run from the repository root:
+#   python -m benchmarks.idle_connections [connections]
+#
+import asyncio
+import json
+import sys
+import threading
+import time
+import tracemalloc
+
+from python_graphql_subscriptions import SubscriptionManager, PubSub
+
+from tests.schema import Schema
+from flask_graphql_subscriptions_transport import AsyncSubscriptionServer
+from flask_graphql_subscriptions_transport.message_types import SUBSCRIPTION_START
+
+DEFAULT_CONNECTIONS = 5000
+QUERY = 'subscription test{ test_subscription }'
+SCOPE = {
+    'type': 'websocket',
+    'asgi': {'version': '3.0'},
+    'scheme': 'ws',
+    'path': '/socket.io/',
+    'query_string': b'EIO=4&transport=websocket',
+    'headers': [(b'upgrade', b'websocket'), (b'connection', b'Upgrade')],
+    'server': ('127.0.0.1', 80),
+    'client': ('127.0.0.1', 5000),
+}
+
+
+async def discard(message):
+    pass
+
+
+async def open_connections(ss, count):
+    inboxes = []
+    for i in range(count):
+        inbox = asyncio.Queue()
+        inbox.put_nowait({'type': 'websocket.connect'})
+        inbox.put_nowait({'type': 'websocket.receive', 'text': '40%s,' % ss.namespace})
+        start = {'type': SUBSCRIPTION_START, 'id': 1, 'query': QUERY, 'variables': {}}
+        inbox.put_nowait({'type': 'websocket.receive',
+                          'text': '42%s,%s' % (ss.namespace, json.dumps(['message', json.dumps(start)]))})
+        asyncio.ensure_future(ss.asgi_app(dict(SCOPE), inbox.get, discard))
+        inboxes.append(inbox)
+        if i % 100 == 0:
+            await asyncio.sleep(0)
+    # let every handshake finish
+    while len(ss.connection_subscriptions) < count:
+        await asyncio.sleep(0.01)
+    return inboxes
+
+
+def main(count):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    ss = AsyncSubscriptionServer(SubscriptionManager(Schema, PubSub(), {}), lifecycle_messages=False)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    inboxes = loop.run_until_complete(open_connections(ss, count))
+    elapsed = time.perf_counter() - started
+    used = tracemalloc.get_traced_memory()[0] - before
+    print('%d idle connections with a subscription each' % len(inboxes))
+    print('  opened in       %8.2fs (%.0f/s)' % (elapsed, count / elapsed))
+    print('  python heap     %8.1f kB per connection' % (used / 1000.0 / count))
+    print('  threads         %8d' % len(threading.enumerate()))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_CONNECTIONS)
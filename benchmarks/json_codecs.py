@@ -0,0 +1,65 @@
+#
+# messages/sec for each available JSON codec, parsing inbound
+# SUBSCRIPTION_START frames and encoding outbound SUBSCRIPTION_DATA frames
+#
+# run from the repository root:
+#   python -m benchmarks.json_codecs
+#
+import json
+import timeit
+
+from flask_graphql_subscriptions_transport.codec import make_codec
+from flask_graphql_subscriptions_transport.message_types import SUBSCRIPTION_START
+from flask_graphql_subscriptions_transport.flask_graphql_subscriptions_transport import (
+    SUBSCRIPTION_DATA_PREFIX,
+)
+
+from benchmarks.fan_out_encoding import make_payload
+
+CODECS = ['json', 'orjson', 'ujson', 'rapidjson']
+PAYLOAD_SIZES = [200, 5000, 50000]
+
+START_MESSAGE = json.dumps({
+    'type': SUBSCRIPTION_START,
+    'id': 17,
+    'query': 'subscription onCommentAdded($repoFullName: String!) {'
+             ' commentAdded(repoFullName: $repoFullName) {'
+             ' id content createdAt postedBy { login html_url } } }',
+    'variables': {'repoFullName': 'apollographql/GitHunt-API'},
+    'operation_name': 'onCommentAdded',
+})
+
+
+def messages_per_second(func, duration=0.2):
+    number = 1
+    while True:
+        elapsed = timeit.timeit(func, number=number)
+        if elapsed > duration:
+            return number / elapsed
+        number *= 2
+
+
+def encode_data(codec, sub_id, payload):
+    return '%s%s, "payload": %s}' % (SUBSCRIPTION_DATA_PREFIX, codec.dumps(sub_id), codec.dumps(payload))
+
+
+def main():
+    codecs = []
+    for name in CODECS:
+        codec = make_codec(name)
+        # make_codec quietly falls back to stdlib json
+        if codec.name == name:
+            codecs.append(codec)
+    rows = [('parse start', lambda codec: (lambda: codec.loads(START_MESSAGE)))]
+    for size in PAYLOAD_SIZES:
+        payload = make_payload(size)
+        rows.append(('data %dB' % size,
+                     lambda codec, payload=payload: (lambda: encode_data(codec, 17, payload))))
+    print('messages/sec')
+    print('%-12s' % 'operation' + ''.join(' %13s' % codec.name for codec in codecs))
+    for label, make_func in rows:
+        print('%-12s' % label + ''.join(' %13.0f' % messages_per_second(make_func(codec)) for codec in codecs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#
+# just enough of a Socket.IO client to drive benchmarks.live_server:
+# Engine.IO 4 over a websocket, one namespace, unfragmented text frames
+#
+# it speaks websocket over a plain socket, since ready made clients may
+# lose a frame that arrives together with the handshake response
+#
+import base64
+import json
+import os
+import socket
+import struct
+
+from flask_graphql_subscriptions_transport.message_types import SUBSCRIPTION_MESSAGE
+
+
+class LiveClient(object):
+    def __init__(self, host, port, namespace='/ws', timeout=10):
+        self.namespace = namespace
+        self.event_prefix = '42%s,' % namespace
+        self.sock = socket.create_connection((host, port), timeout)
+        self.buffer = b''
+        key = base64.b64encode(os.urandom(16)).decode('ascii')
+        self.sock.sendall(('GET /socket.io/?EIO=4&transport=websocket HTTP/1.1\r\n'
+                           'Host: %s:%d\r\n'
+                           'Upgrade: websocket\r\n'
+                           'Connection: Upgrade\r\n'
+                           'Sec-WebSocket-Key: %s\r\n'
+                           'Sec-WebSocket-Version: 13\r\n\r\n' % (host, port, key)).encode('ascii'))
+        while b'\r\n\r\n' not in self.buffer:
+            self.fill()
+        response, self.buffer = self.buffer.split(b'\r\n\r\n', 1)
+        if b' 101 ' not in response.split(b'\r\n', 1)[0]:
+            raise ConnectionError(response.decode('latin-1'))
+        # engine.io open packet
+        self.receive_packet()
+        self.send_packet('40%s,' % namespace)
+        while not self.receive_packet().startswith('40'):
+            pass
+
+    def fill(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise ConnectionError('server closed the connection')
+        self.buffer += data
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            self.fill()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def send_packet(self, text):
+        payload = text.encode('utf-8')
+        # client frames are always masked
+        mask = os.urandom(4)
+        if len(payload) < 126:
+            header = struct.pack('!BB', 0x81, 0x80 | len(payload))
+        elif len(payload) < 65536:
+            header = struct.pack('!BBH', 0x81, 0x80 | 126, len(payload))
+        else:
+            header = struct.pack('!BBQ', 0x81, 0x80 | 127, len(payload))
+        masked = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+        self.sock.sendall(header + mask + masked)
+
+    def receive_packet(self):
+        while True:
+            first, second = self.read(2)
+            length = second & 0x7f
+            if length == 126:
+                length, = struct.unpack('!H', self.read(2))
+            elif length == 127:
+                length, = struct.unpack('!Q', self.read(8))
+            payload = self.read(length)
+            # only text frames carry engine.io packets
+            if first & 0x0f != 0x1:
+                continue
+            packet = payload.decode('utf-8')
+            # answer pings ourselves
+            if packet == '2':
+                self.send_packet('3')
+                continue
+            return packet
+
+    def send(self, message):
+        """
+        send a protocol message, like SocketIOTestClient.emit('message', ...)
+        """
+        self.send_packet(self.event_prefix + json.dumps(['message', json.dumps(message)]))
+
+    def receive(self):
+        """
+        the next protocol message from the server
+        """
+        while True:
+            packet = self.receive_packet()
+            if not packet.startswith(self.event_prefix):
+                continue
+            event, frame = json.loads(packet[len(self.event_prefix):])
+            if event == SUBSCRIPTION_MESSAGE:
+                return json.loads(frame['data'])
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,48 @@
+#
+# a real eventlet Socket.IO server on localhost, used by benchmarks.suite
+# GET /publish/<count>/<size> publishes count payloads of size bytes
+#
+# run from the repository root:
+#   python -m benchmarks.live_server [port]
+#
+import warnings
+# eventlet and graphql-core both warn about deprecations on import
+warnings.filterwarnings('ignore', category=DeprecationWarning)
+
+import eventlet  # noqa: E402
+eventlet.monkey_patch()
+
+import sys  # noqa: E402
+
+from python_graphql_subscriptions import SubscriptionManager, PubSub  # noqa: E402
+
+from tests.app import create_app  # noqa: E402
+from tests.schema import Schema  # noqa: E402
+from flask_graphql_subscriptions_transport import SubscriptionServer  # noqa: E402
+
+DEFAULT_PORT = 5099
+
+
+def create_server():
+    app = create_app()
+    app.debug = False
+    sub_manager = SubscriptionManager(Schema, PubSub(), {})
+    ss = SubscriptionServer(app, sub_manager, lifecycle_messages=False, async_mode='eventlet')
+
+    @app.route('/publish/<int:count>/<int:size>')
+    def publish(count, size):
+        payload = 'x' * size
+        for i in range(count):
+            ss.publish('test_subscription', payload)
+        return 'ok'
+
+    return app, ss
+
+
+def main(port):
+    app, ss = create_server()
+    ss.socketio.run(app, host='127.0.0.1', port=port, log_output=False)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT)
@@ -0,0 +1,90 @@
+#
+# MessagePack frames vs JSON text frames for numeric-heavy telemetry:
+# server encode rate, client decode rate and bytes on the wire per
+# SUBSCRIPTION_DATA frame, measured through Socket.IO packet encoding
+#
+# run from the repository root:
+#   python -m benchmarks.msgpack_protocol
+#
+import json
+import random
+
+from socketio import packet
+
+from flask_graphql_subscriptions_transport.message_types import SUBSCRIPTION_DATA, SUBSCRIPTION_MESSAGE
+from flask_graphql_subscriptions_transport.flask_graphql_subscriptions_transport import (
+    SUBSCRIPTION_DATA_PREFIX,
+)
+from flask_graphql_subscriptions_transport.msgpack_protocol import MsgpackProtocol
+
+from benchmarks.json_codecs import messages_per_second
+
+SAMPLE_COUNTS = [10, 100, 1000]
+NAMESPACE = '/ws'
+
+
+def make_telemetry(samples):
+    """
+    a batch of sensor readings, mostly floats and ints
+    """
+    rng = random.Random(samples)
+    return {'data': {'telemetry': {
+        'device': 'sensor-42',
+        'readings': [{
+            'ts': 1700000000000 + i * 250,
+            'temperature': rng.uniform(-20, 40),
+            'humidity': rng.uniform(0, 100),
+            'pressure': rng.uniform(950, 1050),
+            'battery': rng.randint(0, 100),
+        } for i in range(samples)],
+    }}}
+
+
+def encode_json(payload):
+    frame = {'data': '%s%s, "payload": %s}' % (SUBSCRIPTION_DATA_PREFIX, json.dumps(17), json.dumps(payload))}
+    return packet.Packet(packet.EVENT, data=[SUBSCRIPTION_MESSAGE, frame], namespace=NAMESPACE).encode()
+
+
+def decode_json(encoded):
+    return json.loads(packet.Packet(encoded_packet=encoded).data[1]['data'])
+
+
+def main():
+    try:
+        packer = MsgpackProtocol()
+    except ImportError:
+        print('msgpack is not installed')
+        return
+
+    def encode_msgpack(payload):
+        frame = {'data': packer.encode_data(SUBSCRIPTION_DATA, 17, packer.dumps(payload))}
+        # the text part, then the binary attachment
+        return packet.Packet(packet.EVENT, data=[SUBSCRIPTION_MESSAGE, frame], namespace=NAMESPACE).encode()
+
+    def decode_msgpack(encoded):
+        text, attachment = encoded
+        decoded = packet.Packet(encoded_packet=text)
+        decoded.add_attachment(attachment)
+        return packer.loads(decoded.data[1]['data'])
+
+    print('%-9s %-8s %14s %14s %10s' % ('samples', 'format', 'encode msg/s', 'decode msg/s', 'bytes'))
+    for samples in SAMPLE_COUNTS:
+        payload = make_telemetry(samples)
+        for name, encode, decode in (('json', encode_json, decode_json),
+                                     ('msgpack', encode_msgpack, decode_msgpack)):
+            encoded = encode(payload)
+            assert decode(encoded)['payload']['data']['telemetry']['readings'][-1]['battery'] == \
+                payload['data']['telemetry']['readings'][-1]['battery']
+            if isinstance(encoded, str):
+                size = len(encoded.encode('utf-8'))
+            else:
+                size = sum(len(part if isinstance(part, bytes) else part.encode('utf-8')) for part in encoded)
+            print('%-9d %-8s %14.0f %14.0f %10d' % (samples,
+                                                    name,
+                                                    messages_per_second(lambda: encode(payload)),
+                                                    messages_per_second(lambda: decode(encoded)),
+                                                    size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+#
+# a SUBSCRIPTION_DATA frame in the legacy protocol over Socket.IO vs a
+# graphql-ws next frame on a plain websocket: server encode rate and bytes
+# on the wire per frame, before websocket framing
+#
+# run from the repository root:
+#   python -m benchmarks.protocols
+#
+import json
+
+from socketio import packet
+
+from flask_graphql_subscriptions_transport.message_types import SUBSCRIPTION_MESSAGE, INIT_SUCCESS
+from flask_graphql_subscriptions_transport.flask_graphql_subscriptions_transport import (
+    SUBSCRIPTION_DATA_PREFIX,
+)
+from flask_graphql_subscriptions_transport.protocols import GraphQLWSProtocol
+
+from benchmarks.delta import make_result
+from benchmarks.json_codecs import messages_per_second
+
+ORDER_COUNTS = [1, 10, 100]
+NAMESPACE = '/ws'
+
+
+def encode_legacy(encoded_payload):
+    frame = {'data': '%s%s, "payload": %s}' % (SUBSCRIPTION_DATA_PREFIX, json.dumps('17'), encoded_payload)}
+    # engine.io's message type goes in front
+    return '4' + packet.Packet(packet.EVENT, data=[SUBSCRIPTION_MESSAGE, frame], namespace=NAMESPACE).encode()
+
+
+def main():
+    protocol = GraphQLWSProtocol()
+    protocol.receive({'type': 'connection_init'})
+    protocol.send({'type': INIT_SUCCESS})
+    protocol.receive({'type': 'subscribe', 'id': '17', 'payload': {'query': 'subscription { orders }'}})
+
+    def encode_graphql_ws(encoded_payload):
+        return protocol.data_frame('17', encoded_payload)
+
+    print('%-8s %-20s %14s %10s' % ('orders', 'protocol', 'encode msg/s', 'bytes'))
+    for orders in ORDER_COUNTS:
+        encoded_payload = json.dumps(make_result(orders))
+        for name, encode in (('legacy / Socket.IO', encode_legacy),
+                             ('graphql-ws', encode_graphql_ws)):
+            encoded = encode(encoded_payload)
+            print('%-8d %-20s %14.0f %10d' % (orders,
+                                              name,
+                                              messages_per_second(lambda: encode(encoded_payload)),
+                                              len(encoded.encode('utf-8'))))
+
+
+if __name__ == '__main__':
+    main()
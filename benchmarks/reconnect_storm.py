@@ -0,0 +1,55 @@
+#
+# reconnect storm: every client drops and reconnects at once,
+# like a fleet coming back after a deploy
+#
+# run from the repository root:
+#   python -m benchmarks.reconnect_storm [clients ...]
+#
+import sys
+import time
+
+from flask_socketio import SocketIOTestClient
+from python_graphql_subscriptions import SubscriptionManager, PubSub
+
+from tests.app import create_app
+from tests.schema import Schema
+from flask_graphql_subscriptions_transport import SubscriptionServer
+
+DEFAULT_SIZES = [1000, 5000, 10000]
+NAMESPACE = '/ws'
+
+
+def run_storm(client_count, lifecycle_messages):
+    app = create_app()
+    sub_manager = SubscriptionManager(Schema, PubSub(), {})
+    ss = SubscriptionServer(app, sub_manager, lifecycle_messages=lifecycle_messages)
+    clients = [SocketIOTestClient(app, ss.socketio, namespace=NAMESPACE)
+               for i in range(client_count)]
+
+    start = time.perf_counter()
+    for client in clients:
+        client.disconnect(namespace=NAMESPACE)
+    for client in clients:
+        client.connect(namespace=NAMESPACE)
+    elapsed = time.perf_counter() - start
+
+    received = sum(len(client.queue) for client in clients)
+    for client in clients:
+        SocketIOTestClient.clients.pop(client.eio_sid, None)
+    return elapsed, received
+
+
+def main(sizes):
+    print('%-10s %-10s %12s %14s %12s' % ('clients', 'notices', 'seconds', 'reconnects/s', 'frames'))
+    for size in sizes:
+        for lifecycle_messages in (True, False):
+            elapsed, received = run_storm(size, lifecycle_messages)
+            print('%-10d %-10s %12.3f %14.0f %12d' % (size,
+                                                      'on' if lifecycle_messages else 'off',
+                                                      elapsed,
+                                                      size / elapsed,
+                                                      received))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
@@ -0,0 +1,247 @@
+#
+# throughput suite for catching regressions between releases
+# every result is a rate, higher is better
+#
+# run from the repository root:
+#   python -m benchmarks.suite [--quick] [--output results.json]
+#   python -m benchmarks.suite --baseline results.json [--tolerance 0.2]
+#
+# with --baseline the run is compared against a stored result file and
+# exits non-zero when anything got slower than the tolerance allows
+#
+import argparse
+import importlib.util
+import json
+import platform
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+from flask_socketio import SocketIOTestClient
+from python_graphql_subscriptions import SubscriptionManager, PubSub
+
+from tests.app import create_app
+from tests.schema import Schema
+from flask_graphql_subscriptions_transport import SubscriptionServer
+from flask_graphql_subscriptions_transport.message_types import (
+    SUBSCRIPTION_START,
+    SUBSCRIPTION_END,
+    SUBSCRIPTION_SUCCESS,
+    SUBSCRIPTION_DATA,
+)
+from benchmarks.reconnect_storm import run_storm
+
+QUERY = 'subscription test{ test_subscription }'
+
+
+def make_server(**options):
+    app = create_app()
+    sub_manager = SubscriptionManager(Schema, PubSub(), {})
+    return app, SubscriptionServer(app, sub_manager, lifecycle_messages=False, **options)
+
+
+def connect(app, ss, count):
+    return [SocketIOTestClient(app, ss.socketio, namespace=ss.namespace) for i in range(count)]
+
+
+def release(clients):
+    # the test client keeps every instance in a class level dict
+    for client in clients:
+        SocketIOTestClient.clients.pop(client.eio_sid, None)
+
+
+def start(client, ss, sub_id):
+    client.emit('message',
+                json.dumps({'type': SUBSCRIPTION_START, 'id': sub_id, 'query': QUERY, 'variables': {}}),
+                namespace=ss.namespace)
+
+
+def subscribe_unsubscribe(count):
+    app, ss = make_server()
+    client, = connect(app, ss, 1)
+    started = time.perf_counter()
+    for i in range(count):
+        start(client, ss, i)
+        client.emit('message', json.dumps({'type': SUBSCRIPTION_END, 'id': i}), namespace=ss.namespace)
+        if i % 100 == 0:
+            client.get_received(ss.namespace)
+    elapsed = time.perf_counter() - started
+    release([client])
+    return 2 * count / elapsed
+
+
+def fan_out(subscribers, payload_size=100, deliveries=20000):
+    """
+    deliveries per second for publishes reaching every subscriber
+    """
+    app, ss = make_server()
+    clients = connect(app, ss, subscribers)
+    for client in clients:
+        start(client, ss, 1)
+        client.get_received(ss.namespace)
+    publishes = max(1, deliveries // subscribers)
+    payload = 'x' * payload_size
+    started = time.perf_counter()
+    for i in range(publishes):
+        ss.publish('test_subscription', payload)
+    elapsed = time.perf_counter() - started
+    release(clients)
+    return subscribers * publishes / elapsed
+
+
+def large_payload(size, subscribers=10, megabytes=50):
+    """
+    megabytes of SUBSCRIPTION_DATA per second
+    """
+    publishes = max(1, megabytes * 1000000 // (size * subscribers))
+    rate = fan_out(subscribers, payload_size=size, deliveries=publishes * subscribers)
+    return rate * size / 1e6
+
+
+def reconnect_storm(clients):
+    elapsed, received = run_storm(clients, False)
+    return clients / elapsed
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for_server(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            # publishing nothing doubles as a health check
+            urllib.request.urlopen('http://127.0.0.1:%d/publish/0/0' % port, timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('live server did not come up on port %d' % port)
+
+
+def live_fan_out(subscribers, publishes=200, payload_size=100):
+    """
+    deliveries per second through a real eventlet server and websockets,
+    from the publish request until every client has every frame
+    """
+    from benchmarks.live_client import LiveClient
+
+    port = free_port()
+    server = subprocess.Popen([sys.executable, '-m', 'benchmarks.live_server', str(port)])
+    clients = []
+    try:
+        wait_for_server(port)
+        for i in range(subscribers):
+            client = LiveClient('127.0.0.1', port)
+            client.send({'type': SUBSCRIPTION_START, 'id': 1, 'query': QUERY, 'variables': {}})
+            assert client.receive()['type'] == SUBSCRIPTION_SUCCESS
+            clients.append(client)
+        started = time.perf_counter()
+        urllib.request.urlopen('http://127.0.0.1:%d/publish/%d/%d' % (port, publishes, payload_size)).read()
+        for client in clients:
+            for i in range(publishes):
+                assert client.receive()['type'] == SUBSCRIPTION_DATA
+        elapsed = time.perf_counter() - started
+    finally:
+        for client in clients:
+            client.close()
+        server.terminate()
+        server.wait()
+    return subscribers * publishes / elapsed
+
+
+def live_available():
+    return importlib.util.find_spec('eventlet') is not None
+
+
+def scenarios(quick):
+    """
+    (name, unit, function, args) for everything we measure
+    """
+    fan_out_sizes = [1, 100, 1000] if quick else [1, 100, 10000]
+    yield ('subscribe_unsubscribe', 'ops/s', subscribe_unsubscribe, (2000 if quick else 10000,))
+    for subscribers in fan_out_sizes:
+        yield ('fan_out.%d' % subscribers, 'deliveries/s', fan_out, (subscribers,))
+    for size in [100000, 1000000]:
+        yield ('large_payload.%dkB' % (size // 1000), 'MB/s', large_payload, (size,))
+    yield ('reconnect_storm', 'reconnects/s', reconnect_storm, (1000 if quick else 5000,))
+    if live_available():
+        yield ('live.fan_out.%d' % (20 if quick else 100), 'deliveries/s',
+               live_fan_out, (20 if quick else 100,))
+
+
+def run(quick, only=None, repeat=3):
+    results = {}
+    for name, unit, func, args in scenarios(quick):
+        if only and not any(name.startswith(prefix) for prefix in only):
+            continue
+        # best of a few runs, like timeit
+        value = max(func(*args) for i in range(repeat))
+        results[name] = {'value': value, 'unit': unit}
+        print('%-26s %14.1f %s' % (name, value, unit))
+        sys.stdout.flush()
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'quick': quick,
+        'repeat': repeat,
+        'timestamp': time.time(),
+        'results': results,
+    }
+
+
+def compare(baseline, current, tolerance):
+    """
+    print current against baseline, returns the names that regressed
+    """
+    regressions = []
+    print('%-26s %14s %14s %9s' % ('benchmark', 'baseline', 'current', 'change'))
+    for name, result in sorted(current['results'].items()):
+        before = baseline['results'].get(name, None)
+        if before is None:
+            print('%-26s %14s %14.1f %9s' % (name, '-', result['value'], 'new'))
+            continue
+        change = result['value'] / before['value'] - 1
+        regressed = change < -tolerance
+        if regressed:
+            regressions.append(name)
+        print('%-26s %14.1f %14.1f %+8.1f%%%s' % (name,
+                                                  before['value'],
+                                                  result['value'],
+                                                  change * 100,
+                                                  '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='transport throughput suite')
+    parser.add_argument('--quick', action='store_true', help='smaller sizes, for CI')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='compare against a results file written by --output')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown against the baseline, default 0.2 (20%%)')
+    parser.add_argument('--only', action='append', help='run benchmarks starting with this name')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark, the best one counts')
+    args = parser.parse_args(argv)
+
+    current = run(args.quick, args.only, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(current, output, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(json.load(baseline), current, args.tolerance)
+        if regressions:
+            print('regressed: %s' % ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1 +1,3 @@
 from .flask_graphql_subscriptions_transport import SubscriptionServer
+from .async_server import AsyncSubscriptionServer
+from .websocket_server import WebSocketSubscriptionServer
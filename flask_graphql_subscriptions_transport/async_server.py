@@ -0,0 +1,131 @@
+#
+# the same SubscriptionServer on python-socketio's asyncio AsyncServer,
+# served as an ASGI app instead of through Flask-SocketIO
+#
+
+import asyncio
+import contextvars
+import logging
+import threading
+
+import socketio
+
+from .flask_graphql_subscriptions_transport import SubscriptionServer
+
+logger = logging.getLogger(__name__)
+
+# session id of the event being handled
+CURRENT_SID = contextvars.ContextVar('current_sid', default=None)
+
+# what the writer task is asked to do
+EMIT = 'emit'
+DISCONNECT = 'disconnect'
+
+
+class AsyncSubscriptionServer(SubscriptionServer):
+    """
+    SubscriptionServer on socketio.AsyncServer, every option works the same
+    mount asgi_app, or wrap sio in your own socketio.ASGIApp
+
+    message handling is synchronous and runs on the event loop, frames are
+    handed to a single writer task so they go out in order, and timers,
+    executor workers and the broker listener run on threads
+    parse_context gets the socket's WSGI-style environ instead of a
+    Flask request
+    socket_options go to socketio.AsyncServer, e.g. ping_interval
+    """
+    def __init__(self, subscription_manager, **options):
+        super(AsyncSubscriptionServer, self).__init__(None, subscription_manager, **options)
+
+    def init_transport(self, app, socket_options):
+        socket_options.setdefault('async_mode', 'asgi')
+        self.sio = socketio.AsyncServer(**socket_options)
+        self.asgi_app = socketio.ASGIApp(self.sio)
+        # bound on the first connect
+        self.loop = None
+        self.outgoing = None
+        self.writer = None
+
+    def register_handlers(self):
+        self.sio.on('connect', self.async_connect, namespace=self.namespace)
+        self.sio.on('disconnect', self.async_disconnect, namespace=self.namespace)
+        self.sio.on('message', self.async_message, namespace=self.namespace)
+
+    def bind_loop(self):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+            self.outgoing = asyncio.Queue()
+            self.writer = self.loop.create_task(self.write_loop())
+
+    def handle(self, sid, handler, *args):
+        token = CURRENT_SID.set(sid)
+        try:
+            return handler(*args)
+        finally:
+            CURRENT_SID.reset(token)
+
+    async def async_connect(self, sid, environ, auth=None):
+        self.bind_loop()
+        return self.handle(sid, self.socket_connect, auth)
+
+    async def async_disconnect(self, sid, reason=None):
+        self.handle(sid, self.socket_disconnect)
+
+    async def async_message(self, sid, message):
+        self.handle(sid, self.on_message, message)
+
+    async def write_loop(self):
+        while True:
+            action, request_id, event, frame = await self.outgoing.get()
+            try:
+                if action == EMIT:
+                    await self.sio.emit(event, frame, namespace=self.namespace, to=request_id)
+                else:
+                    await self.sio.disconnect(request_id, namespace=self.namespace)
+            except Exception:
+                # one bad frame must not stop the writer
+                logger.exception('failed to write to %s', request_id)
+
+    def queue_action(self, *action):
+        """
+        hand an action to the writer task, from the loop or any thread
+        """
+        if self.loop is None:
+            return
+        try:
+            on_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self.enqueue(action)
+        else:
+            self.loop.call_soon_threadsafe(self.enqueue, action)
+
+    def enqueue(self, action):
+        """
+        queue an action for the writer, on the loop
+        """
+        self.outgoing.put_nowait(action)
+
+    def start_background_task(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        return thread
+
+    def current_sid(self):
+        return CURRENT_SID.get()
+
+    def current_request(self):
+        request_id = CURRENT_SID.get()
+        if request_id is None:
+            return None
+        return self.sio.get_environ(request_id, namespace=self.namespace)
+
+    def socket_server(self):
+        return self.sio
+
+    def emit(self, event, frame, request_id):
+        self.queue_action(EMIT, request_id, event, frame)
+
+    def disconnect_client(self, request_id):
+        self.queue_action(DISCONNECT, request_id, None, None)
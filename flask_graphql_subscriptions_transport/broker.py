@@ -0,0 +1,66 @@
+#
+# carries publishes and emits between worker processes
+#
+
+import multiprocessing
+import uuid
+
+# broker message kinds
+BROKER_PUBLISH = 'publish'
+BROKER_EMIT = 'emit'
+
+
+class Broker(object):
+    """
+    interface for the message queue that links every worker of an app
+    publish sends a message to all workers, the sender included, and
+    listen yields the messages addressed to this worker until close
+    messages are plain dicts, so any backend that can carry JSON will do
+    """
+    def __init__(self, worker_id=None):
+        self.worker_id = worker_id or uuid.uuid4().hex
+
+    def publish(self, message):
+        raise NotImplementedError
+
+    def listen(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class QueueBroker(Broker):
+    """
+    stand-in broker built from one queue per worker, publish puts the
+    message on every queue
+    works across processes with multiprocessing queues, and inside one
+    process with queue.Queue
+    """
+    def __init__(self, inbox, queues, worker_id=None):
+        super(QueueBroker, self).__init__(worker_id)
+        self.inbox = inbox
+        self.queues = queues
+
+    def publish(self, message):
+        for queue in self.queues:
+            queue.put(message)
+
+    def listen(self):
+        while True:
+            message = self.inbox.get()
+            # close() wakes the listener up with None
+            if message is None:
+                return
+            yield message
+
+    def close(self):
+        self.inbox.put(None)
+
+
+def make_queue_brokers(workers, queue_factory=multiprocessing.Queue):
+    """
+    one QueueBroker per worker, all linked to each other
+    """
+    queues = [queue_factory() for i in range(workers)]
+    return [QueueBroker(inbox, queues, 'worker-%d' % i) for i, inbox in enumerate(queues)]
@@ -0,0 +1,50 @@
+#
+# pluggable JSON codec for parsing inbound messages and encoding frames
+#
+
+import importlib
+import json
+
+
+class Codec(object):
+    """
+    wraps any loads / dumps pair, e.g. from orjson, ujson or rapidjson
+    dumps always returns text, even when the library produces bytes
+    """
+    def __init__(self, loads=None, dumps=None, name=None):
+        self._loads = loads or json.loads
+        self._dumps = dumps or json.dumps
+        self.name = name or ('json' if loads is None and dumps is None else 'custom')
+
+    def loads(self, text):
+        return self._loads(text)
+
+    def dumps(self, obj):
+        encoded = self._dumps(obj)
+        # orjson and friends hand back bytes
+        if isinstance(encoded, bytes):
+            return encoded.decode('utf-8')
+        return encoded
+
+
+def make_codec(codec=None):
+    """
+    build a Codec from:
+    - None, for the stdlib json module
+    - the name of a JSON module ('orjson', 'ujson', 'rapidjson'), falling
+      back to stdlib json if it isn't installed
+    - any object exposing loads and dumps, like the module itself
+    - a Codec
+    """
+    if codec is None:
+        return Codec(name='json')
+    if isinstance(codec, Codec):
+        return codec
+    if isinstance(codec, str):
+        try:
+            codec = importlib.import_module(codec)
+        except ImportError:
+            return Codec(name='json')
+    if not (callable(getattr(codec, 'loads', None)) and callable(getattr(codec, 'dumps', None))):
+        raise ValueError('codec must provide loads and dumps')
+    return Codec(codec.loads, codec.dumps, getattr(codec, '__name__', None))
@@ -0,0 +1,99 @@
+#
+# pluggable compression for large SUBSCRIPTION_DATA payloads, negotiated
+# with each client at INIT
+#
+
+import importlib
+import zlib
+from collections import OrderedDict
+
+
+class Compressor(object):
+    """
+    interface for a compression scheme
+    name is what clients ask for at INIT
+    """
+    name = None
+
+    def compress(self, data):
+        raise NotImplementedError
+
+    def decompress(self, data):
+        raise NotImplementedError
+
+
+class ZlibCompressor(Compressor):
+    name = 'zlib'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class ZstdCompressor(Compressor):
+    """
+    needs the zstandard package
+    """
+    name = 'zstd'
+
+    def __init__(self, level=3):
+        zstandard = importlib.import_module('zstandard')
+        self.level = level
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def decompress(self, data):
+        return self.decompressor.decompress(data)
+
+
+COMPRESSORS = {
+    ZlibCompressor.name: ZlibCompressor,
+    ZstdCompressor.name: ZstdCompressor,
+}
+
+
+def make_compressors(compression=None):
+    """
+    build the name -> Compressor map a server offers, in order of preference,
+    from a name ('zlib', 'zstd'), a Compressor, or a list of them
+    names whose library isn't installed are left out
+    """
+    compressors = OrderedDict()
+    if compression is None:
+        return compressors
+    if isinstance(compression, (str, Compressor)):
+        compression = [compression]
+    for compressor in compression:
+        if isinstance(compressor, str):
+            if compressor not in COMPRESSORS:
+                raise ValueError('unknown compression %r' % compressor)
+            try:
+                compressor = COMPRESSORS[compressor]()
+            except ImportError:
+                continue
+        if not (callable(getattr(compressor, 'compress', None)) and getattr(compressor, 'name', None)):
+            raise ValueError('compression must provide a name and compress')
+        compressors[compressor.name] = compressor
+    return compressors
+
+
+def choose_compressor(compressors, requested):
+    """
+    the first of the client's requested names the server offers, or None
+    """
+    if isinstance(requested, str):
+        requested = [requested]
+    if not isinstance(requested, list):
+        return None
+    for name in requested:
+        if isinstance(name, str) and name in compressors:
+            return compressors[name]
+    return None
@@ -0,0 +1,66 @@
+#
+# latest-value-only delivery for high frequency subscriptions
+#
+
+import threading
+
+
+class Conflator(object):
+    """
+    throttles SUBSCRIPTION_DATA per (request_id, sub_id)
+    the first payload goes straight out and opens a window of interval
+    seconds; payloads arriving inside the window replace each other and
+    only the newest is flushed when the window closes
+    """
+    def __init__(self, scheduler, flush):
+        self.scheduler = scheduler
+        # flush(sub_id, payload, request_id), like send_subscription_data
+        self.flush = flush
+        # offer runs on publishing threads, _close on the scheduler's
+        self.lock = threading.Lock()
+        # (request_id, sub_id) -> [pending payload] while a window is open
+        self.windows = {}
+        # payloads replaced by a newer one before they were sent
+        self.conflated = 0
+
+    def offer(self, request_id, sub_id, payload, interval):
+        """
+        returns True when the payload was held back, False when the caller
+        should send it right away
+        """
+        key = (request_id, sub_id)
+        with self.lock:
+            window = self.windows.get(key, None)
+            if window is None:
+                self._open(key, interval)
+                return False
+            if window:
+                self.conflated += 1
+            window[:] = [payload]
+            return True
+
+    def discard(self, request_id, sub_id):
+        """
+        forget anything pending, e.g. when the subscription ends
+        """
+        with self.lock:
+            self.windows.pop((request_id, sub_id), None)
+
+    def _open(self, key, interval):
+        # called with the lock held
+        window = []
+        self.windows[key] = window
+        self.scheduler.call_later(interval, self._close, key, window, interval)
+
+    def _close(self, key, window, interval):
+        with self.lock:
+            # the subscription was discarded, or restarted with a new window
+            if self.windows.get(key, None) is not window:
+                return
+            if not window:
+                self.windows.pop(key)
+                return
+            payload = window[0]
+            # sending opens the next window, keeping the rate bounded
+            self._open(key, interval)
+        self.flush(key[1], payload, key[0])
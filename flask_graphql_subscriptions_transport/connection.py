@@ -0,0 +1,40 @@
+#
+# per-socket state that lives as long as the connection
+#
+
+import threading
+from collections import deque
+
+
+class Connection(object):
+    """
+    state for one socket, keyed by session id on the SubscriptionServer
+    """
+    def __init__(self, request_id, now=0):
+        self.request_id = request_id
+        # when we last heard from or wrote to the client, on the scheduler clock
+        self.last_activity = now
+        # guards the outbound state, publishes can come from any thread
+        self.lock = threading.Lock()
+        # frames waiting to go out together, None unless batching was negotiated
+        self.batch = None
+        self.batch_timer = None
+        # frames waiting for the transport, only used with bounded queues
+        self.outbox = deque()
+        self.drain_timer = None
+        # frames thrown away by the overflow policy
+        self.dropped = 0
+        # parse_context result, when it is computed once per connection
+        self.init_payload = None
+        self.context = None
+        self.context_ready = False
+        # TokenBucket for inbound messages, None without a rate limit
+        self.bucket = None
+        # the client takes SUBSCRIPTION_PATCH frames
+        self.delta = False
+        # Compressor negotiated at INIT, None for plain frames
+        self.compressor = None
+        # MsgpackProtocol when negotiated at INIT, None for JSON frames
+        self.packer = None
+        # Protocol the client speaks, None for the legacy protocol as it is
+        self.protocol = None
@@ -0,0 +1,85 @@
+#
+# JSON Patch (RFC 6902) diffs between successive results of a subscription,
+# so a small change to a large result costs a small frame
+#
+
+
+class DeltaState(object):
+    """
+    what one subscriber was last sent
+    """
+    __slots__ = ('last', 'patches')
+
+    def __init__(self):
+        self.last = None
+        # patches sent since the last full payload
+        self.patches = 0
+
+
+def escape(key):
+    return str(key).replace('~', '~0').replace('/', '~1')
+
+
+def unescape(part):
+    return part.replace('~1', '/').replace('~0', '~')
+
+
+def diff(old, new, path='', ops=None):
+    """
+    the add, remove and replace operations turning old into new
+    lists are compared index by index, so an insert near the front of a
+    long list turns into many replaces
+    values are compared with ==, so 1 and True count as equal, which a
+    GraphQL field's fixed type never mixes
+    """
+    if ops is None:
+        ops = []
+    if isinstance(old, dict) and isinstance(new, dict):
+        # comparing in C is far cheaper than walking equal subtrees
+        if old == new:
+            return ops
+        for key in old:
+            if key not in new:
+                ops.append({'op': 'remove', 'path': path + '/' + escape(key)})
+        for key, value in new.items():
+            if key in old:
+                diff(old[key], value, path + '/' + escape(key), ops)
+            else:
+                ops.append({'op': 'add', 'path': path + '/' + escape(key), 'value': value})
+    elif isinstance(old, list) and isinstance(new, list):
+        if old == new:
+            return ops
+        common = min(len(old), len(new))
+        for i in range(common):
+            diff(old[i], new[i], '%s/%d' % (path, i), ops)
+        for i in range(common, len(new)):
+            ops.append({'op': 'add', 'path': '%s/%d' % (path, i), 'value': new[i]})
+        # from the end, so the indexes stay valid
+        for i in range(len(old) - 1, common - 1, -1):
+            ops.append({'op': 'remove', 'path': '%s/%d' % (path, i)})
+    elif old != new:
+        ops.append({'op': 'replace', 'path': path, 'value': new})
+    return ops
+
+
+def apply_patch(document, ops):
+    """
+    apply diff output to a decoded document, returning the new document
+    a reference for clients, it only knows the operations diff emits
+    """
+    for op in ops:
+        if op['path'] == '':
+            document = op['value']
+            continue
+        parts = [unescape(part) for part in op['path'].split('/')[1:]]
+        target = document
+        for part in parts[:-1]:
+            target = target[int(part)] if isinstance(target, list) else target[part]
+        key = int(parts[-1]) if isinstance(target, list) else parts[-1]
+        if op['op'] == 'remove':
+            del target[key]
+        elif op['op'] == 'add' and isinstance(target, list):
+            target.insert(key, op['value'])
+        else:
+            target[key] = op['value']
+    return document
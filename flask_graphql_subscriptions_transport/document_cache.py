@@ -0,0 +1,138 @@
+#
+# bounded LRU cache of parsed and validated subscription documents
+#
+
+from collections import OrderedDict, namedtuple
+
+from graphql import parse, validate, specified_rules, value_from_ast, execute
+from graphql.language.ast import OperationDefinition
+from python_graphql_subscriptions import SubscriptionManager
+
+from .persisted_queries import query_hash
+
+# errors is an empty list for a valid document
+CachedDocument = namedtuple('CachedDocument', ['document', 'errors'])
+
+
+class DocumentCache(object):
+    """
+    parses and validates each query string against the schema once,
+    keeping the max_size most recently used results
+    """
+    def __init__(self, schema, max_size=1000):
+        self.schema = schema
+        self.max_size = max_size
+        self.documents = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.documents)
+
+    def __contains__(self, query):
+        return query_hash(query) in self.documents
+
+    def get(self, query):
+        """
+        the CachedDocument for a query string, parsing it on a miss
+        """
+        key = query_hash(query)
+        cached = self.documents.get(key, None)
+        if cached is not None:
+            self.hits += 1
+            self.documents.move_to_end(key)
+            return cached
+        self.misses += 1
+        cached = self.load(query)
+        self.documents[key] = cached
+        if len(self.documents) > self.max_size:
+            self.documents.popitem(last=False)
+            self.evictions += 1
+        return cached
+
+    def load(self, query):
+        try:
+            document = parse(query)
+        except Exception as e:
+            # syntax errors are cached like any other invalid document
+            return CachedDocument(None, [e])
+        return CachedDocument(document, validate(self.schema, document, specified_rules))
+
+    def stats(self):
+        return {
+            'size': len(self.documents),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def takes_documents(subscription_manager):
+    """
+    whether subscribe_document can stand in for subscription_manager.subscribe,
+    which it can for python-graphql-subscriptions' own, not overridden
+    """
+    subscribe = getattr(subscription_manager, 'subscribe', None)
+    return getattr(subscribe, '__func__', None) is SubscriptionManager.subscribe
+
+
+def subscribe_document(subscription_manager, document, **kwargs):
+    """
+    SubscriptionManager.subscribe for a document that is already parsed and
+    validated, registered on the manager exactly as subscribe would
+    the document is executed as it is on every publish, never parsed again
+    """
+    schema = subscription_manager.schema
+    args = {}
+    # the root field of the subscription and its arguments
+    subscription_name = ''
+    for definition in document.definitions:
+        if isinstance(definition, OperationDefinition):
+            root_field = definition.selection_set.selections[0]
+            subscription_name = root_field.name.value
+            fields = schema.get_subscription_type().fields
+            for arg in root_field.arguments:
+                arg_definition = fields[subscription_name].args.get(arg.name.value, None)
+                if arg_definition:
+                    args[arg.name.value] = value_from_ast(arg.value, arg_definition.type, kwargs['variables'])
+
+    setup_function = subscription_manager.setup_functions.get(subscription_name, None)
+    if setup_function:
+        trigger_map = setup_function(kwargs, args, subscription_name)
+    else:
+        trigger_map = {subscription_name: {}}
+
+    subscription_manager.max_subscription_id += 1
+    graphql_sub_id = subscription_manager.max_subscription_id
+    subscription_manager.subscriptions[graphql_sub_id] = []
+    for trigger_name, trigger in trigger_map.items():
+        on_message = document_handler(schema, document, trigger.get('filter', None), kwargs)
+        pubsub_id = subscription_manager.pubsub.subscribe(trigger_name,
+                                                          on_message,
+                                                          **trigger.get('channel_options', {}))
+        subscription_manager.subscriptions[graphql_sub_id].append(pubsub_id)
+    return graphql_sub_id
+
+
+def document_handler(schema, document, filter_func, kwargs):
+    """
+    the pubsub handler running a subscription's document for each payload
+    """
+    def on_message(root_value):
+        context = kwargs['context']() if callable(kwargs['context']) else kwargs['context']
+        if filter_func is not None and not filter_func(root_value, context, **kwargs['variables']):
+            return
+        try:
+            data = execute(schema,
+                           document,
+                           root_value,
+                           context,
+                           kwargs['variables'],
+                           kwargs.get('operation_name', None))
+            kwargs['callback'](None, data)
+        except Exception as e:
+            kwargs['callback'](e)
+
+    return on_message
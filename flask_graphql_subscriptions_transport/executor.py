@@ -0,0 +1,193 @@
+#
+# bounded worker pool for running subscription handlers off the publisher
+#
+
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class Executor(object):
+    """
+    runs tasks on up to size workers started with start_background_task,
+    so threads or greenlets depending on the Socket.IO async mode
+    tasks sharing a key run one at a time in the order they were submitted,
+    tasks with different keys run in parallel
+    once max_queued tasks are waiting, submit blocks until one starts
+    without start_background_task nothing runs on its own, and the owner
+    drives it with run_pending (handy for tests)
+    """
+    def __init__(self, size=4, max_queued=1000, start_background_task=None, clock=time.monotonic):
+        self.size = size
+        self.max_queued = max_queued
+        self.start_background_task = start_background_task
+        self.clock = clock
+        # key -> deque of (func, args, submitted at), for keys with work
+        self._tasks = {}
+        # keys with work and nobody running them, in turn order
+        self._ready = deque()
+        self._queued = 0
+        self._workers = 0
+        self._condition = threading.Condition()
+        # metrics
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run = 0.0
+        self.max_run = 0.0
+
+    def __len__(self):
+        return self._queued
+
+    def submit(self, key, func, *args):
+        """
+        queue func(*args) behind anything else submitted with key
+        """
+        with self._condition:
+            if self.start_background_task:
+                while self._queued >= self.max_queued:
+                    self._condition.wait()
+            tasks = self._tasks.get(key, None)
+            if tasks is None:
+                tasks = self._tasks[key] = deque()
+                self._ready.append(key)
+            tasks.append((func, args, self.clock()))
+            self._queued += 1
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, self._queued)
+            start = bool(self.start_background_task) and self._workers < self.size
+            if start:
+                self._workers += 1
+        if start:
+            self.start_background_task(self._work)
+        elif not self.start_background_task and self._queued > self.max_queued:
+            # nobody else will make room
+            self.run_pending()
+
+    def run_pending(self):
+        """
+        run everything queued in the calling thread, returns how many ran
+        """
+        ran = 0
+        while True:
+            with self._condition:
+                task = self._next()
+            if task is None:
+                return ran
+            self._run(*task)
+            ran += 1
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'queued': self._queued,
+            'max_depth': self.max_depth,
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'avg_wait': self.total_wait / self.completed if self.completed else 0.0,
+            'max_wait': self.max_wait,
+            'avg_run': self.total_run / self.completed if self.completed else 0.0,
+            'max_run': self.max_run,
+        }
+
+    def _next(self):
+        # called with the condition held
+        if not self._ready:
+            return None
+        key = self._ready.popleft()
+        func, args, submitted = self._tasks[key].popleft()
+        self._queued -= 1
+        self._condition.notify()
+        return (key, func, args, submitted)
+
+    def _run(self, key, func, args, submitted):
+        started = self.clock()
+        try:
+            func(*args)
+        except Exception:
+            # one bad task must not take down the worker
+            logger.exception('task %r failed', func)
+            self.failed += 1
+        finished = self.clock()
+        with self._condition:
+            self.completed += 1
+            wait = started - submitted
+            run = finished - started
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.total_run += run
+            self.max_run = max(self.max_run, run)
+            # the key's next task waits its turn behind the other keys
+            if self._tasks[key]:
+                self._ready.append(key)
+            else:
+                del self._tasks[key]
+
+    def _work(self):
+        while True:
+            with self._condition:
+                task = self._next()
+                if task is None:
+                    self._workers -= 1
+                    return
+            self._run(*task)
+
+
+class ExecutorPubSub(object):
+    """
+    wraps a pubsub engine so that the handler of every subscription, which
+    runs the resolvers and then our callback, is executed on an Executor
+    each handler is its own key, so a subscription sees its payloads in
+    publish order
+    """
+    def __init__(self, pubsub, executor):
+        self.pubsub = pubsub
+        self.executor = executor
+        # pubsub sub id -> handler
+        self.handlers = {}
+
+    def __getattr__(self, name):
+        # anything else is the wrapped engine's business
+        return getattr(self.pubsub, name)
+
+    def publish(self, trigger_name, payload):
+        return self.pubsub.publish(trigger_name, payload)
+
+    def subscribe(self, trigger_name, on_message, **options):
+        handler = PooledHandler(self.executor, on_message)
+        sub_id = self.pubsub.subscribe(trigger_name, handler, **options)
+        self.handlers[sub_id] = handler
+        return sub_id
+
+    def unsubscribe(self, sub_id):
+        handler = self.handlers.pop(sub_id, None)
+        if handler is not None:
+            # payloads still queued for it are skipped
+            handler.active = False
+        self.pubsub.unsubscribe(sub_id)
+
+
+class PooledHandler(object):
+    """
+    stands in for a subscription's on_message, queueing each payload
+    """
+    __slots__ = ('executor', 'on_message', 'active')
+
+    def __init__(self, executor, on_message):
+        self.executor = executor
+        self.on_message = on_message
+        self.active = True
+
+    def __call__(self, root_value):
+        self.executor.submit(self, self.run, root_value)
+
+    def run(self, root_value):
+        if self.active:
+            self.on_message(root_value)
@@ -4,8 +4,10 @@
 
 # the websocket plugin we are using
 from flask_socketio import SocketIO
-from flask import request
+from flask import request, has_request_context
 import json
+import logging
+from functools import partial
 
 from .message_types import (
     SUBSCRIPTION_MESSAGE,
@@ -18,8 +20,57 @@ from .message_types import (
     INIT,
     INIT_FAIL,
     INIT_SUCCESS,
+    BATCH,
+    ENVELOPE_STRING,
+    ENVELOPE_OBJECT,
+    OVERFLOW_DROP_OLDEST,
+    OVERFLOW_DROP_NEWEST,
+    OVERFLOW_DISCONNECT,
     PARAMS_MUST_BE_OBJECT,
+    SLOW_CONSUMER,
+    PERSISTED_QUERY_NOT_FOUND,
+    TOO_MANY_SUBSCRIPTIONS,
+    SERVER_AT_CAPACITY,
+    RATE_LIMITED,
+    SUBSCRIPTION_BATCH,
+    SUBSCRIPTION_BATCH_RESULT,
+    BATCH_PAYLOAD_MUST_BE_LIST,
+    SUBSCRIPTION_PATCH,
+    PROTOCOL_MSGPACK,
+    CLOSE_NORMAL,
 )
+from .shared_subscriptions import SharedSubscription, subscription_key
+from .codec import make_codec
+from .scheduler import Scheduler
+from .conflation import Conflator
+from .connection import Connection
+from .token_bucket import TokenBucket
+from .sessions import Session
+from .delta import DeltaState, diff
+from .compression import make_compressors, choose_compressor
+from .msgpack_protocol import MsgpackProtocol
+from .protocols import HANDLE, SEND, make_protocols, choose_protocol
+from .broker import BROKER_PUBLISH, BROKER_EMIT
+from .executor import Executor, ExecutorPubSub
+from .instrumentation import (
+    TIMING_HANDLE_MESSAGE,
+    TIMING_DECODE,
+    TIMING_PARSE_CONTEXT,
+    TIMING_SUBSCRIBE,
+    TIMING_EMIT,
+)
+
+# everything in a SUBSCRIPTION_DATA frame that comes before the id
+SUBSCRIPTION_DATA_PREFIX = '{"type": %s, "id": ' % json.dumps(SUBSCRIPTION_DATA)
+SUBSCRIPTION_PATCH_PREFIX = '{"type": %s, "id": ' % json.dumps(SUBSCRIPTION_PATCH)
+FRAME_PREFIXES = {
+    SUBSCRIPTION_DATA: SUBSCRIPTION_DATA_PREFIX,
+    SUBSCRIPTION_PATCH: SUBSCRIPTION_PATCH_PREFIX,
+}
+logger = logging.getLogger(__name__)
+
+# a BATCH frame around a comma separated list of encoded messages
+BATCH_TEMPLATE = '{"type": %s, "payload": [%%s]}' % json.dumps(BATCH)
 
 class SubscriptionServer(object):
     def __init__(self,
@@ -31,23 +82,215 @@ class SubscriptionServer(object):
                  on_connect=None,
                  on_disconnect=None,
                  parse_context=None,
+                 context_per_connection=False,
+                 lifecycle_messages=True,
+                 share_subscriptions=False,
+                 context_key=None,
+                 codec=None,
+                 envelope=ENVELOPE_STRING,
+                 conflate_interval=None,
+                 batch_window=None,
+                 batch_size=20,
+                 max_queued_frames=None,
+                 overflow_policy=OVERFLOW_DROP_OLDEST,
+                 max_transport_backlog=64,
+                 drain_interval=0.05,
+                 keepalive_interval=None,
+                 document_cache_size=None,
+                 query_store=None,
+                 broker=None,
+                 executor_size=None,
+                 executor_queue=1000,
+                 instrumentation=None,
+                 max_subscriptions_per_connection=None,
+                 max_subscriptions=None,
+                 rate_limit=None,
+                 rate_burst=None,
+                 replay_buffer_size=None,
+                 session_ttl=60,
+                 delta_threshold=None,
+                 delta_snapshot_interval=50,
+                 compression=None,
+                 compression_threshold=1024,
+                 msgpack=False,
+                 protocols=None,
                  **socket_options):
 
         # initialize
         self.subscription_manager = subscription_manager
+        # an Instrumentation to report counts and timings to, None for none
+        self.instrumentation = instrumentation
+        # session id -> Connection
+        self.connections = {}
+        # two-level registry: session id -> {client sub_id -> manager sub_id}
         self.connection_subscriptions = {}
+        # client subscriptions across every connection
+        self.subscription_count = 0
+        # identical subscriptions can share one subscription_manager subscription
+        self.share_subscriptions = share_subscriptions
+        self.context_key = context_key
+        # subscription key -> SharedSubscription
+        self.shared_subscriptions = {}
+        # manager sub id -> SharedSubscription
+        self.shared_by_id = {}
         self.namespace = namespace
+        # loads / dumps used for every message in and out
+        self.codec = make_codec(codec)
+        # ENVELOPE_STRING: {'data': '<json text>'}, the default
+        # ENVELOPE_OBJECT: the message itself, encoded once by Socket.IO
+        if envelope not in (ENVELOPE_STRING, ENVELOPE_OBJECT):
+            raise ValueError('Unknown envelope: %s' % envelope)
+        self.envelope = envelope
         # hooks
         self.on_subscribe = on_subscribe
         self.on_unsubscribe = on_unsubscribe
         self.on_connect = on_connect
         self.on_disconnect = on_disconnect
         self.parse_context = parse_context
+        # call parse_context(request, init_payload) once per socket at INIT,
+        # instead of parse_context(request) for every SUBSCRIPTION_START
+        self.context_per_connection = context_per_connection
+        # whether to tell a client about its own connect / disconnect
+        self.lifecycle_messages = lifecycle_messages
 
         # initialize websocket, and init with our app
-        self.socketio = SocketIO()
+        # socket_options go to Flask-SocketIO, e.g. message_queue
+        self.init_transport(app, socket_options)
+
+        # admission control, checked before any expensive work
+        # caps on subscriptions per connection and per server, and a token
+        # bucket of rate_limit messages a second, up to rate_burst at once
+        self.max_subscriptions_per_connection = max_subscriptions_per_connection
+        self.max_subscriptions = max_subscriptions
+        self.rate_limit = rate_limit
+        self.rate_burst = rate_burst or rate_limit
+        # counters
+        self.rate_limited_messages = 0
+        self.rejected_connection_cap = 0
+        self.rejected_server_cap = 0
+
+        # resumable sessions, off unless replay_buffer_size is set
+        # the last replay_buffer_size payloads of every subscription are
+        # kept, and a disconnected client's subscriptions stay up for
+        # session_ttl seconds waiting for it to come back
+        self.replay_buffer_size = replay_buffer_size
+        self.session_ttl = session_ttl
+        # token -> Session
+        self.sessions = {}
+        # sid the subscriptions are registered under -> Session
+        self.sid_sessions = {}
+        # sid a subscription started on -> sid it lives on after resuming
+        self.sid_routes = {}
+        # counters
+        self.resumed_sessions = 0
+        self.expired_sessions = 0
+
+        # delta delivery, off unless delta_threshold is set
+        # clients that ask for it at INIT get a SUBSCRIPTION_PATCH against
+        # the previous result instead of results of delta_threshold encoded
+        # characters or more, with a full result every delta_snapshot_interval
+        # patches to resync
+        self.delta_threshold = delta_threshold
+        self.delta_snapshot_interval = delta_snapshot_interval
+        # (request_id, sub_id) -> DeltaState
+        self.delta_states = {}
+        # counters
+        self.delta_patches = 0
+        self.delta_chars_saved = 0
+
+        # payload compression, off unless compression names what to offer
+        # clients pick a scheme at INIT, then payloads of compression_threshold
+        # encoded characters or more go out compressed, as a binary attachment
+        self.compressors = make_compressors(compression)
+        self.compression_threshold = compression_threshold
+        # counters
+        self.compressed_payloads = 0
+        self.compression_bytes_saved = 0
+
+        # MessagePack frames for clients that ask for them at INIT, needs the
+        # msgpack package
+        self.packer = MsgpackProtocol() if msgpack else None
+
+        # wire protocols offered, in order of preference, the legacy one
+        # alone by default; each connection picks one when it connects
+        self.protocols = make_protocols(protocols)
+        # whether any connection can need translating
+        self.translating = any(protocol.translates for protocol in self.protocols.values())
+
+        # every timer on the server shares this one heap
+        self.scheduler = Scheduler(self.start_background_task)
+
+        # latest-value-only delivery, seconds between frames per subscription
+        # on_subscribe can override it with base_params['conflate_interval']
+        self.conflate_interval = conflate_interval
+        # (request_id, sub_id) -> interval, for conflated subscriptions only
+        self.conflate_intervals = {}
+        self.conflator = Conflator(self.scheduler, self.send_subscription_data)
+
+        # clients that ask for it at INIT get their frames in BATCH messages,
+        # gathered for batch_window seconds or until batch_size frames
+        # None turns batching off, 0 batches whatever is sent in one go
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+
+        # bounded per-connection send queues, None leaves them unbounded
+        # frames wait in the queue while engine.io already holds
+        # max_transport_backlog packets for the client, and are retried
+        # every drain_interval seconds
+        if overflow_policy not in (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_DISCONNECT):
+            raise ValueError('Unknown overflow policy: %s' % overflow_policy)
+        self.max_queued_frames = max_queued_frames
+        self.overflow_policy = overflow_policy
+        self.max_transport_backlog = max_transport_backlog
+        self.drain_interval = drain_interval
+        # counters
+        self.dropped_frames = 0
+        self.evicted_connections = 0
+
+        # KEEPALIVE to connections that have been quiet for keepalive_interval
+        # seconds, checked by a single sweep timer for all connections
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_timer = None
+
+        # LRU of parsed and validated documents, documents that fail
+        # validation are rejected without reaching the subscription_manager
+        self.document_cache = None
+        if document_cache_size:
+            # graphql comes with the subscription_manager, not with us
+            from .document_cache import DocumentCache
+            self.document_cache = DocumentCache(subscription_manager.schema, document_cache_size)
+
+        # persisted queries, SUBSCRIPTION_START can send a query_id instead
+        # of the query; every stored query is validated up front
+        self.query_store = query_store
+        if query_store is not None:
+            self.validate_query_store()
+
+        # multi-process mode: publishes go to every worker through the
+        # broker, and each subscription lives on the worker that owns its
+        # socket, so emits for other sockets are forwarded to their owner
+        self.broker = broker
+        if broker is not None:
+            self.start_background_task(self.listen_broker)
+
+        # run each subscription's resolvers and callback on a bounded pool
+        # instead of inside publish, by wrapping the manager's pubsub
+        self.executor = None
+        if executor_size:
+            self.executor = Executor(executor_size, executor_queue, self.start_background_task)
+            subscription_manager.pubsub = ExecutorPubSub(subscription_manager.pubsub, self.executor)
+
+        self.register_handlers()
+
+    ###
+    # the transport, override these to serve over something other than
+    # Flask-SocketIO
+    ###
+    def init_transport(self, app, socket_options):
+        self.socketio = SocketIO(**socket_options)
         self.socketio.init_app(app)
 
+    def register_handlers(self):
         # connect
         self.socketio.on_event('connect', self.socket_connect, namespace=self.namespace)
 
@@ -57,20 +300,371 @@ class SubscriptionServer(object):
         # run on a message
         self.socketio.on_event('message', self.on_message, namespace=self.namespace)
 
+    def start_background_task(self, target, *args):
+        return self.socketio.start_background_task(target, *args)
+
+    def current_sid(self):
+        """
+        session id of the socket we are handling, None outside of an event
+        """
+        if has_request_context():
+            return getattr(request, 'sid', None)
+        return None
+
+    def current_request(self):
+        """
+        what parse_context gets to look at, the Flask request
+        """
+        return request
+
+    def socket_server(self):
+        """
+        the python-socketio server underneath
+        """
+        return self.socketio.server
+
+    def emit(self, event, frame, request_id):
+        self.socketio.emit(event, frame, namespace=self.namespace, room=request_id)
+
+    def disconnect_client(self, request_id):
+        self.socketio.server.disconnect(request_id, namespace=self.namespace)
+
+    def close_client(self, request_id, code=CLOSE_NORMAL, reason=''):
+        """
+        close a connection with a websocket close code, Socket.IO has no
+        way to send one so it just disconnects
+        """
+        self.disconnect_client(request_id)
+
+    def requested_protocols(self, auth):
+        """
+        the protocol names a client asked for, from its Socket.IO auth data
+        """
+        if isinstance(auth, dict):
+            return auth.get('protocol', None)
+        return None
+
+    def validate_query_store(self):
+        """
+        check every persisted query against the schema, raising on any
+        invalid ones so a bad allowlist fails at boot
+        warms the document cache on the way
+        """
+        if self.document_cache is not None:
+            load = self.document_cache.get
+        else:
+            from .document_cache import DocumentCache
+            load = DocumentCache(self.subscription_manager.schema).load
+        invalid = [query_id for query_id, query in self.query_store if load(query).errors]
+        if invalid:
+            raise ValueError('Invalid persisted queries: %s' % ', '.join(sorted(invalid)))
+
+    def publish(self, trigger_name, payload):
+        """
+        publish to subscribers on every worker, use this instead of
+        subscription_manager.publish when running with a broker
+        """
+        if self.broker is None:
+            return self.subscription_manager.publish(trigger_name, payload)
+        self.broker.publish({
+            'kind': BROKER_PUBLISH,
+            'worker': self.broker.worker_id,
+            'trigger': trigger_name,
+            'payload': payload,
+        })
+
+    def owns(self, request_id):
+        """
+        whether the socket, and so its subscriptions, lives on this worker
+        """
+        return request_id in self.connections
+
+    def listen_broker(self):
+        """
+        background task handling broker messages until the broker closes
+        """
+        for message in self.broker.listen():
+            try:
+                self.handle_broker_message(message)
+            except Exception:
+                # one bad message must not stop the listener
+                logger.exception('failed to handle broker message %r', message.get('kind', None))
+
+    def handle_broker_message(self, message):
+        if message['kind'] == BROKER_PUBLISH:
+            # every worker runs the publish for its own subscriptions
+            self.subscription_manager.publish(message['trigger'], message['payload'])
+        elif message['kind'] == BROKER_EMIT:
+            # only the owner can reach the socket
+            if self.owns(message['sid']):
+                self.send_message(message['message'], message['sid'])
+
     # to run on connection
-    def socket_connect(self):
+    def socket_connect(self, auth=None):
+        request_id = self.current_sid()
+        protocol = choose_protocol(self.protocols, self.requested_protocols(auth))
+        if protocol is None:
+            # nothing we both speak, refuse the connection
+            return False
+        if request_id is not None:
+            connection = self.get_connection(request_id)
+            if protocol.translates:
+                connection.protocol = protocol(self.codec)
+            self.schedule_keepalive()
         if self.on_connect:
             self.on_connect()
-        self.socketio.emit('message', {'data': 'connected'}, namespace=self.namespace)
+        self.send_lifecycle_message('connected', request_id)
 
     # to run on disconnect
     def socket_disconnect(self):
         """
         cleans up all of the existing subscriptions
         """
+        request_id = self.current_sid()
+        if request_id is not None:
+            session = self.sid_sessions.get(request_id, None)
+            if session is not None:
+                # keep the subscriptions for the client to resume
+                self.detach_session(session)
+            else:
+                self.unsubscribe_connection(request_id)
+            self.drop_connection(request_id)
         if self.on_disconnect:
             self.on_disconnect()
-        self.socketio.emit('message', {'data': 'disconnected'}, namespace=self.namespace)
+        self.send_lifecycle_message('disconnected', request_id)
+
+    def open_session(self, request_id, token=None, last_seen=0):
+        """
+        start a session for a socket at INIT, or resume the one token names
+        returns the fields for INIT_SUCCESS and the frames to replay
+        """
+        session = self.sid_sessions.get(request_id, None)
+        if session is not None:
+            # INIT again on the same socket
+            return {'session': session.token}, []
+        session = self.sessions.get(token, None) if token else None
+        if session is None:
+            session = Session(request_id, self.replay_buffer_size)
+            self.sessions[session.token] = session
+            self.sid_sessions[request_id] = session
+            fields = {'session': session.token}
+            if token:
+                # expired or never existed, the client starts over
+                fields['resumed'] = False
+            return fields, []
+
+        if session.expiry_timer is not None:
+            session.expiry_timer.cancel()
+            session.expiry_timer = None
+        self.sid_sessions.pop(session.request_id, None)
+        self.move_subscriptions(session.request_id, request_id)
+        session.request_id = request_id
+        session.attached = True
+        self.sid_sessions[request_id] = session
+        self.resumed_sessions += 1
+        frames, stale = session.missed(last_seen or 0)
+        # stale subscriptions lost frames, the client should restart them
+        return {'session': session.token, 'resumed': True, 'stale': stale}, frames
+
+    def detach_session(self, session):
+        session.attached = False
+        session.expiry_timer = self.scheduler.call_later(self.session_ttl, self.expire_session, session)
+
+    def expire_session(self, session):
+        """
+        the client never came back, tear its subscriptions down
+        """
+        session.expiry_timer = None
+        if session.attached or self.sessions.get(session.token, None) is not session:
+            return
+        self.expired_sessions += 1
+        request_id = session.request_id
+        self.sessions.pop(session.token, None)
+        self.sid_sessions.pop(request_id, None)
+        self.unsubscribe_connection(request_id)
+        # routes that led to this sid lead nowhere now
+        for sid, target in list(self.sid_routes.items()):
+            if target == request_id:
+                del self.sid_routes[sid]
+
+    def move_subscriptions(self, old_sid, new_sid):
+        """
+        hand every subscription registered under old_sid over to new_sid
+        """
+        # unshared callbacks still name the sid they started on
+        for sid, target in list(self.sid_routes.items()):
+            if target == old_sid:
+                self.sid_routes[sid] = new_sid
+        self.sid_routes[old_sid] = new_sid
+        subscriptions = self.connection_subscriptions.pop(old_sid, None)
+        if not subscriptions:
+            return
+        # ids the new socket already started before its INIT give way to
+        # the session's, or nothing would ever unsubscribe them
+        for sub_id in list(self.connection_subscriptions.get(new_sid, {})):
+            if sub_id in subscriptions:
+                self.end_subscription(new_sid, sub_id)
+        for sub_id, graphql_sub_id in subscriptions.items():
+            interval = self.conflate_intervals.get((old_sid, sub_id), None)
+            self.forget_conflation(old_sid, sub_id)
+            self.set_conflation(new_sid, sub_id, interval)
+            state = self.delta_states.pop((old_sid, sub_id), None)
+            if state is not None:
+                self.delta_states[(new_sid, sub_id)] = state
+            shared = self.shared_by_id.get(graphql_sub_id, None)
+            if shared is not None:
+                shared.remove(old_sid, sub_id)
+                shared.add(new_sid, sub_id)
+        self.connection_subscriptions.setdefault(new_sid, {}).update(subscriptions)
+
+    def sequence(self, request_id, sub_id, payload):
+        """
+        keep a payload in the socket's session, if it has one
+        returns its sequence number, and whether to send it now
+        """
+        session = self.sid_sessions.get(request_id, None)
+        if session is None:
+            return None, True
+        return session.record(sub_id, payload), session.attached
+
+    def replay(self, request_id, frames):
+        """
+        resend what a resumed client missed, as (seq, sub_id, (type, payload))
+        """
+        packer = self.client_packer(request_id) if self.packer is not None else None
+        for seq, sub_id, (message_type, payload) in frames:
+            if packer is not None:
+                if isinstance(payload, str):
+                    payload = self.codec.loads(payload)
+                self.send_packed_data(sub_id, message_type, payload, seq, request_id)
+            elif self.envelope == ENVELOPE_OBJECT:
+                self.send_object_data(sub_id, message_type, payload, seq, request_id)
+            else:
+                self.send_encoded_data(sub_id, message_type, payload, seq, request_id)
+
+    def get_connection(self, request_id):
+        """
+        the Connection for a session id, created if we missed the connect
+        """
+        connection = self.connections.get(request_id, None)
+        if connection is None:
+            connection = self.connections[request_id] = Connection(request_id, self.scheduler.clock())
+            if self.instrumentation is not None:
+                self.instrumentation.connection_opened()
+        return connection
+
+    def drop_connection(self, request_id):
+        """
+        forget all per-socket state, anything still queued is discarded
+        """
+        connection = self.connections.pop(request_id, None)
+        if connection is None:
+            return
+        if self.instrumentation is not None:
+            self.instrumentation.connection_closed()
+        with connection.lock:
+            for timer in (connection.batch_timer, connection.drain_timer):
+                if timer is not None:
+                    timer.cancel()
+            connection.outbox.clear()
+
+    def connection_context(self, request_id):
+        """
+        the cached parse_context result for a socket, computed on first use
+        for clients that start subscriptions without an INIT
+        """
+        connection = self.get_connection(request_id)
+        if not connection.context_ready:
+            connection.context = self.timed(TIMING_PARSE_CONTEXT,
+                                            self.parse_context,
+                                            self.current_request(),
+                                            connection.init_payload)
+            connection.context_ready = True
+        return connection.context
+
+    def allow_message(self, request_id, parsed_message):
+        """
+        admission control, returns the reason to reject a message or None
+        """
+        message_type = parsed_message.get('type', None)
+        # ending subscriptions only frees resources, never hold it back
+        if message_type == SUBSCRIPTION_END:
+            return None
+        rejected = self.take_token(request_id)
+        if rejected is not None or message_type != SUBSCRIPTION_START:
+            return rejected
+        return self.admit_subscription(request_id, parsed_message)
+
+    def take_token(self, request_id):
+        """
+        charge one message to the connection's rate limit, returns the
+        reason to reject it or None
+        """
+        if not self.rate_limit:
+            return None
+        connection = self.get_connection(request_id)
+        now = self.scheduler.clock()
+        if connection.bucket is None:
+            connection.bucket = TokenBucket(self.rate_limit, self.rate_burst, now)
+        if not connection.bucket.take(now):
+            self.rate_limited_messages += 1
+            return RATE_LIMITED
+        return None
+
+    def admit_subscription(self, request_id, parsed_message):
+        """
+        check a SUBSCRIPTION_START against the subscription caps
+        """
+        subscriptions = self.connection_subscriptions.get(request_id, {})
+        # restarting an id replaces the subscription, it doesn't add one
+        if parsed_message.get('id', None) in subscriptions:
+            return None
+        if self.max_subscriptions_per_connection is not None and \
+                len(subscriptions) >= self.max_subscriptions_per_connection:
+            self.rejected_connection_cap += 1
+            return TOO_MANY_SUBSCRIPTIONS
+        if self.max_subscriptions is not None and self.subscription_count >= self.max_subscriptions:
+            self.rejected_server_cap += 1
+            return SERVER_AT_CAPACITY
+        return None
+
+    def invalidate_context(self, request_id):
+        """
+        forget a socket's cached context, e.g. after its credentials change
+        the next SUBSCRIPTION_START computes it again
+        """
+        connection = self.connections.get(request_id, None)
+        if connection is not None:
+            connection.context = None
+            connection.context_ready = False
+
+    def schedule_keepalive(self):
+        if self.keepalive_interval and self.keepalive_timer is None:
+            # sweep twice per interval so nobody goes much over it
+            self.keepalive_timer = self.scheduler.call_later(self.keepalive_interval / 2.0,
+                                                             self.send_keepalives)
+
+    def send_keepalives(self):
+        """
+        one pass over every connection, sending KEEPALIVE to the quiet ones
+        """
+        self.keepalive_timer = None
+        idle_since = self.scheduler.clock() - self.keepalive_interval
+        for connection in list(self.connections.values()):
+            if connection.last_activity <= idle_since:
+                self.send_message({'type': KEEPALIVE}, connection.request_id)
+        # nothing to keep alive, let the scheduler go idle
+        if self.connections:
+            self.schedule_keepalive()
+
+    def touch(self, request_id):
+        """
+        note activity on a connection, which postpones its next KEEPALIVE
+        """
+        if self.keepalive_interval:
+            connection = self.connections.get(request_id, None)
+            if connection is not None:
+                connection.last_activity = self.scheduler.clock()
 
     def unsubscribe(self, sub_id):
         # delegate to our subscription_manager
@@ -79,31 +673,214 @@ class SubscriptionServer(object):
         if self.on_unsubscribe:
             self.on_unsubscribe(sub_id)
 
+    def unsubscribe_many(self, sub_ids):
+        """
+        bulk unsubscribe a list of subscription_manager sub ids
+        uses the manager's own unsubscribe_many if it exposes one
+        """
+        bulk_unsubscribe = getattr(self.subscription_manager, 'unsubscribe_many', None)
+        if bulk_unsubscribe:
+            bulk_unsubscribe(sub_ids)
+        else:
+            for sub_id in sub_ids:
+                try:
+                    self.subscription_manager.unsubscribe(sub_id)
+                except KeyError:
+                    # already gone
+                    pass
+                except Exception:
+                    # keep tearing down the rest
+                    logger.exception('failed to unsubscribe %r', sub_id)
+        if self.on_unsubscribe:
+            for sub_id in sub_ids:
+                self.on_unsubscribe(sub_id)
+
+    def unsubscribe_connection(self, request_id):
+        """
+        tears down every subscription owned by a session id in one pass
+        """
+        subscriptions = self.connection_subscriptions.pop(request_id, None)
+        if not subscriptions:
+            return
+        self.subscription_count -= len(subscriptions)
+        if self.instrumentation is not None:
+            self.instrumentation.subscriptions_ended(len(subscriptions))
+        for sub_id in subscriptions:
+            self.forget_conflation(request_id, sub_id)
+        # shared subscriptions other clients still listen to stay up
+        graphql_sub_ids = [graphql_sub_id for sub_id, graphql_sub_id in subscriptions.items()
+                           if self.release_shared(request_id, sub_id, graphql_sub_id)]
+        if graphql_sub_ids:
+            self.unsubscribe_many(graphql_sub_ids)
+
+    def end_subscription(self, request_id, sub_id):
+        """
+        stop a client's subscription, only unsubscribing from the
+        subscription_manager once nobody else shares it
+        """
+        graphql_sub_id = self.remove_subscription(request_id, sub_id)
+        if graphql_sub_id is None:
+            return
+        if self.release_shared(request_id, sub_id, graphql_sub_id):
+            self.unsubscribe(graphql_sub_id)
+
+    def set_conflation(self, request_id, sub_id, interval):
+        if interval:
+            self.conflate_intervals[(request_id, sub_id)] = interval
+
+    def forget_conflation(self, request_id, sub_id):
+        if self.conflate_intervals.pop((request_id, sub_id), None):
+            self.conflator.discard(request_id, sub_id)
+
+    def release_shared(self, request_id, sub_id, graphql_sub_id):
+        """
+        drop a subscriber from a shared subscription
+        returns True when the manager subscription should be unsubscribed
+        """
+        shared = self.shared_by_id.get(graphql_sub_id, None)
+        if shared is None:
+            return True
+        if not shared.remove(request_id, sub_id):
+            return False
+        self.shared_subscriptions.pop(shared.key, None)
+        self.shared_by_id.pop(graphql_sub_id, None)
+        return True
+
+    def get_subscription(self, request_id, sub_id):
+        """
+        look up the subscription_manager sub id for a client sub id
+        """
+        return self.connection_subscriptions.get(request_id, {}).get(sub_id, None)
+
+    def add_subscription(self, request_id, sub_id, graphql_sub_id):
+        self.connection_subscriptions.setdefault(request_id, {})[sub_id] = graphql_sub_id
+        self.subscription_count += 1
+        if self.delta_threshold is not None:
+            connection = self.connections.get(request_id, None)
+            if connection is not None and connection.delta:
+                self.delta_states[(request_id, sub_id)] = DeltaState()
+        if self.instrumentation is not None:
+            self.instrumentation.subscriptions_started()
+
+    def remove_subscription(self, request_id, sub_id):
+        """
+        drop a client sub id from the registry, returning the manager sub id
+        """
+        subscriptions = self.connection_subscriptions.get(request_id, None)
+        if not subscriptions:
+            return None
+        graphql_sub_id = subscriptions.pop(sub_id, None)
+        if graphql_sub_id is not None:
+            self.subscription_count -= 1
+            session = self.sid_sessions.get(request_id, None)
+            if session is not None:
+                session.forget(sub_id)
+            if self.instrumentation is not None:
+                self.instrumentation.subscriptions_ended()
+        self.forget_conflation(request_id, sub_id)
+        if self.delta_states:
+            self.delta_states.pop((request_id, sub_id), None)
+        # don't keep empty connection entries around
+        if not subscriptions:
+            self.connection_subscriptions.pop(request_id)
+        return graphql_sub_id
+
+    def timed(self, name, func, *args, **kwargs):
+        """
+        call func, reporting how long it took when instrumented
+        """
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            return func(*args, **kwargs)
+        started = instrumentation.clock()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            instrumentation.timing(name, instrumentation.clock() - started)
+
+    def metrics_snapshot(self):
+        """
+        everything we count, as plain data, e.g. to return from a Flask route
+        """
+        snapshot = {
+            'connections': len(self.connections),
+            'subscriptions': self.subscription_count,
+            'shared_subscriptions': len(self.shared_subscriptions),
+            'dropped_frames': self.dropped_frames,
+            'evicted_connections': self.evicted_connections,
+            'rate_limited_messages': self.rate_limited_messages,
+            'rejected_connection_cap': self.rejected_connection_cap,
+            'rejected_server_cap': self.rejected_server_cap,
+            'sessions': len(self.sessions),
+            'resumed_sessions': self.resumed_sessions,
+            'expired_sessions': self.expired_sessions,
+            'delta_patches': self.delta_patches,
+            'delta_chars_saved': self.delta_chars_saved,
+            'compressed_payloads': self.compressed_payloads,
+            'compression_bytes_saved': self.compression_bytes_saved,
+            'conflated': self.conflator.conflated,
+            'scheduled_timers': len(self.scheduler),
+            'document_cache': self.document_cache.stats() if self.document_cache is not None else None,
+            'executor': self.executor.stats() if self.executor is not None else None,
+        }
+        if self.instrumentation is not None:
+            snapshot['instrumentation'] = self.instrumentation.snapshot()
+        return snapshot
+
     def on_message(self, message):
         """
         executes on message receipt
-        handles the several reasons we would get a message:
-        - INIT
-        - SUBSCRIPTION_START
-        - SUBSCRIPTION_END
+        """
+        return self.timed(TIMING_HANDLE_MESSAGE, self.handle_message, message)
+
+    def handle_message(self, message):
+        """
+        decode a message and hand it to the connection's protocol, or
+        straight to handle_parsed for the legacy protocol
         """
 
         # closure over request.sid
-        request_id = request.sid
+        request_id = self.current_sid()
+        self.touch(request_id)
 
         # first parse our message
         try:
-            parsed_message = json.loads(message)
+            if self.envelope == ENVELOPE_OBJECT and isinstance(message, dict):
+                # already decoded by Socket.IO
+                parsed_message = message
+            elif isinstance(message, bytes) and self.packer is not None:
+                parsed_message = self.timed(TIMING_DECODE, self.packer.loads, message)
+            else:
+                parsed_message = self.timed(TIMING_DECODE, self.codec.loads, message)
         except Exception as e:
             # send failure
             self.send_subscription_fail(None, {'errors': e}, request_id)
             return
 
+        if self.translating:
+            protocol = self.client_protocol(request_id)
+            if protocol is not None:
+                self.perform(request_id, protocol.receive(parsed_message))
+                return
+        self.handle_parsed(request_id, parsed_message)
+
+    def handle_parsed(self, request_id, parsed_message):
+        """
+        handles a legacy protocol message, which is what every protocol
+        translates to, for the several reasons we would get one:
+        - INIT
+        - SUBSCRIPTION_START
+        - SUBSCRIPTION_BATCH
+        - SUBSCRIPTION_END
+        """
         sub_id = parsed_message.get('id', None)
-        unique_sub_id = None
-        # scope our subscription id here
-        if sub_id is not None:
-            unique_sub_id = str(request_id) + str(sub_id)
+        if self.instrumentation is not None:
+            self.instrumentation.message_in(parsed_message.get('type', None))
+
+        rejected = self.allow_message(request_id, parsed_message)
+        if rejected is not None:
+            self.send_subscription_fail(sub_id, {'errors': rejected}, request_id)
+            return
 
         # handle our different message types
 
@@ -119,7 +896,42 @@ class SubscriptionServer(object):
                 if not on_connect_context:
                     raise ValueError('Prohibited connection!')
 
-                self.send_init_result(INIT_SUCCESS, {}, request_id)
+                # a new INIT replaces whatever context we had
+                if self.parse_context and self.context_per_connection:
+                    self.invalidate_context(request_id)
+                    self.get_connection(request_id).init_payload = parsed_message.get('payload', None)
+                    self.connection_context(request_id)
+
+                result = {}
+                if parsed_message.get('batch', False) and self.batch_window is not None:
+                    result['batch'] = True
+                if parsed_message.get('delta', False) and self.delta_threshold is not None:
+                    # only subscriptions started from now on get patches
+                    result['delta'] = True
+                    self.get_connection(request_id).delta = True
+                if self.compressors and 'compression' in parsed_message:
+                    compressor = choose_compressor(self.compressors, parsed_message['compression'])
+                    if compressor is not None:
+                        result['compression'] = compressor.name
+                    # asking again without a match turns compression off
+                    self.get_connection(request_id).compressor = compressor
+                if parsed_message.get('msgpack', False) and self.packer is not None:
+                    result['msgpack'] = True
+                missed = []
+                # only legacy clients know how to resume
+                if self.replay_buffer_size and self.client_protocol(request_id) is None:
+                    fields, missed = self.open_session(request_id,
+                                                       parsed_message.get('session', None),
+                                                       parsed_message.get('last_seen', 0))
+                    result.update(fields)
+                self.send_init_result(INIT_SUCCESS, result, request_id)
+                # only start batching once the client knows about it
+                if result.get('batch', False):
+                    self.get_connection(request_id).batch = []
+                # INIT_SUCCESS went out in the old format, the rest in the new
+                if self.packer is not None:
+                    self.get_connection(request_id).packer = self.packer if result.get('msgpack', False) else None
+                self.replay(request_id, missed)
 
             except Exception as e:
                 self.send_init_result(INIT_FAIL, {'errors': e}, request_id)
@@ -128,133 +940,743 @@ class SubscriptionServer(object):
 
         # SUBSCRIPTION_START case
         elif parsed_message['type'] == SUBSCRIPTION_START:
-            try:
-                context = {}
-                # gain general context from request if specified
-                if self.parse_context:
-                    context = self.parse_context(request)
-
-                # query and variables required
-                base_params = {
-                     'query': parsed_message['query'],
-                     'variables': parsed_message['variables'],
-                     'operation_name': parsed_message.get('operation_name', None),
-                     'context': context,
-                     'format_response': None,
-                     'format_error': None,
-                     'callback': None,
-                }
-            except Exception as e:
-                self.send_subscription_fail(sub_id,
-                                            {'errors': repr(e)},
-                                            request_id)
+            errors = self.start_subscription(request_id, parsed_message)
+            if errors is None:
+                self.send_subscription_success(sub_id, request_id)
+            else:
+                self.send_subscription_fail(sub_id, errors, request_id)
+            return
+
+        # SUBSCRIPTION_BATCH case
+        elif parsed_message['type'] == SUBSCRIPTION_BATCH:
+            operations = parsed_message.get('payload', None)
+            if not isinstance(operations, list):
+                self.send_subscription_fail(None, {'errors': BATCH_PAYLOAD_MUST_BE_LIST}, request_id)
                 return
+            # one frame back, whatever the number of operations
+            self.send_message({
+                'type': SUBSCRIPTION_BATCH_RESULT,
+                'payload': self.run_operations(request_id, operations),
+            }, request_id)
+            return
 
-            try:
-                # option for custom on_subscribe
-                if self.on_subscribe:
-                    base_params = self.on_subscribe(parsed_message, base_params)
-
-                # if we already have a subscription with this id unsub first
-                # need a clever way to test this
-                if self.connection_subscriptions.get(unique_sub_id, None):
-                    self.unsubscribe(self.connection_subscriptions[unique_sub_id])
-                    self.connection_subscriptions.pop(unique_sub_id)
-
-                if not isinstance(base_params, dict):
-                    self.send_subscription_fail(sub_id,
-                                                {'errors': PARAMS_MUST_BE_OBJECT},
-                                                request_id)
-                    return
+        # SUBSCRIPTION_END case
+        elif parsed_message['type'] == SUBSCRIPTION_END:
+            # get the sub_id, unsub, delete it
+            if self.get_subscription(request_id, sub_id):
+                self.end_subscription(request_id, sub_id)
+            return
 
-                # create a callback for sending data
-                # error could be runtime or object with errors
-                # result is GraphQL ExecutionResult
+        # otherwise fail
+        else:
+            self.send_subscription_fail(sub_id, {'errors': 'Invalid message type'}, request_id)
+            return
+
+    def subscription_context(self, request_id):
+        """
+        the context for a new subscription, from parse_context if given
+        """
+        if not self.parse_context:
+            return {}
+        if self.context_per_connection:
+            return self.connection_context(request_id)
+        return self.timed(TIMING_PARSE_CONTEXT, self.parse_context, self.current_request())
+
+    def start_subscription(self, request_id, parsed_message, context=None):
+        """
+        set up the subscription a SUBSCRIPTION_START asks for
+        returns None on success, or the failure payload for the client
+        """
+        sub_id = parsed_message.get('id', None)
+
+        try:
+            # swap a persisted query id for the query it stands for
+            if self.query_store is not None and 'query' not in parsed_message and 'query_id' in parsed_message:
+                query = self.query_store.get(parsed_message['query_id'])
+                if query is None:
+                    # the client can retry with the full text
+                    return {'errors': PERSISTED_QUERY_NOT_FOUND}
+                parsed_message['query'] = query
+
+            # a batch works the context out once for all of its starts
+            if context is None:
+                context = self.subscription_context(request_id)
+
+            # query and variables required
+            base_params = {
+                 'query': parsed_message['query'],
+                 'variables': parsed_message['variables'],
+                 'operation_name': parsed_message.get('operation_name', None),
+                 'context': context,
+                 'format_response': None,
+                 'format_error': None,
+                 'callback': None,
+            }
+        except Exception as e:
+            return {'errors': repr(e)}
+
+        try:
+            # option for custom on_subscribe
+            if self.on_subscribe:
+                base_params = self.on_subscribe(parsed_message, base_params)
+
+            # if we already have a subscription with this id unsub first
+            # need a clever way to test this
+            if self.get_subscription(request_id, sub_id):
+                self.end_subscription(request_id, sub_id)
+
+            if not isinstance(base_params, dict):
+                return {'errors': PARAMS_MUST_BE_OBJECT}
+
+            # known bad documents never reach the subscription_manager
+            cached = None
+            if self.document_cache is not None:
+                cached = self.document_cache.get(base_params['query'])
+                if cached.errors:
+                    return {'errors': cached.errors}
+
+            # not a subscription_manager parameter
+            conflate_interval = base_params.pop('conflate_interval', self.conflate_interval)
+
+            shared = None
+            if self.share_subscriptions:
+                key = subscription_key(base_params, self.context_key)
+                if key is not None:
+                    shared = self.shared_subscriptions.get(key, None)
+                    # identical subscription already running, listen in on it
+                    if shared:
+                        shared.add(request_id, sub_id)
+                        self.add_subscription(request_id, sub_id, shared.graphql_sub_id)
+                        self.set_conflation(request_id, sub_id, conflate_interval)
+                        return None
+                    shared = SharedSubscription(key)
+                    shared.add(request_id, sub_id)
+
+            # create a callback for sending data
+            if shared:
+                base_params['callback'] = self.fan_out_callback(shared)
+            else:
                 def callback(error=None, result=None):
-                    if not error:
-                        self.send_subscription_data(sub_id, {'data': result.data}, request_id)
-                    elif isinstance(error, dict) and 'errors' in error:
-                        self.send_subscription_data(sub_id, {'errors': error['errors']}, request_id)
-                    else:
-                        # this is a runtime error
-                        self.send_subscription_fail(sub_id, {'errors': error}, request_id)
-
-                # set the callback
+                    # a resumed session moves its subscriptions to a new sid
+                    self.send_execution_result(sub_id,
+                                               self.sid_routes.get(request_id, request_id),
+                                               error,
+                                               result)
+
                 base_params['callback'] = callback
 
-                # get back the subscription id of the subscription_manager
-                graphql_sub_id = self.subscription_manager.subscribe(**base_params)
+            # get back the subscription id of the subscription_manager
+            subscribe = self.subscription_manager.subscribe
+            if cached is not None:
+                from .document_cache import takes_documents, subscribe_document
+                if takes_documents(self.subscription_manager):
+                    # the cached document, instead of parsing the text again
+                    subscribe = partial(subscribe_document, self.subscription_manager, cached.document)
+            graphql_sub_id = self.timed(TIMING_SUBSCRIBE, subscribe, **base_params)
 
-                # add subscription
-                self.connection_subscriptions[unique_sub_id] = graphql_sub_id
+            if shared:
+                shared.graphql_sub_id = graphql_sub_id
+                self.shared_subscriptions[shared.key] = shared
+                self.shared_by_id[graphql_sub_id] = shared
 
-                self.send_subscription_success(sub_id, request_id)
+            # add subscription
+            self.add_subscription(request_id, sub_id, graphql_sub_id)
+            self.set_conflation(request_id, sub_id, conflate_interval)
+            return None
 
-            # handle any errors
-            except Exception as e:
-                if isinstance(e, dict):
-                    # these are graphql errors
-                    self.send_subscription_fail(sub_id, {'errors': e['errors']}, request_id)
+        # handle any errors
+        except Exception as e:
+            if isinstance(e, dict):
+                # these are graphql errors
+                return {'errors': e['errors']}
+            # this is a runtime error
+            return {'errors': e}
+
+    def run_operations(self, request_id, operations):
+        """
+        apply the starts and ends of a SUBSCRIPTION_BATCH in order, returning
+        the SUBSCRIPTION_SUCCESS / SUBSCRIPTION_FAIL / SUBSCRIPTION_END
+        message each of them would have got on its own
+        """
+        results = []
+        # worked out at the first start, then shared by the rest
+        context = None
+        context_errors = None
+        # every start is charged to the rate limit, the frame's own token
+        # pays for the first
+        charged = False
+        for operation in operations:
+            if not isinstance(operation, dict):
+                results.append(self.subscription_fail_message(None, {'errors': 'Invalid message type'}))
+                continue
+            sub_id = operation.get('id', None)
+            operation_type = operation.get('type', None)
+            if operation_type == SUBSCRIPTION_START:
+                rejected = self.take_token(request_id) if charged else None
+                charged = True
+                if rejected is None:
+                    rejected = self.admit_subscription(request_id, operation)
+                errors = {'errors': rejected} if rejected is not None else context_errors
+                if errors is None and context is None:
+                    try:
+                        context = self.subscription_context(request_id)
+                    except Exception as e:
+                        errors = context_errors = {'errors': repr(e)}
+                if errors is None:
+                    errors = self.start_subscription(request_id, operation, context)
+                if errors is None:
+                    results.append(self.subscription_success_message(sub_id))
                 else:
-                    # this is a runtime error
-                    self.send_subscription_fail(sub_id, {'errors': e}, request_id)
+                    results.append(self.subscription_fail_message(sub_id, errors))
+            elif operation_type == SUBSCRIPTION_END:
+                if self.get_subscription(request_id, sub_id):
+                    self.end_subscription(request_id, sub_id)
+                results.append({'type': SUBSCRIPTION_END, 'id': sub_id})
+            else:
+                results.append(self.subscription_fail_message(sub_id, {'errors': 'Invalid message type'}))
+        return results
+
+    def fan_out_callback(self, shared):
+        """
+        callback for a shared subscription, one execution for every subscriber
+        """
+        def callback(error=None, result=None):
+            # subscribers can come and go while we send
+            subscribers = list(shared.subscribers)
+            payload = self.execution_payload(error, result)
+            if payload is not None:
+                self.fan_out_subscription_data(subscribers, payload)
+                return
+            # this is a runtime error
+            for request_id, sub_id in subscribers:
+                self.send_subscription_fail(sub_id, {'errors': error}, request_id)
+        return callback
+
+    def execution_payload(self, error=None, result=None):
+        """
+        turn a subscription_manager callback into a SUBSCRIPTION_DATA payload
+        error could be runtime or object with errors
+        result is GraphQL ExecutionResult
+        returns None for runtime errors
+        """
+        if not error:
+            return {'data': result.data}
+        elif isinstance(error, dict) and 'errors' in error:
+            return {'errors': error['errors']}
+        return None
+
+    def send_execution_result(self, sub_id, request_id, error=None, result=None):
+        """
+        forward a subscription_manager callback to the client
+        """
+        payload = self.execution_payload(error, result)
+        if payload is not None:
+            if not self.hold_for_conflation(request_id, sub_id, payload):
+                self.send_subscription_data(sub_id, payload, request_id)
+        else:
+            # this is a runtime error
+            self.send_subscription_fail(sub_id, {'errors': error}, request_id)
+
+    def hold_for_conflation(self, request_id, sub_id, payload):
+        """
+        returns True when the conflator keeps the payload for later
+        """
+        interval = self.conflate_intervals.get((request_id, sub_id), None)
+        if not interval:
+            return False
+        return self.conflator.offer(request_id, sub_id, payload, interval)
+
+    def encode_subscription_data(self, sub_id, encoded_payload, seq=None, message_type=SUBSCRIPTION_DATA):
+        """
+        build a SUBSCRIPTION_DATA frame around an already encoded payload
+        only the id is encoded here, so one payload can serve many frames
+        """
+        if seq is not None:
+            return '%s%s, "seq": %d, "payload": %s}' % (FRAME_PREFIXES[message_type],
+                                                        self.codec.dumps(sub_id),
+                                                        seq,
+                                                        encoded_payload)
+        return '%s%s, "payload": %s}' % (FRAME_PREFIXES[message_type],
+                                         self.codec.dumps(sub_id),
+                                         encoded_payload)
+
+    def delta_patch(self, request_id, sub_id, payload, size, memo=None):
+        """
+        the patch to send instead of payload, as (ops, encoded ops),
+        or None to send payload in full
+        size is the encoded length of payload
+        memo shares diffs between the subscribers of one fan-out
+        """
+        state = self.delta_states.get((request_id, sub_id), None)
+        if state is None:
+            return None
+        previous = state.last
+        state.last = payload
+        if (previous is None
+                or size < self.delta_threshold
+                or state.patches >= self.delta_snapshot_interval):
+            state.patches = 0
+            return None
+        patch = memo.get(id(previous), None) if memo is not None else None
+        if patch is None:
+            ops = diff(previous, payload)
+            patch = (ops, self.codec.dumps(ops))
+            if memo is not None:
+                # holding on to previous keeps its id from being reused
+                memo[id(previous)] = patch + (previous,)
+        if len(patch[1]) >= size:
+            state.patches = 0
+            return None
+        state.patches += 1
+        self.delta_patches += 1
+        self.delta_chars_saved += size - len(patch[1])
+        return patch[0], patch[1]
+
+    def fan_out_subscription_data(self, subscribers, payload):
+        """
+        send one payload to many (request_id, sub_id) pairs, encoding it once
+        """
+        if self.conflate_intervals:
+            subscribers = [(request_id, sub_id) for request_id, sub_id in subscribers
+                           if not self.hold_for_conflation(request_id, sub_id, payload)]
+        # diffs, packed and compressed payloads are shared between subscribers
+        memo = {} if self.delta_states or self.compressors or self.packer is not None else None
+        if self.envelope == ENVELOPE_OBJECT:
+            for request_id, sub_id in subscribers:
+                self.send_subscription_data(sub_id, payload, request_id, memo)
             return
+        encoded_payload = self.codec.dumps(payload)
+        for request_id, sub_id in subscribers:
+            message_type, value, encoded = SUBSCRIPTION_DATA, payload, encoded_payload
+            if self.delta_states:
+                patch = self.delta_patch(request_id, sub_id, payload, len(encoded_payload), memo)
+                if patch is not None:
+                    message_type, value, encoded = SUBSCRIPTION_PATCH, patch[0], patch[1]
+            seq = None
+            if self.sid_sessions:
+                seq, send = self.sequence(request_id, sub_id, (message_type, encoded))
+                if not send:
+                    continue
+            if self.packer is not None and self.client_packer(request_id) is not None:
+                self.send_packed_data(sub_id, message_type, value, seq, request_id, memo)
+            else:
+                self.send_encoded_data(sub_id, message_type, encoded, seq, request_id, memo)
 
-        # SUBSCRIPTION_END case
-        elif parsed_message['type'] == SUBSCRIPTION_END:
-            # get the sub_id, unsub, delete it
-            if self.connection_subscriptions.get(unique_sub_id, None):
-                self.unsubscribe(self.connection_subscriptions[unique_sub_id])
-                self.connection_subscriptions.pop(unique_sub_id)
+    def send_subscription_data(self, sub_id, payload, request_id, memo=None):
+        """
+        send update to the appropriate client via the session id
+        """
+        message_type = SUBSCRIPTION_DATA
+        seq = None
+        if self.envelope == ENVELOPE_OBJECT:
+            if (request_id, sub_id) in self.delta_states:
+                patch = self.delta_patch(request_id, sub_id, payload, len(self.codec.dumps(payload)), memo)
+                if patch is not None:
+                    message_type, payload = SUBSCRIPTION_PATCH, patch[0]
+            if self.sid_sessions:
+                seq, send = self.sequence(request_id, sub_id, (message_type, payload))
+                if not send:
+                    return
+            if self.packer is not None and self.client_packer(request_id) is not None:
+                self.send_packed_data(sub_id, message_type, payload, seq, request_id, memo)
+            else:
+                self.send_object_data(sub_id, message_type, payload, seq, request_id, memo)
             return
+        encoded_payload = self.codec.dumps(payload)
+        if self.delta_states:
+            patch = self.delta_patch(request_id, sub_id, payload, len(encoded_payload))
+            if patch is not None:
+                message_type, payload, encoded_payload = SUBSCRIPTION_PATCH, patch[0], patch[1]
+        if self.sid_sessions:
+            seq, send = self.sequence(request_id, sub_id, (message_type, encoded_payload))
+            if not send:
+                return
+        if self.packer is not None and self.client_packer(request_id) is not None:
+            self.send_packed_data(sub_id, message_type, payload, seq, request_id)
+        else:
+            self.send_encoded_data(sub_id, message_type, encoded_payload, seq, request_id)
 
-        # otherwise fail
+    def send_encoded_data(self, sub_id, message_type, encoded_payload, seq, request_id, memo=None):
+        """
+        send an encoded SUBSCRIPTION_DATA or SUBSCRIPTION_PATCH payload,
+        compressed if the client asked for it
+        """
+        if self.translating:
+            protocol = self.client_protocol(request_id)
+            if protocol is not None:
+                # the payload is spliced into the protocol's frame as well
+                frame = protocol.data_frame(sub_id, encoded_payload)
+                if frame is not None:
+                    self.count_out(message_type)
+                    self.send_encoded(frame, request_id)
+                return
+        self.count_out(message_type)
+        if self.compressors:
+            compressor = self.client_compressor(request_id)
+            if compressor is not None:
+                compressed = self.compress(compressor, encoded_payload, memo)
+                if compressed is not None:
+                    header = {'type': message_type, 'id': sub_id, 'compression': compressor.name}
+                    if seq is not None:
+                        header['seq'] = seq
+                    self.send_binary({'data': self.codec.dumps(header), 'payload': compressed}, request_id)
+                    return
+        self.send_encoded(self.encode_subscription_data(sub_id, encoded_payload, seq, message_type),
+                          request_id)
+
+    def send_object_data(self, sub_id, message_type, payload, seq, request_id, memo=None):
+        """
+        the object envelope version of send_encoded_data
+        """
+        message = {'type': message_type, 'id': sub_id, 'payload': payload}
+        if seq is not None:
+            message['seq'] = seq
+        if self.compressors:
+            compressor = self.client_compressor(request_id)
+            if compressor is not None:
+                compressed = self.compress(compressor, payload, memo)
+                if compressed is not None:
+                    self.count_out(message_type)
+                    message['compression'] = compressor.name
+                    message['payload'] = compressed
+                    self.send_binary(message, request_id)
+                    return
+        # counted by write_message
+        self.send_message(message, request_id)
+
+    def send_packed_data(self, sub_id, message_type, payload, seq, request_id, memo=None):
+        """
+        the MessagePack version of send_encoded_data
+        """
+        self.count_out(message_type)
+        key = (PROTOCOL_MSGPACK, id(payload))
+        if memo is not None and key in memo:
+            packed = memo[key][1]
         else:
-            self.send_subscription_fail(sub_id, {'errors': 'Invalid message type'}, request_id)
+            packed = self.packer.dumps(payload)
+            if memo is not None:
+                # holding on to payload keeps its id from being reused
+                memo[key] = (payload, packed)
+        compression = None
+        if self.compressors:
+            compressor = self.client_compressor(request_id)
+            if compressor is not None:
+                compressed = self.compress(compressor, packed, memo)
+                if compressed is not None:
+                    compression = compressor.name
+                    packed = self.packer.dumps(compressed)
+        self.send_binary({'data': self.packer.encode_data(message_type, sub_id, packed, seq, compression)},
+                         request_id)
+
+    def client_packer(self, request_id):
+        connection = self.connections.get(request_id, None)
+        if connection is None:
+            return None
+        return connection.packer
+
+    def client_protocol(self, request_id):
+        """
+        the Protocol translating for a connection, None for the legacy one
+        """
+        connection = self.connections.get(request_id, None)
+        if connection is None:
+            return None
+        return connection.protocol
+
+    def perform(self, request_id, actions):
+        """
+        carry out what a connection's Protocol asked for
+        """
+        for action in actions:
+            if action[0] == HANDLE:
+                self.handle_parsed(request_id, action[1])
+            elif action[0] == SEND:
+                self.write_message(action[1], request_id)
+            else:
+                self.close_client(request_id, action[1], action[2])
+
+    def client_compressor(self, request_id):
+        connection = self.connections.get(request_id, None)
+        if connection is None:
+            return None
+        return connection.compressor
+
+    def compress(self, compressor, payload, memo=None):
+        """
+        compressed bytes of a payload, None when it encodes to fewer than
+        compression_threshold characters
+        payload is encoded text or MessagePack, or a payload object for the
+        object envelope
+        memo shares the work between the subscribers of one fan-out
+        """
+        key = (compressor.name, id(payload))
+        if memo is not None and key in memo:
+            return memo[key][1]
+        encoded = payload if isinstance(payload, (str, bytes)) else self.codec.dumps(payload)
+        compressed = None
+        if len(encoded) >= self.compression_threshold:
+            data = encoded if isinstance(encoded, bytes) else encoded.encode('utf-8')
+            compressed = compressor.compress(data)
+            self.compressed_payloads += 1
+            self.compression_bytes_saved += len(data) - len(compressed)
+        if memo is not None:
+            # holding on to payload keeps its id from being reused
+            memo[key] = (payload, compressed)
+        return compressed
+
+    def send_binary(self, frame, request_id):
+        """
+        send a frame carrying bytes, which can't join a text batch
+        """
+        connection = self.connections.get(request_id, None)
+        if connection is not None and connection.batch:
+            # send what is waiting first, to keep the order
+            self.flush_batch(connection)
+        self.emit_frame(frame, request_id)
+
+    def send_message(self, message, request_id):
+        """
+        encode a protocol message and send it to a single client
+        """
+        if self.broker is not None and not self.owns(request_id):
+            # the socket lives on another worker
+            self.broker.publish({
+                'kind': BROKER_EMIT,
+                'worker': self.broker.worker_id,
+                'sid': request_id,
+                'message': message,
+            })
             return
+        if self.translating:
+            protocol = self.client_protocol(request_id)
+            if protocol is not None:
+                self.perform(request_id, protocol.send(message))
+                return
+        self.write_message(message, request_id)
 
-    def send_subscription_data(self, sub_id, payload, request_id):
+    def write_message(self, message, request_id):
         """
-        send update to the appropriate client via the session id
+        encode a message as it is and send it to a single client
         """
-        message = {
-            'type': SUBSCRIPTION_DATA,
-            'id': sub_id,
-            'payload': payload,
-            'room': request_id,
-        }
-        self.socketio.emit(SUBSCRIPTION_MESSAGE,
-                          {'data': json.dumps(message)},
-                          namespace=self.namespace,
-                          room=request_id)
+        self.count_out(message['type'])
+        if self.packer is not None and self.client_packer(request_id) is not None:
+            self.send_binary({'data': self.packer.dumps(message)}, request_id)
+        elif self.envelope == ENVELOPE_OBJECT:
+            self.deliver(message, request_id)
+        else:
+            self.send_encoded(self.codec.dumps(message), request_id)
 
-    def send_subscription_fail(self, sub_id, payload, request_id):
+    def count_out(self, message_type):
         """
-        alert client to failure in setting up subscription
+        count a message going out, where it is sent, by its real type
         """
+        if self.instrumentation is not None:
+            self.instrumentation.messages_out(message_type)
+
+    def send_encoded(self, encoded_message, request_id):
+        """
+        send an already encoded protocol message to a single client
+        """
+        self.deliver(encoded_message, request_id)
+
+    def deliver(self, message, request_id):
+        """
+        send a message, encoded or not depending on the envelope, right away
+        or as part of the connection's next batch
+        """
+        connection = self.connections.get(request_id, None)
+        if connection is None or connection.batch is None:
+            self.emit_frame(self.make_frame(message), request_id)
+            return
+        with connection.lock:
+            connection.batch.append(message)
+            full = len(connection.batch) >= self.batch_size
+            if not full and connection.batch_timer is None:
+                connection.batch_timer = self.scheduler.call_later(self.batch_window,
+                                                                   self.flush_batch,
+                                                                   connection)
+        if full:
+            self.flush_batch(connection)
+
+    def flush_batch(self, connection):
+        """
+        send everything a connection has queued as a single frame
+        """
+        with connection.lock:
+            if connection.batch_timer is not None:
+                connection.batch_timer.cancel()
+                connection.batch_timer = None
+            messages = connection.batch
+            if not messages:
+                return
+            connection.batch = []
+        if len(messages) == 1:
+            # no point wrapping a lone message
+            frame = self.make_frame(messages[0])
+        elif self.envelope == ENVELOPE_OBJECT:
+            frame = {'type': BATCH, 'payload': messages}
+        else:
+            frame = self.make_frame(BATCH_TEMPLATE % ', '.join(messages))
+        self.emit_frame(frame, connection.request_id)
+
+    def make_frame(self, message):
+        if self.envelope == ENVELOPE_OBJECT:
+            return message
+        return {'data': message}
+
+    def encode_frame(self, message):
+        if self.envelope == ENVELOPE_OBJECT:
+            return message
+        return self.make_frame(self.codec.dumps(message))
+
+    def emit_frame(self, frame, request_id):
+        """
+        send a frame to a single client, through its bounded queue if enabled
+        """
+        connection = None
+        if self.max_queued_frames:
+            connection = self.connections.get(request_id, None)
+        if connection is None:
+            self.write_frame(frame, request_id)
+            return
+        with connection.lock:
+            outbox = connection.outbox
+            overflow = len(outbox) >= self.max_queued_frames
+            if overflow:
+                connection.dropped += 1
+                self.dropped_frames += 1
+                if self.overflow_policy == OVERFLOW_DROP_OLDEST:
+                    outbox.popleft()
+                    outbox.append(frame)
+            else:
+                outbox.append(frame)
+        if overflow and self.overflow_policy == OVERFLOW_DISCONNECT:
+            self.evict(connection)
+            return
+        if overflow and self.delta_states:
+            self.resync_deltas(request_id)
+        self.drain(connection)
+
+    def resync_deltas(self, request_id):
+        """
+        a frame was dropped and it may have been a patch, or the result
+        the next patch builds on; each of the connection's delta
+        subscriptions sends its next result in full
+        """
+        for sub_id in self.connection_subscriptions.get(request_id, {}):
+            state = self.delta_states.get((request_id, sub_id), None)
+            if state is not None:
+                state.last = None
+                state.patches = 0
+
+    def drain(self, connection):
+        """
+        move queued frames to Socket.IO while the client keeps up
+        """
+        request_id = connection.request_id
+        with connection.lock:
+            while connection.outbox:
+                if self.transport_backlog(request_id) >= self.max_transport_backlog:
+                    # stalled, look again later
+                    if connection.drain_timer is None:
+                        connection.drain_timer = self.scheduler.call_later(self.drain_interval,
+                                                                           self.retry_drain,
+                                                                           connection)
+                    return
+                self.write_frame(connection.outbox.popleft(), request_id)
+
+    def retry_drain(self, connection):
+        with connection.lock:
+            connection.drain_timer = None
+        # dropped while we were waiting
+        if self.connections.get(connection.request_id, None) is connection:
+            self.drain(connection)
+
+    def transport_backlog(self, request_id):
+        """
+        packets engine.io is holding for a client that it hasn't written yet
+        """
+        try:
+            server = self.socket_server()
+            eio_sid = server.manager.eio_sid_from_sid(request_id, self.namespace)
+            return server.eio.sockets[eio_sid].queue.qsize()
+        except Exception:
+            return 0
+
+    def evict(self, connection):
+        """
+        disconnect a client that can't keep up
+        """
+        self.evicted_connections += 1
+        request_id = connection.request_id
+        self.drop_connection(request_id)
+        self.write_frame(self.encode_frame({'type': SUBSCRIPTION_FAIL,
+                                            'id': None,
+                                            'payload': SLOW_CONSUMER}),
+                         request_id)
+        self.disconnect_client(request_id)
+
+    def frame_size(self, frame):
+        """
+        bytes a frame puts on the wire, give or take Socket.IO's framing
+        """
+        if isinstance(frame.get('data', None), bytes):
+            # MessagePack
+            return len(frame['data'])
+        compressed = frame.get('payload', None)
+        if not isinstance(compressed, bytes):
+            compressed = None
+        if self.envelope == ENVELOPE_OBJECT:
+            if compressed is not None:
+                frame = dict(frame, payload=None)
+            encoded = self.codec.dumps(frame)
+        else:
+            encoded = frame['data']
+        return len(encoded.encode('utf-8')) + (len(compressed) if compressed is not None else 0)
+
+    def write_frame(self, frame, request_id):
+        """
+        hand a frame to Socket.IO
+        """
+        self.touch(request_id)
+        if self.instrumentation is not None:
+            self.instrumentation.frame_out(self.frame_size(frame))
+        self.timed(TIMING_EMIT, self.emit, SUBSCRIPTION_MESSAGE, frame, request_id)
+
+    def subscription_fail_message(self, sub_id, payload):
         error_message = str(payload['errors'])
-        message = {
+        return {
             'type': SUBSCRIPTION_FAIL,
             'id': sub_id,
             'payload': error_message,
         }
-        self.socketio.emit(SUBSCRIPTION_MESSAGE,
-                          {'data': json.dumps(message)},
-                          namespace=self.namespace,
-                          room=request_id)
+
+    def subscription_success_message(self, sub_id):
+        return {
+            'type': SUBSCRIPTION_SUCCESS,
+            'id': sub_id,
+        }
+
+    def send_subscription_fail(self, sub_id, payload, request_id):
+        """
+        alert client to failure in setting up subscription
+        """
+        self.send_message(self.subscription_fail_message(sub_id, payload), request_id)
 
     def send_subscription_success(self, sub_id, request_id):
         """
         notify client of success in setting up subscription
         """
-        message = {
-            'type': SUBSCRIPTION_SUCCESS,
-            'id': sub_id,
-        }
-        self.socketio.emit(SUBSCRIPTION_MESSAGE,
-                          {'data': json.dumps(message)},
-                          namespace=self.namespace,
-                          room=request_id)
+        self.send_message(self.subscription_success_message(sub_id), request_id)
+
+    def send_lifecycle_message(self, data, request_id):
+        """
+        notify only the affected client of its connect / disconnect
+        """
+        # without a session id this would broadcast to the whole namespace
+        if not self.lifecycle_messages or request_id is None:
+            return
+        self.emit('message', {'data': data}, request_id)
 
     def send_init_result(self, message_type, payload, request_id):
         if payload.get('errors', None):
@@ -263,7 +1685,4 @@ class SubscriptionServer(object):
             'type': message_type,
             'payload': payload,
         }
-        self.socketio.emit(SUBSCRIPTION_MESSAGE,
-                          {'data': json.dumps(message)},
-                          namespace=self.namespace,
-                          room=request_id)
+        self.send_message(message, request_id)
@@ -0,0 +1,157 @@
+#
+# hooks for counting and timing what the server does
+#
+
+import threading
+import time
+from collections import defaultdict
+
+# upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# timings the server reports
+TIMING_HANDLE_MESSAGE = 'handle_message'
+TIMING_DECODE = 'decode'
+TIMING_PARSE_CONTEXT = 'parse_context'
+TIMING_SUBSCRIBE = 'subscribe'
+TIMING_EMIT = 'emit'
+
+
+class Instrumentation(object):
+    """
+    interface the server reports to, every hook is a no-op
+    subclass it to feed statsd, prometheus_client or similar
+    hooks run on the hot path, so keep them cheap
+    """
+    # used to time the calls reported to timing
+    clock = staticmethod(time.perf_counter)
+
+    def connection_opened(self):
+        pass
+
+    def connection_closed(self):
+        pass
+
+    def subscriptions_started(self, count=1):
+        pass
+
+    def subscriptions_ended(self, count=1):
+        pass
+
+    def message_in(self, message_type):
+        pass
+
+    def messages_out(self, message_type, count=1):
+        pass
+
+    def frame_out(self, size):
+        pass
+
+    def timing(self, name, seconds):
+        pass
+
+    def snapshot(self):
+        return {}
+
+
+class Histogram(object):
+    """
+    fixed bucket histogram, cumulative like prometheus
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def snapshot(self):
+        buckets = {}
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            buckets[repr(bound)] = total
+        buckets['+Inf'] = self.count
+        return {'count': self.count, 'sum': self.sum, 'max': self.max, 'buckets': buckets}
+
+
+class InMemoryInstrumentation(Instrumentation):
+    """
+    keeps everything in process, read it back with snapshot
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS, clock=None):
+        if clock is not None:
+            self.clock = clock
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.active_connections = 0
+            self.active_subscriptions = 0
+            self.messages_in_by_type = defaultdict(int)
+            self.messages_out_by_type = defaultdict(int)
+            self.frames_out_total = 0
+            self.bytes_out = 0
+            self.timings = {}
+
+    def connection_opened(self):
+        with self.lock:
+            self.active_connections += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.active_connections -= 1
+
+    def subscriptions_started(self, count=1):
+        with self.lock:
+            self.active_subscriptions += count
+
+    def subscriptions_ended(self, count=1):
+        with self.lock:
+            self.active_subscriptions -= count
+
+    def message_in(self, message_type):
+        with self.lock:
+            self.messages_in_by_type[message_type] += 1
+
+    def messages_out(self, message_type, count=1):
+        with self.lock:
+            self.messages_out_by_type[message_type] += count
+
+    def frame_out(self, size):
+        with self.lock:
+            self.frames_out_total += 1
+            self.bytes_out += size
+
+    def timing(self, name, seconds):
+        with self.lock:
+            histogram = self.timings.get(name, None)
+            if histogram is None:
+                histogram = self.timings[name] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def snapshot(self):
+        """
+        plain dicts and numbers, ready for jsonify
+        """
+        with self.lock:
+            return {
+                'active_connections': self.active_connections,
+                'active_subscriptions': self.active_subscriptions,
+                'messages_in': dict(self.messages_in_by_type),
+                'messages_out': dict(self.messages_out_by_type),
+                'frames_out': self.frames_out_total,
+                'bytes_out': self.bytes_out,
+                'timings': {name: histogram.snapshot() for name, histogram in self.timings.items()},
+            }
@@ -1,6 +1,7 @@
 SUBSCRIPTION_MESSAGE = 'subscription_message'
 SUBSCRIPTION_FAIL = 'subscription_fail'
 SUBSCRIPTION_DATA = 'subscription_data'
+SUBSCRIPTION_PATCH = 'subscription_patch'
 SUBSCRIPTION_START = 'subscription_start'
 SUBSCRIPTION_END = 'subscription_end'
 SUBSCRIPTION_SUCCESS = 'subscription_success'
@@ -8,4 +9,37 @@ KEEPALIVE = 'keepalive'
 INIT = 'init'
 INIT_FAIL = 'init_fail'
 INIT_SUCCESS = 'init_success'
+BATCH = 'batch'
+ENVELOPE_STRING = 'string'
+ENVELOPE_OBJECT = 'object'
+PROTOCOL_MSGPACK = 'msgpack'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+OVERFLOW_DISCONNECT = 'disconnect'
 PARAMS_MUST_BE_OBJECT  = 'Invalid params returned from on_subscribe - return values must be an object'
+SLOW_CONSUMER = 'Too many frames queued for this connection - disconnecting'
+PERSISTED_QUERY_NOT_FOUND = 'PersistedQueryNotFound'
+TOO_MANY_SUBSCRIPTIONS = 'Too many subscriptions on this connection'
+SERVER_AT_CAPACITY = 'Too many subscriptions on this server'
+RATE_LIMITED = 'Too many messages - slow down'
+SUBSCRIPTION_BATCH = 'subscription_batch'
+SUBSCRIPTION_BATCH_RESULT = 'subscription_batch_result'
+BATCH_PAYLOAD_MUST_BE_LIST = 'subscription_batch payload must be a list of operations'
+PROTOCOL_LEGACY = 'graphql-subscriptions'
+PROTOCOL_GRAPHQL_WS = 'graphql-transport-ws'
+GQL_CONNECTION_INIT = 'connection_init'
+GQL_CONNECTION_ACK = 'connection_ack'
+GQL_PING = 'ping'
+GQL_PONG = 'pong'
+GQL_SUBSCRIBE = 'subscribe'
+GQL_NEXT = 'next'
+GQL_ERROR = 'error'
+GQL_COMPLETE = 'complete'
+CLOSE_NORMAL = 1000
+CLOSE_TRY_AGAIN_LATER = 1013
+CLOSE_BAD_REQUEST = 4400
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_FORBIDDEN = 4403
+CLOSE_SUBPROTOCOL_NOT_ACCEPTABLE = 4406
+CLOSE_SUBSCRIBER_EXISTS = 4409
+CLOSE_TOO_MANY_INITS = 4429
@@ -0,0 +1,41 @@
+#
+# MessagePack wire protocol, negotiated per connection at INIT
+# frames are {'data': <packed message>}, sent as Socket.IO binary attachments
+#
+
+import importlib
+
+from .message_types import PROTOCOL_MSGPACK
+
+
+class MsgpackProtocol(object):
+    """
+    packs protocol messages as MessagePack maps, needs the msgpack package
+    """
+    name = PROTOCOL_MSGPACK
+
+    def __init__(self):
+        self.msgpack = importlib.import_module('msgpack')
+        # map keys of data frames, packed once
+        self.keys = {key: self.dumps(key) for key in ['type', 'id', 'seq', 'compression', 'payload']}
+
+    def dumps(self, message):
+        return self.msgpack.packb(message, use_bin_type=True)
+
+    def loads(self, data):
+        return self.msgpack.unpackb(data, raw=False)
+
+    def encode_data(self, message_type, sub_id, packed_payload, seq=None, compression=None):
+        """
+        build a SUBSCRIPTION_DATA or SUBSCRIPTION_PATCH map around an already
+        packed payload, so one payload can serve many frames
+        """
+        keys = self.keys
+        fields = [keys['type'], self.dumps(message_type), keys['id'], self.dumps(sub_id)]
+        if seq is not None:
+            fields += [keys['seq'], self.dumps(seq)]
+        if compression is not None:
+            fields += [keys['compression'], self.dumps(compression)]
+        fields += [keys['payload'], packed_payload]
+        # a fixmap header, we never have more than 15 fields
+        return bytes((0x80 | (len(fields) // 2),)) + b''.join(fields)
@@ -0,0 +1,57 @@
+#
+# persisted queries: clients send the hash of a known document
+# instead of its full text
+#
+
+import hashlib
+import json
+
+
+def query_hash(query):
+    """
+    the sha256 of a document's text, used as its persisted query id
+    """
+    return hashlib.sha256(query.encode('utf-8')).hexdigest()
+
+
+class InMemoryQueryStore(object):
+    """
+    maps persisted query ids to query text, given either as
+    {id: query} or as a list of queries keyed by their hash
+    """
+    def __init__(self, queries=None):
+        self.queries = {}
+        if isinstance(queries, dict):
+            self.queries.update(queries)
+        elif queries:
+            # a plain list of documents, keyed by their hash
+            for query in queries:
+                self.add(query)
+
+    def __len__(self):
+        return len(self.queries)
+
+    def __iter__(self):
+        return iter(self.queries.items())
+
+    def get(self, query_id):
+        """
+        the query text for an id, None if we don't know it
+        """
+        return self.queries.get(query_id, None)
+
+    def add(self, query):
+        query_id = query_hash(query)
+        self.queries[query_id] = query
+        return query_id
+
+
+class ManifestQueryStore(InMemoryQueryStore):
+    """
+    queries loaded once from a JSON manifest file, either an
+    {id: query} object or a list of queries
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path) as manifest:
+            super(ManifestQueryStore, self).__init__(json.load(manifest))
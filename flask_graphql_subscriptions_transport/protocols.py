@@ -0,0 +1,268 @@
+#
+# the wire protocols a client can speak, as I/O-free state machines
+# one Protocol per connection turns what the client sends into legacy
+# protocol messages for the server to handle, and the server's legacy
+# messages into what goes out on the wire; neither direction touches a
+# socket, both return a list of actions for the transport to carry out
+#
+
+import json
+from collections import OrderedDict
+
+from .message_types import (
+    SUBSCRIPTION_FAIL,
+    SUBSCRIPTION_DATA,
+    SUBSCRIPTION_START,
+    SUBSCRIPTION_END,
+    KEEPALIVE,
+    INIT,
+    INIT_FAIL,
+    INIT_SUCCESS,
+    PROTOCOL_LEGACY,
+    PROTOCOL_GRAPHQL_WS,
+    GQL_CONNECTION_INIT,
+    GQL_CONNECTION_ACK,
+    GQL_PING,
+    GQL_PONG,
+    GQL_SUBSCRIBE,
+    GQL_NEXT,
+    GQL_ERROR,
+    GQL_COMPLETE,
+    CLOSE_BAD_REQUEST,
+    CLOSE_UNAUTHORIZED,
+    CLOSE_FORBIDDEN,
+    CLOSE_SUBSCRIBER_EXISTS,
+    CLOSE_TOO_MANY_INITS,
+)
+
+# actions
+# (HANDLE, message): the server handles a legacy protocol message
+# (SEND, message): the message goes to the client as it is
+# (CLOSE, code, reason): the connection is closed
+HANDLE = 'handle'
+SEND = 'send'
+CLOSE = 'close'
+
+# websocket close reasons are limited to 123 bytes
+MAX_CLOSE_REASON = 123
+
+
+def close_action(code, reason):
+    reason = str(reason)
+    while len(reason.encode('utf-8')) > MAX_CLOSE_REASON:
+        reason = reason[:-1]
+    return (CLOSE, code, reason)
+
+
+class Protocol(object):
+    """
+    interface for a wire protocol, name is the websocket subprotocol
+    translates is False for the legacy protocol, which the server handles
+    without going through receive / send
+    """
+    name = None
+    translates = True
+
+    def __init__(self, codec=None):
+        self.dumps = codec.dumps if codec is not None else json.dumps
+
+    def receive(self, message):
+        """
+        actions for a decoded message from the client
+        """
+        raise NotImplementedError
+
+    def send(self, message):
+        """
+        actions for a legacy protocol message from the server
+        """
+        raise NotImplementedError
+
+    def data_frame(self, sub_id, encoded_payload):
+        """
+        the encoded frame send() would produce for SUBSCRIPTION_DATA around
+        an already encoded payload, or None when nothing goes out
+        """
+        raise NotImplementedError
+
+
+class LegacyProtocol(Protocol):
+    """
+    the protocol this server has always spoken, passed through as it is
+    """
+    name = PROTOCOL_LEGACY
+    translates = False
+
+    def receive(self, message):
+        return [(HANDLE, message)]
+
+    def send(self, message):
+        return [(SEND, message)]
+
+    def data_frame(self, sub_id, encoded_payload):
+        return '{"type": %s, "id": %s, "payload": %s}' % (self.dumps(SUBSCRIPTION_DATA),
+                                                          self.dumps(sub_id),
+                                                          encoded_payload)
+
+
+class GraphQLWSProtocol(Protocol):
+    """
+    graphql-ws's graphql-transport-ws protocol
+    an operation lives from subscribe until either side completes it or
+    the server sends an error; protocol violations close the connection
+    with graphql-ws's 44xx codes
+    """
+    name = PROTOCOL_GRAPHQL_WS
+
+    def __init__(self, codec=None):
+        super(GraphQLWSProtocol, self).__init__(codec)
+        self.next_prefix = '{"type": %s, "id": ' % self.dumps(GQL_NEXT)
+        self.init_received = False
+        self.acknowledged = False
+        self.closed = False
+        # ids of the client's running operations
+        self.operations = set()
+
+    def close(self, code, reason):
+        self.closed = True
+        self.operations.clear()
+        return [close_action(code, reason)]
+
+    def receive(self, message):
+        if self.closed:
+            return []
+        message_type = message.get('type', None) if isinstance(message, dict) else None
+
+        if message_type == GQL_CONNECTION_INIT:
+            payload = message.get('payload', None)
+            if payload is not None and not isinstance(payload, dict):
+                return self.close(CLOSE_BAD_REQUEST, 'Invalid connection_init payload')
+            if self.init_received:
+                return self.close(CLOSE_TOO_MANY_INITS, 'Too many initialisation requests')
+            self.init_received = True
+            return [(HANDLE, {'type': INIT, 'payload': payload if payload is not None else {}})]
+
+        if message_type == GQL_PING:
+            return [(SEND, {'type': GQL_PONG})]
+
+        if message_type == GQL_PONG:
+            return []
+
+        if message_type == GQL_SUBSCRIBE:
+            sub_id = message.get('id', None)
+            payload = message.get('payload', None)
+            if not isinstance(sub_id, str) or not sub_id or not isinstance(payload, dict) \
+                    or not isinstance(payload.get('query', None), str):
+                return self.close(CLOSE_BAD_REQUEST, 'Invalid subscribe message')
+            if not self.acknowledged:
+                return self.close(CLOSE_UNAUTHORIZED, 'Unauthorized')
+            if sub_id in self.operations:
+                return self.close(CLOSE_SUBSCRIBER_EXISTS, 'Subscriber for %s already exists' % sub_id)
+            self.operations.add(sub_id)
+            return [(HANDLE, {
+                'type': SUBSCRIPTION_START,
+                'id': sub_id,
+                'query': payload['query'],
+                'variables': payload.get('variables', None) or {},
+                'operation_name': payload.get('operationName', None),
+            })]
+
+        if message_type == GQL_COMPLETE:
+            sub_id = message.get('id', None)
+            if not isinstance(sub_id, str):
+                return self.close(CLOSE_BAD_REQUEST, 'Invalid complete message')
+            if sub_id not in self.operations:
+                # already over, e.g. we sent an error
+                return []
+            self.operations.discard(sub_id)
+            return [(HANDLE, {'type': SUBSCRIPTION_END, 'id': sub_id})]
+
+        return self.close(CLOSE_BAD_REQUEST, 'Invalid message received')
+
+    def send(self, message):
+        if self.closed:
+            return []
+        message_type = message.get('type', None)
+        sub_id = message.get('id', None)
+
+        if message_type == SUBSCRIPTION_DATA:
+            if sub_id not in self.operations:
+                return []
+            return [(SEND, {'type': GQL_NEXT, 'id': sub_id, 'payload': message['payload']})]
+
+        if message_type == INIT_SUCCESS:
+            self.acknowledged = True
+            return [(SEND, {'type': GQL_CONNECTION_ACK})]
+
+        if message_type == INIT_FAIL:
+            return self.close(CLOSE_FORBIDDEN, 'Forbidden')
+
+        if message_type == SUBSCRIPTION_FAIL:
+            if sub_id is None:
+                # not about any one operation, e.g. an unparseable message
+                return self.close(CLOSE_BAD_REQUEST, message.get('payload', None))
+            if sub_id not in self.operations:
+                return []
+            # an error ends the operation, on our side too
+            self.operations.discard(sub_id)
+            return [(SEND, {'type': GQL_ERROR, 'id': sub_id, 'payload': [{'message': message.get('payload', None)}]}),
+                    (HANDLE, {'type': SUBSCRIPTION_END, 'id': sub_id})]
+
+        if message_type == KEEPALIVE:
+            return [(SEND, {'type': GQL_PING})]
+
+        # SUBSCRIPTION_SUCCESS has no counterpart, batches, patches and the
+        # other INIT options are never negotiated
+        return []
+
+    def data_frame(self, sub_id, encoded_payload):
+        if self.closed or sub_id not in self.operations:
+            return None
+        return '%s%s, "payload": %s}' % (self.next_prefix, self.dumps(sub_id), encoded_payload)
+
+
+PROTOCOLS = {
+    LegacyProtocol.name: LegacyProtocol,
+    GraphQLWSProtocol.name: GraphQLWSProtocol,
+}
+
+
+def make_protocols(protocols=None):
+    """
+    build the name -> Protocol class map a server offers, in order of
+    preference, from a name, a Protocol subclass, or a list of them
+    defaults to the legacy protocol alone
+    """
+    offered = OrderedDict()
+    if protocols is None:
+        protocols = [PROTOCOL_LEGACY]
+    if isinstance(protocols, str) or isinstance(protocols, type):
+        protocols = [protocols]
+    for protocol in protocols:
+        if isinstance(protocol, str):
+            if protocol not in PROTOCOLS:
+                raise ValueError('unknown protocol %r' % protocol)
+            protocol = PROTOCOLS[protocol]
+        if not (isinstance(protocol, type) and issubclass(protocol, Protocol) and protocol.name):
+            raise ValueError('protocols must be names or Protocol subclasses with a name')
+        offered[protocol.name] = protocol
+    if not offered:
+        raise ValueError('protocols must offer at least one protocol')
+    return offered
+
+
+def choose_protocol(protocols, requested):
+    """
+    the first of the client's requested names the server offers, or None
+    a client that asks for nothing speaks the legacy protocol
+    """
+    if not requested:
+        return protocols.get(PROTOCOL_LEGACY, None)
+    if isinstance(requested, str):
+        requested = [requested]
+    if not isinstance(requested, (list, tuple)):
+        return None
+    for name in requested:
+        if isinstance(name, str) and name in protocols:
+            return protocols[name]
+    return None
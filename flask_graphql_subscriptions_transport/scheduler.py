@@ -0,0 +1,105 @@
+#
+# a single timer heap shared by every connection and subscription
+#
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Timer(object):
+    """
+    handle for a scheduled call, can be cancelled until it runs
+    """
+    __slots__ = ('deadline', 'func', 'args', 'cancelled')
+
+    def __init__(self, deadline, func, args):
+        self.deadline = deadline
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler(object):
+    """
+    runs delayed calls from one heap and one background task,
+    instead of one greenlet per timer
+    without start_background_task nothing runs on its own, and the owner
+    drives it with run_pending (handy for tests)
+    """
+    def __init__(self, start_background_task=None, clock=time.monotonic):
+        self.start_background_task = start_background_task
+        self.clock = clock
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = None
+        self._running = False
+
+    def __len__(self):
+        return len(self._heap)
+
+    def call_later(self, delay, func, *args):
+        """
+        run func(*args) after delay seconds, returns a cancellable Timer
+        """
+        timer = Timer(self.clock() + delay, func, args)
+        with self._lock:
+            heapq.heappush(self._heap, (timer.deadline, next(self._counter), timer))
+            earliest = self._heap[0][2] is timer
+            start = self.start_background_task and not self._running
+            if start:
+                self._running = True
+                self._wakeup = threading.Event()
+        if start:
+            self.start_background_task(self._run)
+        elif earliest and self._wakeup is not None:
+            # the loop is sleeping towards a later deadline
+            self._wakeup.set()
+        return timer
+
+    def next_deadline(self):
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def run_pending(self, now=None):
+        """
+        run every timer that is due, returns how many ran
+        """
+        if now is None:
+            now = self.clock()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap)[2])
+        ran = 0
+        for timer in due:
+            if timer.cancelled:
+                continue
+            ran += 1
+            try:
+                timer.func(*timer.args)
+            except Exception:
+                # one bad timer must not take down the loop
+                logger.exception('timer %r failed', timer.func)
+        return ran
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._heap:
+                    self._running = False
+                    return
+                delay = self._heap[0][0] - self.clock()
+                wakeup = self._wakeup
+            if delay > 0:
+                wakeup.wait(delay)
+                wakeup.clear()
+            self.run_pending()
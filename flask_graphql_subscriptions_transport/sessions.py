@@ -0,0 +1,82 @@
+#
+# resumable sessions: recent SUBSCRIPTION_DATA is kept per subscription so
+# a client that reconnects gets what it missed instead of starting over
+#
+
+import secrets
+from collections import deque
+
+
+class ReplayBuffer(object):
+    """
+    ring of the last size payloads of one subscription, with their
+    sequence numbers
+    """
+    __slots__ = ('frames', 'evicted_seq')
+
+    def __init__(self, size):
+        self.frames = deque(maxlen=size)
+        # newest sequence number pushed out of the ring
+        self.evicted_seq = 0
+
+    def append(self, seq, payload):
+        if len(self.frames) == self.frames.maxlen:
+            self.evicted_seq = self.frames[0][0]
+        self.frames.append((seq, payload))
+
+    def since(self, seq):
+        """
+        the (seq, payload) pairs after seq, None if some of them are gone
+        """
+        if self.evicted_seq > seq:
+            return None
+        return [frame for frame in self.frames if frame[0] > seq]
+
+
+class Session(object):
+    """
+    the subscriptions of one client, which outlive its socket for a while
+    sequence numbers count across all of the session's subscriptions, so
+    the client only has to remember the last one it saw
+    """
+    def __init__(self, request_id, buffer_size):
+        self.token = secrets.token_urlsafe(16)
+        # the sid the subscriptions are registered under
+        self.request_id = request_id
+        # False between a disconnect and the next resume
+        self.attached = True
+        self.buffer_size = buffer_size
+        self.seq = 0
+        # client sub_id -> ReplayBuffer
+        self.buffers = {}
+        self.expiry_timer = None
+
+    def record(self, sub_id, payload):
+        """
+        keep a payload for replay, returning its sequence number
+        """
+        self.seq += 1
+        buffer = self.buffers.get(sub_id, None)
+        if buffer is None:
+            buffer = self.buffers[sub_id] = ReplayBuffer(self.buffer_size)
+        buffer.append(self.seq, payload)
+        return self.seq
+
+    def forget(self, sub_id):
+        self.buffers.pop(sub_id, None)
+
+    def missed(self, last_seen):
+        """
+        everything after last_seen as (seq, sub_id, payload) in order,
+        and the sub ids whose buffers no longer reach back that far
+        """
+        frames = []
+        stale = []
+        for sub_id, buffer in self.buffers.items():
+            since = buffer.since(last_seen)
+            if since is None:
+                stale.append(sub_id)
+                continue
+            frames.extend((seq, sub_id, payload) for seq, payload in since)
+        frames.sort(key=lambda frame: frame[0])
+        return frames, stale
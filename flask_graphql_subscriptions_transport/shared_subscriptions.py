@@ -0,0 +1,55 @@
+#
+# lets identical subscriptions share a single subscription_manager
+# subscription, whose results are fanned out to every subscriber
+#
+
+import json
+
+
+def subscription_key(base_params, context_key=None):
+    """
+    identity of a subscription: query, variables, operation name and
+    a key derived from the context
+    returns None when the subscription must not be shared
+    without a context_key, only subscriptions with an empty context are
+    shared, so nobody gets results resolved with someone else's context
+    """
+    context = None
+    if not context_key and base_params.get('context', None):
+        return None
+    if context_key:
+        context = context_key(base_params.get('context', None))
+        # the context_key hook can opt a subscription out of sharing
+        if context is None:
+            return None
+    try:
+        variables = json.dumps(base_params.get('variables', None), sort_keys=True)
+        hash(context)
+    except (TypeError, ValueError):
+        return None
+    return (base_params.get('query', None),
+            variables,
+            base_params.get('operation_name', None),
+            context)
+
+
+class SharedSubscription(object):
+    """
+    a single subscription_manager subscription and the (sid, sub_id)
+    pairs that receive its results
+    """
+    def __init__(self, key):
+        self.key = key
+        self.graphql_sub_id = None
+        # insertion ordered set of (request_id, sub_id)
+        self.subscribers = {}
+
+    def add(self, request_id, sub_id):
+        self.subscribers[(request_id, sub_id)] = True
+
+    def remove(self, request_id, sub_id):
+        """
+        drop a subscriber, returns True once nobody is left
+        """
+        self.subscribers.pop((request_id, sub_id), None)
+        return not self.subscribers
@@ -0,0 +1,27 @@
+#
+# token bucket for limiting how fast a client may send
+#
+
+
+class TokenBucket(object):
+    """
+    refills at rate tokens per second up to burst, every message takes one
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        """
+        returns False when the bucket is empty
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
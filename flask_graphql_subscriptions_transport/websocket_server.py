@@ -0,0 +1,212 @@
+#
+# the SubscriptionServer as a plain ASGI websocket app, without Socket.IO:
+# one websocket per client, whose subprotocol picks the wire protocol
+#
+
+import asyncio
+import logging
+import uuid
+
+from .async_server import AsyncSubscriptionServer, EMIT
+from .message_types import (
+    SUBSCRIPTION_MESSAGE,
+    SLOW_CONSUMER,
+    ENVELOPE_OBJECT,
+    PROTOCOL_LEGACY,
+    CLOSE_NORMAL,
+    CLOSE_TRY_AGAIN_LATER,
+    CLOSE_SUBPROTOCOL_NOT_ACCEPTABLE,
+)
+
+logger = logging.getLogger(__name__)
+
+# what the writer task is asked to do, besides EMIT
+CLOSE = 'close'
+
+
+class WebSocketSubscriptionServer(AsyncSubscriptionServer):
+    """
+    SubscriptionServer straight on websockets, mount asgi_app
+    clients offer protocols as websocket subprotocols, e.g. graphql-ws
+    clients offer graphql-transport-ws; a client offering none speaks the
+    legacy protocol, one offering only protocols the server doesn't is
+    closed with 4406
+    every frame is a single websocket message, so compression, which needs
+    Socket.IO's binary attachments, isn't available, and lifecycle messages
+    aren't sent
+    each connection has its own writer task and a queue of at most
+    max_pending_writes frames, so a slow client only holds up itself; the
+    queue is the transport backlog bounded queues wait on, and a client
+    that lets it fill up is closed with 1013
+    parse_context gets the ASGI scope
+    """
+    def __init__(self, subscription_manager, max_pending_writes=1024, **options):
+        self.max_pending_writes = max_pending_writes
+        super(WebSocketSubscriptionServer, self).__init__(subscription_manager, **options)
+        if self.compressors:
+            raise ValueError('compression needs Socket.IO binary attachments')
+
+    def init_transport(self, app, socket_options):
+        if socket_options:
+            raise TypeError('unexpected options: %s' % ', '.join(sorted(socket_options)))
+        # session id -> ASGI scope, from connect to disconnect
+        self.scopes = {}
+        # session id -> ASGI send, writer task and its queue, from accept
+        # to disconnect; the queue goes first, at a close
+        self.senders = {}
+        self.writers = {}
+        self.outboxes = {}
+        # bound on the first connect
+        self.loop = None
+
+    def register_handlers(self):
+        # asgi_app calls the handlers itself
+        pass
+
+    async def asgi_app(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'websocket':
+            await send({'type': 'http.response.start', 'status': 404,
+                        'headers': [(b'content-type', b'text/plain')]})
+            await send({'type': 'http.response.body', 'body': b'Not Found'})
+            return
+        message = await receive()
+        if message['type'] != 'websocket.connect':
+            return
+        self.bind_loop()
+        sid = uuid.uuid4().hex
+        offered = scope.get('subprotocols', None) or []
+        self.scopes[sid] = scope
+        if self.handle(sid, self.socket_connect, {'protocol': offered}) is False:
+            self.scopes.pop(sid, None)
+            # accept first, so the client gets the close code
+            await send({'type': 'websocket.accept'})
+            await send({'type': 'websocket.close',
+                        'code': CLOSE_SUBPROTOCOL_NOT_ACCEPTABLE,
+                        'reason': 'Subprotocol not acceptable'})
+            return
+        protocol = self.client_protocol(sid)
+        name = protocol.name if protocol is not None else PROTOCOL_LEGACY
+        await send({'type': 'websocket.accept', 'subprotocol': name if name in offered else None})
+        self.senders[sid] = send
+        self.outboxes[sid] = asyncio.Queue(self.max_pending_writes)
+        self.writers[sid] = self.loop.create_task(self.write_loop(sid, send, self.outboxes[sid]))
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'websocket.disconnect':
+                    break
+                if message['type'] == 'websocket.receive':
+                    data = message.get('text', None)
+                    if data is None:
+                        data = message.get('bytes', None)
+                    self.handle(sid, self.on_message, data)
+        finally:
+            self.handle(sid, self.socket_disconnect)
+            self.outboxes.pop(sid, None)
+            writer = self.writers.pop(sid, None)
+            if writer is not None:
+                writer.cancel()
+            self.senders.pop(sid, None)
+            self.scopes.pop(sid, None)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def bind_loop(self):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+
+    def enqueue(self, action):
+        # (EMIT, sid, event, frame) or (CLOSE, sid, code, reason)
+        kind, request_id, event, frame = action
+        outbox = self.outboxes.get(request_id, None)
+        if outbox is None:
+            # gone, or closing
+            return
+        if kind == CLOSE:
+            # nothing goes out after a close
+            del self.outboxes[request_id]
+        try:
+            outbox.put_nowait((kind, event, frame))
+        except asyncio.QueueFull:
+            if kind == CLOSE:
+                self.abort(request_id, event, frame)
+            else:
+                self.evicted_connections += 1
+                self.abort(request_id, CLOSE_TRY_AGAIN_LATER, SLOW_CONSUMER)
+
+    def abort(self, request_id, code, reason):
+        """
+        close a connection right away, dropping the frames it has queued
+        """
+        self.outboxes.pop(request_id, None)
+        writer = self.writers.pop(request_id, None)
+        send = self.senders.get(request_id, None)
+        if writer is None or send is None:
+            return
+        writer.cancel()
+        self.loop.create_task(self.write_close(request_id, send, code, reason))
+
+    async def write_loop(self, request_id, send, outbox):
+        while True:
+            # (EMIT, event, frame) or (CLOSE, code, reason)
+            action, event, frame = await outbox.get()
+            if action != EMIT:
+                await self.write_close(request_id, send, event, frame)
+                return
+            # lifecycle messages are Socket.IO events, with nothing to
+            # stand for them here
+            if event != SUBSCRIPTION_MESSAGE:
+                continue
+            try:
+                await send(self.websocket_message(frame))
+            except Exception:
+                # one bad frame must not stop the writer
+                logger.exception('failed to write to %s', request_id)
+
+    async def write_close(self, request_id, send, code, reason):
+        try:
+            await send({'type': 'websocket.close', 'code': code, 'reason': reason})
+        except Exception:
+            logger.exception('failed to close %s', request_id)
+
+    def websocket_message(self, frame):
+        """
+        the websocket message carrying a frame, binary for MessagePack
+        """
+        data = frame.get('data', None)
+        if isinstance(data, bytes):
+            return {'type': 'websocket.send', 'bytes': data}
+        if self.envelope == ENVELOPE_OBJECT:
+            data = self.codec.dumps(frame)
+        return {'type': 'websocket.send', 'text': data}
+
+    def current_request(self):
+        return self.scopes.get(self.current_sid(), None)
+
+    def socket_server(self):
+        return None
+
+    def transport_backlog(self, request_id):
+        """
+        frames in the connection's queue that its writer hasn't sent yet
+        """
+        outbox = self.outboxes.get(request_id, None)
+        if outbox is None:
+            return 0
+        return outbox.qsize()
+
+    def close_client(self, request_id, code=CLOSE_NORMAL, reason=''):
+        self.queue_action(CLOSE, request_id, code, reason)
+
+    def disconnect_client(self, request_id):
+        self.close_client(request_id)
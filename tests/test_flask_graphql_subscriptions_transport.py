@@ -1,12 +1,52 @@
+import asyncio
 import pytest
-from mock import Mock
+from mock import Mock, patch
 from python_graphql_subscriptions import SubscriptionManager, PubSub
 from flask_socketio import SocketIOTestClient
+from flask import request
 import json
+import gc
+import tracemalloc
+import threading
+import multiprocessing
+import queue
+import time
+import zlib
 
 from tests.app import create_app
 from tests.schema import Schema
+from flask_graphql_subscriptions_transport.codec import Codec, make_codec
+from flask_graphql_subscriptions_transport.scheduler import Scheduler
+from flask_graphql_subscriptions_transport.document_cache import DocumentCache
+from flask_graphql_subscriptions_transport.broker import make_queue_brokers
+from flask_graphql_subscriptions_transport.executor import Executor
+from flask_graphql_subscriptions_transport.instrumentation import Histogram, InMemoryInstrumentation
+from flask_graphql_subscriptions_transport.token_bucket import TokenBucket
+from flask_graphql_subscriptions_transport.sessions import ReplayBuffer, Session
+from flask_graphql_subscriptions_transport.delta import diff, apply_patch
+from flask_graphql_subscriptions_transport.msgpack_protocol import MsgpackProtocol
+from flask_graphql_subscriptions_transport.compression import (
+    ZlibCompressor,
+    make_compressors,
+    choose_compressor,
+)
+from flask_graphql_subscriptions_transport.persisted_queries import (
+    InMemoryQueryStore,
+    ManifestQueryStore,
+    query_hash,
+)
 from flask_graphql_subscriptions_transport.flask_graphql_subscriptions_transport import SubscriptionServer
+from flask_graphql_subscriptions_transport.async_server import AsyncSubscriptionServer
+from flask_graphql_subscriptions_transport.websocket_server import WebSocketSubscriptionServer
+from flask_graphql_subscriptions_transport.protocols import (
+    HANDLE,
+    SEND,
+    CLOSE,
+    LegacyProtocol,
+    GraphQLWSProtocol,
+    make_protocols,
+    choose_protocol,
+)
 from flask_graphql_subscriptions_transport.message_types import (
     SUBSCRIPTION_MESSAGE,
     SUBSCRIPTION_FAIL,
@@ -18,7 +58,24 @@ from flask_graphql_subscriptions_transport.message_types import (
     INIT,
     INIT_FAIL,
     INIT_SUCCESS,
+    BATCH,
+    ENVELOPE_STRING,
+    ENVELOPE_OBJECT,
+    OVERFLOW_DROP_OLDEST,
+    OVERFLOW_DROP_NEWEST,
+    OVERFLOW_DISCONNECT,
     PARAMS_MUST_BE_OBJECT,
+    SLOW_CONSUMER,
+    PERSISTED_QUERY_NOT_FOUND,
+    TOO_MANY_SUBSCRIPTIONS,
+    SERVER_AT_CAPACITY,
+    RATE_LIMITED,
+    SUBSCRIPTION_BATCH,
+    SUBSCRIPTION_BATCH_RESULT,
+    BATCH_PAYLOAD_MUST_BE_LIST,
+    SUBSCRIPTION_PATCH,
+    PROTOCOL_LEGACY,
+    PROTOCOL_GRAPHQL_WS,
 )
 
 ###
@@ -99,23 +156,48 @@ def basic_ss():
                             parse_context)
     return (app, ss)
 
-# should respond to the connect event by sending data
+# should respond to the connect event by sending data to that client
 def test_connect_response(basic_ss):
     app, ss = basic_ss
     ss.socketio.emit = Mock()
-    ss.socket_connect()
+    with app.test_request_context():
+        request.sid = 'sid'
+        ss.socket_connect()
     ss.socketio.emit.assert_called_once_with('message',
         {'data': 'connected'},
-        namespace=ss.namespace)
+        namespace=ss.namespace,
+        room='sid')
 
 # should respond to the disconnect event
 def test_disconnect_response(basic_ss):
     app, ss = basic_ss
     ss.socketio.emit = Mock()
-    ss.socket_disconnect()
+    with app.test_request_context():
+        request.sid = 'sid'
+        ss.socket_disconnect()
     ss.socketio.emit.assert_called_once_with('message',
         {'data': 'disconnected'},
-        namespace=ss.namespace)
+        namespace=ss.namespace,
+        room='sid')
+
+# should never broadcast lifecycle messages to the whole namespace
+def test_lifecycle_messages_not_broadcast(basic_ss):
+    app, ss = basic_ss
+    first_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    first_client.get_received(ss.namespace)
+    second_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    assert first_client.get_received(ss.namespace) == []
+    assert second_client.get_received(ss.namespace)[0]['args'] == {'data': 'connected'}
+    second_client.disconnect(namespace=ss.namespace)
+    assert first_client.get_received(ss.namespace) == []
+
+def test_lifecycle_messages_can_be_disabled(basic_ss):
+    app, ss = basic_ss
+    ss.lifecycle_messages = False
+    ss.socketio.emit = Mock()
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    test_client.disconnect(namespace=ss.namespace)
+    ss.socketio.emit.assert_not_called()
 
 # lots to do here...
 # this just tests that the on_message method gets executed
@@ -410,6 +492,26 @@ def test_send_sub_success(basic_ss):
                      namespace=ss.namespace)
     ss.send_subscription_success.assert_called_once()
 
+# the spliced frame should be exactly what encoding the message would give
+def test_encode_subscription_data(basic_ss):
+    app, ss = basic_ss
+    payload = {'data': {'testString': 'string returned'}}
+    for sub_id in [1, 'abc', None]:
+        message = {'type': SUBSCRIPTION_DATA, 'id': sub_id, 'payload': payload}
+        assert ss.encode_subscription_data(sub_id, json.dumps(payload)) == json.dumps(message)
+
+def test_fan_out_encodes_payload_once(basic_ss):
+    app, ss = basic_ss
+    ss.send_encoded = Mock()
+    payload = {'data': {'testString': 'string returned'}}
+    with patch.object(ss.codec, 'dumps', wraps=ss.codec.dumps) as dumps:
+        ss.fan_out_subscription_data([('a', 1), ('b', 2), ('c', 3)], payload)
+    assert ss.send_encoded.call_count == 3
+    assert [call[0][0] for call in dumps.call_args_list].count(payload) == 1
+    for call, (request_id, sub_id) in zip(ss.send_encoded.call_args_list, [('a', 1), ('b', 2), ('c', 3)]):
+        assert call[0][1] == request_id
+        assert json.loads(call[0][0]) == {'type': SUBSCRIPTION_DATA, 'id': sub_id, 'payload': payload}
+
 ###
 # INIT testing
 ###
@@ -438,3 +540,2539 @@ def test_send_init_fail(basic_ss):
                      namespace=ss.namespace)
     ss.send_init_result.assert_called_once()
     assert ss.send_init_result.call_args[0][0] == INIT_FAIL
+
+###
+# disconnect / teardown testing
+###
+def start_subscription(test_client, ss, sub_id):
+    test_client.emit('message',
+                     json.dumps({'type': SUBSCRIPTION_START,
+                                 'payload': 'foo',
+                                 'id': sub_id,
+                                 'query': 'query test{ testString }',
+                                 'variables': {}}),
+                     namespace=ss.namespace)
+
+def test_registry_is_keyed_by_connection(basic_ss):
+    app, ss = basic_ss
+    first_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    second_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_subscription(first_client, ss, 1)
+    start_subscription(first_client, ss, 2)
+    start_subscription(second_client, ss, 1)
+    assert len(ss.connection_subscriptions) == 2
+    assert sorted(len(subs) for subs in ss.connection_subscriptions.values()) == [1, 2]
+
+def test_disconnect_unsubscribes_everything(basic_ss):
+    app, ss = basic_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    ss.on_unsubscribe = Mock()
+    start_subscription(test_client, ss, 1)
+    start_subscription(test_client, ss, 2)
+    assert len(ss.subscription_manager.subscriptions) == 2
+    test_client.disconnect(namespace=ss.namespace)
+    assert ss.connection_subscriptions == {}
+    assert ss.subscription_manager.subscriptions == {}
+    assert ss.subscription_manager.pubsub.subscriptions == {}
+    assert ss.on_unsubscribe.call_count == 2
+
+def test_disconnect_only_touches_its_connection(basic_ss):
+    app, ss = basic_ss
+    first_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    second_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_subscription(first_client, ss, 1)
+    start_subscription(second_client, ss, 1)
+    first_client.disconnect(namespace=ss.namespace)
+    assert len(ss.connection_subscriptions) == 1
+    assert len(ss.subscription_manager.subscriptions) == 1
+
+def test_disconnect_uses_bulk_unsubscribe(basic_ss):
+    app, ss = basic_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_subscription(test_client, ss, 1)
+    start_subscription(test_client, ss, 2)
+    ss.subscription_manager.unsubscribe = Mock()
+    ss.subscription_manager.unsubscribe_many = Mock()
+    test_client.disconnect(namespace=ss.namespace)
+    ss.subscription_manager.unsubscribe_many.assert_called_once()
+    assert sorted(ss.subscription_manager.unsubscribe_many.call_args[0][0]) == [1, 2]
+    ss.subscription_manager.unsubscribe.assert_not_called()
+
+def test_bulk_unsubscribe_survives_missing_subscriptions(basic_ss):
+    app, ss = basic_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_subscription(test_client, ss, 1)
+    start_subscription(test_client, ss, 2)
+    # yank one out from under the server
+    ss.subscription_manager.unsubscribe(1)
+    test_client.disconnect(namespace=ss.namespace)
+    assert ss.subscription_manager.subscriptions == {}
+
+def test_bulk_unsubscribe_logs_failures_and_carries_on(basic_ss, caplog):
+    app, ss = basic_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_subscription(test_client, ss, 1)
+    start_subscription(test_client, ss, 2)
+    unsubscribe = ss.subscription_manager.unsubscribe
+
+    def failing_unsubscribe(sub_id):
+        if sub_id == 1:
+            raise ValueError('pubsub is down')
+        unsubscribe(sub_id)
+    ss.subscription_manager.unsubscribe = failing_unsubscribe
+    test_client.disconnect(namespace=ss.namespace)
+    assert list(ss.subscription_manager.subscriptions) == [1]
+    assert [record.exc_info[0] for record in caplog.records] == [ValueError]
+
+# open and drop 10k connections, nothing should be left behind
+def test_connection_churn_soak(basic_ss):
+    app, ss = basic_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    # warm up so lazily created state doesn't count as growth
+    start_subscription(test_client, ss, 1)
+    test_client.disconnect(namespace=ss.namespace)
+    test_client.queue = []
+    gc.collect()
+    baseline = len(gc.get_objects())
+    for i in range(10000):
+        test_client.connect(namespace=ss.namespace)
+        start_subscription(test_client, ss, 1)
+        test_client.disconnect(namespace=ss.namespace)
+        test_client.queue = []
+    gc.collect()
+    assert ss.connection_subscriptions == {}
+    assert ss.subscription_manager.subscriptions == {}
+    assert ss.subscription_manager.pubsub.subscriptions == {}
+    # a leak would be at least one object per connection
+    assert len(gc.get_objects()) - baseline < 1000
+
+###
+# shared subscription testing
+###
+@pytest.fixture
+def shared_ss(basic_ss):
+    app, ss = basic_ss
+    ss.share_subscriptions = True
+    # an empty context, the same for everyone
+    ss.parse_context = None
+    return (app, ss)
+
+def start_shared_subscription(test_client, ss, sub_id, variables=None):
+    test_client.emit('message',
+                     json.dumps({'type': SUBSCRIPTION_START,
+                                 'id': sub_id,
+                                 'query': 'subscription test{ test_subscription }',
+                                 'variables': variables or {}}),
+                     namespace=ss.namespace)
+
+def test_identical_subscriptions_share_one_upstream(shared_ss):
+    app, ss = shared_ss
+    clients = [SocketIOTestClient(app, ss.socketio, namespace=ss.namespace) for i in range(3)]
+    for i, test_client in enumerate(clients):
+        start_shared_subscription(test_client, ss, i)
+    assert len(ss.subscription_manager.subscriptions) == 1
+    assert len(ss.shared_subscriptions) == 1
+
+def test_shared_subscription_executes_once(shared_ss):
+    app, ss = shared_ss
+    clients = [SocketIOTestClient(app, ss.socketio, namespace=ss.namespace) for i in range(3)]
+    for i, test_client in enumerate(clients):
+        start_shared_subscription(test_client, ss, i)
+        test_client.get_received(ss.namespace)
+    resolver = Mock(return_value='published')
+    field = ss.subscription_manager.schema.get_subscription_type().fields['test_subscription']
+    with patch.object(field, 'resolver', resolver):
+        ss.subscription_manager.publish('test_subscription', 'payload')
+    resolver.assert_called_once()
+    for i, test_client in enumerate(clients):
+        received = test_client.get_received(ss.namespace)
+        assert len(received) == 1
+        assert json.loads(received[0]['args'][0]['data']) == {
+            'type': SUBSCRIPTION_DATA,
+            'id': i,
+            'payload': {'data': {'test_subscription': 'published'}},
+        }
+
+def test_different_variables_are_not_shared(shared_ss):
+    app, ss = shared_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_shared_subscription(test_client, ss, 1, {'foo': 1})
+    start_shared_subscription(test_client, ss, 2, {'foo': 2})
+    assert len(ss.subscription_manager.subscriptions) == 2
+
+def test_context_key_separates_subscriptions(shared_ss):
+    app, ss = shared_ss
+    contexts = iter([{'user': 1}, {'user': 2}, {'user': 1}])
+    ss.parse_context = lambda request: next(contexts)
+    ss.context_key = lambda context: context['user']
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    for i in range(3):
+        start_shared_subscription(test_client, ss, i)
+    assert len(ss.subscription_manager.subscriptions) == 2
+
+def test_contexts_not_shared_without_context_key(shared_ss):
+    app, ss = shared_ss
+    contexts = iter([{'user': 'alice'}, {'user': 'mallory'}])
+    ss.parse_context = lambda request: next(contexts)
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_shared_subscription(test_client, ss, 1)
+    start_shared_subscription(test_client, ss, 2)
+    assert len(ss.subscription_manager.subscriptions) == 2
+    assert ss.shared_subscriptions == {}
+
+def test_context_key_can_opt_out_of_sharing(shared_ss):
+    app, ss = shared_ss
+    ss.context_key = lambda context: None
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_shared_subscription(test_client, ss, 1)
+    start_shared_subscription(test_client, ss, 2)
+    assert len(ss.subscription_manager.subscriptions) == 2
+    assert ss.shared_subscriptions == {}
+
+def test_shared_subscription_refcounting(shared_ss):
+    app, ss = shared_ss
+    first_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    second_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_shared_subscription(first_client, ss, 1)
+    start_shared_subscription(second_client, ss, 1)
+    ss.on_unsubscribe = Mock()
+    first_client.emit('message',
+                      json.dumps({'type': SUBSCRIPTION_END, 'id': 1}),
+                      namespace=ss.namespace)
+    # still in use by the second client
+    assert len(ss.subscription_manager.subscriptions) == 1
+    ss.on_unsubscribe.assert_not_called()
+    second_client.disconnect(namespace=ss.namespace)
+    assert ss.subscription_manager.subscriptions == {}
+    assert ss.shared_subscriptions == {}
+    assert ss.shared_by_id == {}
+    ss.on_unsubscribe.assert_called_once()
+
+###
+# codec testing
+###
+def test_defaults_to_stdlib_json(basic_ss):
+    app, ss = basic_ss
+    assert ss.codec.name == 'json'
+    assert ss.codec.loads(ss.codec.dumps({'a': [1, 2]})) == {'a': [1, 2]}
+
+def test_codec_from_module_name():
+    orjson = pytest.importorskip('orjson')
+    codec = make_codec('orjson')
+    assert codec.name == 'orjson'
+    # orjson produces bytes, frames must stay text
+    assert codec.dumps({'a': 1}) == orjson.dumps({'a': 1}).decode('utf-8')
+
+def test_missing_codec_module_falls_back_to_stdlib():
+    codec = make_codec('not_an_installed_json_module')
+    assert codec.name == 'json'
+    assert codec.loads('{"a": 1}') == {'a': 1}
+
+def test_codec_must_have_loads_and_dumps():
+    with pytest.raises(ValueError):
+        make_codec(object())
+
+def test_custom_codec_used_for_messages(basic_ss):
+    app, ss = basic_ss
+    ss.codec = Codec(loads=Mock(wraps=json.loads),
+                     dumps=Mock(side_effect=lambda obj: json.dumps(obj).encode('utf-8')))
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    test_client.get_received(ss.namespace)
+    test_client.emit('message',
+                     json.dumps({'type': INIT, 'payload': 'foo'}),
+                     namespace=ss.namespace)
+    ss.codec._loads.assert_called_once()
+    ss.codec._dumps.assert_called_once()
+    received = test_client.get_received(ss.namespace)
+    assert json.loads(received[0]['args'][0]['data']) == {'type': INIT_SUCCESS, 'payload': {}}
+
+###
+# envelope testing
+###
+@pytest.fixture
+def object_ss(basic_ss):
+    app, ss = basic_ss
+    ss.envelope = ENVELOPE_OBJECT
+    return (app, ss)
+
+def test_rejects_unknown_envelope():
+    app = create_app()
+    sub_manager = SubscriptionManager(Schema, PubSub(), {})
+    with pytest.raises(ValueError):
+        SubscriptionServer(app, sub_manager, envelope='carrier pigeon')
+
+def test_string_envelope_is_default(basic_ss):
+    app, ss = basic_ss
+    assert ss.envelope == ENVELOPE_STRING
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    test_client.get_received(ss.namespace)
+    test_client.emit('message',
+                     json.dumps({'type': INIT, 'payload': 'foo'}),
+                     namespace=ss.namespace)
+    frame = test_client.get_received(ss.namespace)[0]['args'][0]
+    assert json.loads(frame['data']) == {'type': INIT_SUCCESS, 'payload': {}}
+
+def test_object_envelope_has_no_inner_string(object_ss):
+    app, ss = object_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    test_client.get_received(ss.namespace)
+    # objects are accepted as well as strings
+    test_client.emit('message',
+                     {'type': INIT, 'payload': 'foo'},
+                     namespace=ss.namespace)
+    test_client.emit('message',
+                     json.dumps({'type': SUBSCRIPTION_START,
+                                 'id': 1,
+                                 'query': 'subscription test{ test_subscription }',
+                                 'variables': {}}),
+                     namespace=ss.namespace)
+    ss.subscription_manager.publish('test_subscription', 'published')
+    frames = [received['args'][0] for received in test_client.get_received(ss.namespace)]
+    assert frames == [
+        {'type': INIT_SUCCESS, 'payload': {}},
+        {'type': SUBSCRIPTION_SUCCESS, 'id': 1},
+        {'type': SUBSCRIPTION_DATA, 'id': 1, 'payload': {'data': {'test_subscription': 'published'}}},
+    ]
+
+def test_object_envelope_fan_out(object_ss):
+    app, ss = object_ss
+    ss.emit_frame = Mock()
+    payload = {'data': {'testString': 'string returned'}}
+    ss.fan_out_subscription_data([('a', 1), ('b', 2)], payload)
+    assert ss.emit_frame.call_args_list[1][0] == (
+        {'type': SUBSCRIPTION_DATA, 'id': 2, 'payload': payload}, 'b')
+
+###
+# scheduler testing
+###
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_scheduler_runs_due_timers_in_order():
+    clock = FakeClock()
+    scheduler = Scheduler(clock=clock)
+    calls = []
+    scheduler.call_later(2, calls.append, 'second')
+    scheduler.call_later(1, calls.append, 'first')
+    scheduler.call_later(3, calls.append, 'third')
+    clock.now = 2
+    assert scheduler.run_pending() == 2
+    assert calls == ['first', 'second']
+    assert len(scheduler) == 1
+    assert scheduler.next_deadline() == 3
+
+def test_scheduler_cancel():
+    clock = FakeClock()
+    scheduler = Scheduler(clock=clock)
+    func = Mock()
+    timer = scheduler.call_later(1, func)
+    timer.cancel()
+    clock.now = 1
+    assert scheduler.run_pending() == 0
+    func.assert_not_called()
+
+def test_scheduler_survives_failing_timer(caplog):
+    clock = FakeClock()
+    scheduler = Scheduler(clock=clock)
+    func = Mock()
+    scheduler.call_later(1, Mock(side_effect=ValueError))
+    scheduler.call_later(1, func)
+    clock.now = 1
+    scheduler.run_pending()
+    func.assert_called_once()
+    # logged, not swallowed
+    assert [record.exc_info[0] for record in caplog.records] == [ValueError]
+
+def test_scheduler_starts_one_background_task():
+    start = Mock()
+    scheduler = Scheduler(start)
+    for i in range(10):
+        scheduler.call_later(i, Mock())
+    start.assert_called_once()
+
+def test_scheduler_background_task_runs_timers():
+    scheduler = Scheduler(lambda target: threading.Thread(target=target, daemon=True).start())
+    done = threading.Event()
+    scheduler.call_later(0.01, done.set)
+    assert done.wait(2)
+
+###
+# conflation testing
+###
+@pytest.fixture
+def conflated_ss(basic_ss):
+    app, ss = basic_ss
+    clock = FakeClock()
+    ss.scheduler.start_background_task = None
+    ss.scheduler.clock = clock
+    ss.conflate_interval = 1
+    return (app, ss, clock)
+
+def received_data(test_client, ss):
+    frames = [json.loads(received['args'][0]['data']) for received in test_client.get_received(ss.namespace)
+              if received['name'] == SUBSCRIPTION_MESSAGE]
+    return [frame['payload']['data'] for frame in frames if frame['type'] == SUBSCRIPTION_DATA]
+
+def test_conflation_sends_first_then_latest(conflated_ss):
+    app, ss, clock = conflated_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_shared_subscription(test_client, ss, 1)
+    for value in ['a', 'b', 'c', 'd']:
+        ss.subscription_manager.publish('test_subscription', value)
+    # only the first goes out straight away
+    assert received_data(test_client, ss) == [{'test_subscription': 'a'}]
+    clock.now = 1
+    ss.scheduler.run_pending()
+    assert received_data(test_client, ss) == [{'test_subscription': 'd'}]
+    assert ss.conflator.conflated == 2
+    # window with nothing pending closes quietly
+    clock.now = 2
+    ss.scheduler.run_pending()
+    assert received_data(test_client, ss) == []
+    assert ss.conflator.windows == {}
+
+def test_conflation_per_subscription_from_on_subscribe(conflated_ss):
+    app, ss, clock = conflated_ss
+    ss.conflate_interval = None
+    def on_subscribe(parsed_message, base_params):
+        if parsed_message['id'] == 2:
+            base_params['conflate_interval'] = 5
+        return base_params
+    ss.on_subscribe = on_subscribe
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    ss.subscription_manager.subscribe = Mock(wraps=ss.subscription_manager.subscribe)
+    start_shared_subscription(test_client, ss, 1)
+    start_shared_subscription(test_client, ss, 2)
+    assert 'conflate_interval' not in ss.subscription_manager.subscribe.call_args[1]
+    assert [(sub_id, interval) for (request_id, sub_id), interval in ss.conflate_intervals.items()] == [(2, 5)]
+    test_client.get_received(ss.namespace)
+    for value in ['a', 'b']:
+        ss.subscription_manager.publish('test_subscription', value)
+    # unconflated subscription gets everything
+    assert received_data(test_client, ss) == [{'test_subscription': 'a'},
+                                              {'test_subscription': 'a'},
+                                              {'test_subscription': 'b'}]
+
+def test_conflation_with_shared_subscriptions(conflated_ss):
+    app, ss, clock = conflated_ss
+    ss.share_subscriptions = True
+    # an empty context, the same for everyone
+    ss.parse_context = None
+    clients = [SocketIOTestClient(app, ss.socketio, namespace=ss.namespace) for i in range(2)]
+    for test_client in clients:
+        start_shared_subscription(test_client, ss, 1)
+        test_client.get_received(ss.namespace)
+    for value in ['a', 'b', 'c']:
+        ss.subscription_manager.publish('test_subscription', value)
+    clock.now = 1
+    ss.scheduler.run_pending()
+    for test_client in clients:
+        assert received_data(test_client, ss) == [{'test_subscription': 'a'}, {'test_subscription': 'c'}]
+
+def test_conflation_pending_dropped_on_end(conflated_ss):
+    app, ss, clock = conflated_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_shared_subscription(test_client, ss, 1)
+    ss.subscription_manager.publish('test_subscription', 'a')
+    ss.subscription_manager.publish('test_subscription', 'b')
+    test_client.disconnect(namespace=ss.namespace)
+    assert ss.conflate_intervals == {}
+    assert ss.conflator.windows == {}
+    ss.send_subscription_data = Mock()
+    clock.now = 1
+    ss.scheduler.run_pending()
+    ss.send_subscription_data.assert_not_called()
+
+###
+# batching testing
+###
+@pytest.fixture
+def batching_ss(basic_ss):
+    app, ss = basic_ss
+    clock = FakeClock()
+    ss.scheduler.start_background_task = None
+    ss.scheduler.clock = clock
+    ss.batch_window = 0.005
+    return (app, ss, clock)
+
+def init_client(test_client, ss, **options):
+    message = {'type': INIT, 'payload': 'foo'}
+    message.update(options)
+    test_client.emit('message', json.dumps(message), namespace=ss.namespace)
+
+def received_messages(test_client, ss):
+    return [json.loads(received['args'][0]['data']) for received in test_client.get_received(ss.namespace)
+            if received['name'] == SUBSCRIPTION_MESSAGE]
+
+def test_batching_negotiated_at_init(batching_ss):
+    app, ss, clock = batching_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    init_client(test_client, ss, batch=True)
+    assert received_messages(test_client, ss) == [{'type': INIT_SUCCESS, 'payload': {'batch': True}}]
+
+def test_batching_not_offered_when_disabled(basic_ss):
+    app, ss = basic_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    init_client(test_client, ss, batch=True)
+    assert received_messages(test_client, ss) == [{'type': INIT_SUCCESS, 'payload': {}}]
+    assert ss.connections[list(ss.connections)[0]].batch is None
+
+def test_frames_batched_per_connection(batching_ss):
+    app, ss, clock = batching_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    init_client(test_client, ss, batch=True)
+    for sub_id in range(3):
+        start_shared_subscription(test_client, ss, sub_id)
+    test_client.get_received(ss.namespace)
+    clock.now = 0.005
+    ss.scheduler.run_pending()
+    # the three SUBSCRIPTION_SUCCESS frames
+    assert received_messages(test_client, ss) == [
+        {'type': BATCH, 'payload': [{'type': SUBSCRIPTION_SUCCESS, 'id': sub_id} for sub_id in range(3)]}]
+    ss.subscription_manager.publish('test_subscription', 'published')
+    assert received_messages(test_client, ss) == []
+    clock.now = 0.01
+    ss.scheduler.run_pending()
+    batch = received_messages(test_client, ss)
+    assert len(batch) == 1
+    assert [message['id'] for message in batch[0]['payload']] == [0, 1, 2]
+    assert batch[0]['payload'][0]['payload'] == {'data': {'test_subscription': 'published'}}
+
+def test_batch_flushed_when_full(batching_ss):
+    app, ss, clock = batching_ss
+    ss.batch_size = 2
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    init_client(test_client, ss, batch=True)
+    test_client.get_received(ss.namespace)
+    for sub_id in range(3):
+        start_shared_subscription(test_client, ss, sub_id)
+    assert [len(batch['payload']) for batch in received_messages(test_client, ss)] == [2]
+    clock.now = 0.005
+    ss.scheduler.run_pending()
+    # a lone message isn't wrapped
+    assert received_messages(test_client, ss) == [{'type': SUBSCRIPTION_SUCCESS, 'id': 2}]
+
+def test_clients_without_batching_get_single_frames(batching_ss):
+    app, ss, clock = batching_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    init_client(test_client, ss)
+    for sub_id in range(2):
+        start_shared_subscription(test_client, ss, sub_id)
+    assert [message['type'] for message in received_messages(test_client, ss)] == [
+        INIT_SUCCESS, SUBSCRIPTION_SUCCESS, SUBSCRIPTION_SUCCESS]
+
+def test_object_envelope_batch(batching_ss):
+    app, ss, clock = batching_ss
+    ss.envelope = ENVELOPE_OBJECT
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    init_client(test_client, ss, batch=True)
+    for sub_id in range(2):
+        start_shared_subscription(test_client, ss, sub_id)
+    clock.now = 0.005
+    ss.scheduler.run_pending()
+    frames = [received['args'][0] for received in test_client.get_received(ss.namespace)
+              if received['name'] == SUBSCRIPTION_MESSAGE]
+    assert frames[-1] == {'type': BATCH, 'payload': [{'type': SUBSCRIPTION_SUCCESS, 'id': 0},
+                                                      {'type': SUBSCRIPTION_SUCCESS, 'id': 1}]}
+
+def test_pending_batch_dropped_on_disconnect(batching_ss):
+    app, ss, clock = batching_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    init_client(test_client, ss, batch=True)
+    start_shared_subscription(test_client, ss, 1)
+    test_client.disconnect(namespace=ss.namespace)
+    assert ss.connections == {}
+    ss.emit_frame = Mock()
+    clock.now = 0.005
+    ss.scheduler.run_pending()
+    ss.emit_frame.assert_not_called()
+
+###
+# bounded send queue testing
+###
+@pytest.fixture
+def queued_ss(basic_ss):
+    app, ss = basic_ss
+    clock = FakeClock()
+    ss.scheduler.start_background_task = None
+    ss.scheduler.clock = clock
+    ss.max_queued_frames = 3
+    return (app, ss, clock)
+
+# a client that stopped reading, engine.io is holding everything for it
+def stall(ss):
+    ss.transport_backlog = lambda request_id: ss.max_transport_backlog
+
+def unstall(ss):
+    ss.transport_backlog = lambda request_id: 0
+
+def publish_values(ss, values):
+    for value in values:
+        ss.subscription_manager.publish('test_subscription', value)
+
+def test_rejects_unknown_overflow_policy():
+    app = create_app()
+    sub_manager = SubscriptionManager(Schema, PubSub(), {})
+    with pytest.raises(ValueError):
+        SubscriptionServer(app, sub_manager, overflow_policy='shrug')
+
+def test_queue_passes_frames_through_when_client_keeps_up(queued_ss):
+    app, ss, clock = queued_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_shared_subscription(test_client, ss, 1)
+    test_client.get_received(ss.namespace)
+    publish_values(ss, ['a', 'b', 'c', 'd', 'e'])
+    assert len(received_data(test_client, ss)) == 5
+    assert ss.dropped_frames == 0
+
+def test_queue_drop_oldest(queued_ss):
+    app, ss, clock = queued_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_shared_subscription(test_client, ss, 1)
+    test_client.get_received(ss.namespace)
+    stall(ss)
+    publish_values(ss, ['a', 'b', 'c', 'd', 'e'])
+    assert received_data(test_client, ss) == []
+    assert ss.dropped_frames == 2
+    unstall(ss)
+    clock.now = ss.drain_interval
+    ss.scheduler.run_pending()
+    assert received_data(test_client, ss) == [{'test_subscription': value} for value in ['c', 'd', 'e']]
+
+def test_queue_drop_newest(queued_ss):
+    app, ss, clock = queued_ss
+    ss.overflow_policy = OVERFLOW_DROP_NEWEST
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_shared_subscription(test_client, ss, 1)
+    test_client.get_received(ss.namespace)
+    stall(ss)
+    publish_values(ss, ['a', 'b', 'c', 'd', 'e'])
+    unstall(ss)
+    clock.now = ss.drain_interval
+    ss.scheduler.run_pending()
+    assert received_data(test_client, ss) == [{'test_subscription': value} for value in ['a', 'b', 'c']]
+    assert list(ss.connections.values())[0].dropped == 2
+
+def test_queue_disconnects_slow_consumer(queued_ss):
+    app, ss, clock = queued_ss
+    ss.overflow_policy = OVERFLOW_DISCONNECT
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_shared_subscription(test_client, ss, 1)
+    test_client.get_received(ss.namespace)
+    stall(ss)
+    publish_values(ss, ['a', 'b', 'c', 'd'])
+    assert not test_client.is_connected(ss.namespace)
+    assert ss.evicted_connections == 1
+    assert ss.connections == {}
+    assert ss.connection_subscriptions == {}
+    assert ss.subscription_manager.subscriptions == {}
+    fail = [json.loads(received['args'][0]['data']) for received in test_client.queue
+            if received['name'] == SUBSCRIPTION_MESSAGE][-1]
+    assert fail == {'type': SUBSCRIPTION_FAIL, 'id': None, 'payload': SLOW_CONSUMER}
+
+def test_non_reading_client_memory_stays_bounded(queued_ss):
+    app, ss, clock = queued_ss
+    ss.max_queued_frames = 100
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_shared_subscription(test_client, ss, 1)
+    stall(ss)
+    publish_values(ss, range(200))
+    tracemalloc.start()
+    publish_values(ss, range(1000))
+    halfway, peak = tracemalloc.get_traced_memory()
+    publish_values(ss, range(1000))
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(list(ss.connections.values())[0].outbox) == 100
+    assert ss.dropped_frames == 2100
+    # another thousand publishes cost nothing once the queue is full
+    assert current - halfway < 32 * 1024
+
+###
+# keepalive testing
+###
+@pytest.fixture
+def keepalive_ss(basic_ss):
+    app, ss = basic_ss
+    clock = FakeClock()
+    ss.scheduler.start_background_task = None
+    ss.scheduler.clock = clock
+    ss.keepalive_interval = 10
+    return (app, ss, clock)
+
+def advance(ss, clock, seconds):
+    clock.now += seconds
+    ss.scheduler.run_pending()
+
+def received_types(test_client, ss):
+    return [message['type'] for message in received_messages(test_client, ss)]
+
+def test_keepalive_sent_to_idle_connection(keepalive_ss):
+    app, ss, clock = keepalive_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    test_client.get_received(ss.namespace)
+    advance(ss, clock, 5)
+    assert received_types(test_client, ss) == []
+    advance(ss, clock, 5)
+    assert received_types(test_client, ss) == [KEEPALIVE]
+    # the keepalive itself counts as activity
+    advance(ss, clock, 5)
+    assert received_types(test_client, ss) == []
+    advance(ss, clock, 5)
+    assert received_types(test_client, ss) == [KEEPALIVE]
+
+def test_keepalive_skipped_for_busy_connection(keepalive_ss):
+    app, ss, clock = keepalive_ss
+    busy_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    idle_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_shared_subscription(busy_client, ss, 1)
+    busy_client.get_received(ss.namespace)
+    idle_client.get_received(ss.namespace)
+    for i in range(4):
+        advance(ss, clock, 5)
+        ss.subscription_manager.publish('test_subscription', 'value')
+    assert KEEPALIVE not in received_types(busy_client, ss)
+    assert received_types(idle_client, ss).count(KEEPALIVE) == 2
+
+def test_keepalive_inbound_messages_count_as_activity(keepalive_ss):
+    app, ss, clock = keepalive_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    advance(ss, clock, 5)
+    test_client.emit('message', json.dumps({'type': SUBSCRIPTION_END, 'id': 1}), namespace=ss.namespace)
+    test_client.get_received(ss.namespace)
+    advance(ss, clock, 5)
+    assert received_types(test_client, ss) == []
+
+# one sweep timer, no matter how many connections there are
+def test_keepalive_timer_overhead_is_flat(keepalive_ss):
+    app, ss, clock = keepalive_ss
+    start = Mock()
+    ss.scheduler.start_background_task = start
+    timer_counts = []
+    clients = []
+    for count in [1, 10, 100]:
+        while len(clients) < count:
+            clients.append(SocketIOTestClient(app, ss.socketio, namespace=ss.namespace))
+        timer_counts.append(len(ss.scheduler))
+    assert timer_counts == [1, 1, 1]
+    start.assert_called_once()
+    advance(ss, clock, 10)
+    assert len(ss.scheduler) == 1
+    for test_client in clients:
+        assert received_types(test_client, ss) == [KEEPALIVE]
+
+def test_keepalive_stops_without_connections(keepalive_ss):
+    app, ss, clock = keepalive_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    test_client.disconnect(namespace=ss.namespace)
+    advance(ss, clock, 5)
+    assert len(ss.scheduler) == 0
+    assert ss.keepalive_timer is None
+
+def test_no_keepalive_by_default(basic_ss):
+    app, ss = basic_ss
+    SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    assert len(ss.scheduler) == 0
+
+###
+# document cache testing
+###
+@pytest.fixture
+def cached_ss(basic_ss):
+    app, ss = basic_ss
+    ss.document_cache = DocumentCache(ss.subscription_manager.schema, 2)
+    return (app, ss)
+
+def test_no_document_cache_by_default(basic_ss):
+    app, ss = basic_ss
+    assert ss.document_cache is None
+
+def test_document_cache_size_option():
+    app = create_app()
+    sub_manager = SubscriptionManager(Schema, PubSub(), {})
+    ss = SubscriptionServer(app, sub_manager, document_cache_size=5)
+    assert ss.document_cache.max_size == 5
+    assert ss.document_cache.schema is Schema
+
+def test_document_cache_hits_and_misses():
+    cache = DocumentCache(Schema, 10)
+    first = cache.get('subscription test{ test_subscription }')
+    second = cache.get('subscription test{ test_subscription }')
+    assert first is second
+    assert first.errors == []
+    assert cache.stats() == {'size': 1, 'max_size': 10, 'hits': 1, 'misses': 1, 'evictions': 0}
+
+def test_document_cache_caches_invalid_documents():
+    cache = DocumentCache(Schema, 10)
+    assert cache.get('query test{ unknownField }').errors
+    syntax_error = cache.get('subscription test{')
+    assert syntax_error.document is None
+    assert syntax_error.errors
+
+def test_document_cache_evicts_least_recently_used():
+    cache = DocumentCache(Schema, 2)
+    cache.get('query a{ testString }')
+    cache.get('query b{ testString }')
+    cache.get('query a{ testString }')
+    cache.get('query c{ testString }')
+    assert 'query a{ testString }' in cache
+    assert 'query b{ testString }' not in cache
+    assert cache.evictions == 1
+    assert len(cache) == 2
+
+def test_invalid_document_rejected_before_subscribe(cached_ss):
+    app, ss = cached_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    ss.subscription_manager.subscribe = Mock()
+    ss.send_subscription_fail = Mock()
+    for i in range(2):
+        test_client.emit('message',
+                         json.dumps({'type': SUBSCRIPTION_START,
+                                     'id': i,
+                                     'query': 'query test{ unknownField }',
+                                     'variables': {}}),
+                         namespace=ss.namespace)
+    ss.subscription_manager.subscribe.assert_not_called()
+    assert ss.send_subscription_fail.call_count == 2
+    assert ss.document_cache.hits == 1
+
+def test_valid_document_subscribed_without_reparsing(cached_ss):
+    app, ss = cached_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    # the manager's own parse never runs, on subscribe or on publish
+    with patch('python_graphql_subscriptions.python_graphql_subscriptions.parse', side_effect=AssertionError):
+        for i in range(2):
+            start_shared_subscription(test_client, ss, i)
+        assert received_messages(test_client, ss) == [{'type': SUBSCRIPTION_SUCCESS, 'id': 0},
+                                                      {'type': SUBSCRIPTION_SUCCESS, 'id': 1}]
+        ss.subscription_manager.publish('test_subscription', 'a')
+    assert [message['payload'] for message in received_messages(test_client, ss)] == \
+        [{'data': {'test_subscription': 'a'}}] * 2
+    assert ss.document_cache.stats()['hits'] == 1
+    assert ss.document_cache.misses == 1
+    test_client.disconnect(namespace=ss.namespace)
+    assert ss.subscription_manager.subscriptions == {}
+    assert ss.subscription_manager.pubsub.subscriptions == {}
+
+def test_cached_document_keeps_setup_functions_and_variables(cached_ss):
+    app, ss = cached_ss
+    ss.subscription_manager.setup_functions['test_filter_sub'] = lambda options, args, name: {
+        'filter_sub': {'filter': lambda root, context, **variables: root == args['filter_bool']},
+    }
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    test_client.emit('message',
+                     json.dumps({'type': SUBSCRIPTION_START,
+                                 'id': 1,
+                                 'query': 'subscription s($f: Boolean) { test_filter_sub(filter_bool: $f) }',
+                                 'variables': {'f': True}}),
+                     namespace=ss.namespace)
+    received_messages(test_client, ss)
+    ss.subscription_manager.publish('filter_sub', False)
+    assert received_messages(test_client, ss) == []
+    ss.subscription_manager.publish('filter_sub', True)
+    assert received_messages(test_client, ss) == [
+        {'type': SUBSCRIPTION_DATA, 'id': 1, 'payload': {'data': {'test_filter_sub': 'SUCCESS'}}}]
+
+def test_overridden_subscribe_still_gets_the_text(cached_ss):
+    app, ss = cached_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    ss.subscription_manager.subscribe = Mock(return_value=1)
+    start_shared_subscription(test_client, ss, 1)
+    assert ss.subscription_manager.subscribe.call_args[1]['query'] == 'subscription test{ test_subscription }'
+
+###
+# persisted queries
+###
+TEST_QUERY = 'subscription test{ test_subscription }'
+
+@pytest.fixture
+def persisted_ss():
+    app = create_app()
+    sub_manager = SubscriptionManager(Schema, PubSub(), {})
+    ss = SubscriptionServer(app, sub_manager, query_store=InMemoryQueryStore([TEST_QUERY]))
+    return (app, ss)
+
+def start_persisted_subscription(test_client, ss, sub_id, query_id):
+    test_client.emit('message',
+                     json.dumps({'type': SUBSCRIPTION_START,
+                                 'id': sub_id,
+                                 'query_id': query_id,
+                                 'variables': {}}),
+                     namespace=ss.namespace)
+
+def test_query_store_keys_lists_by_hash():
+    store = InMemoryQueryStore([TEST_QUERY])
+    assert store.get(query_hash(TEST_QUERY)) == TEST_QUERY
+    assert store.get('nope') is None
+    assert len(store) == 1
+
+def test_manifest_query_store(tmp_path):
+    as_dict = tmp_path / 'dict.json'
+    as_dict.write_text(json.dumps({'test': TEST_QUERY}))
+    assert ManifestQueryStore(str(as_dict)).get('test') == TEST_QUERY
+    as_list = tmp_path / 'list.json'
+    as_list.write_text(json.dumps([TEST_QUERY]))
+    assert ManifestQueryStore(str(as_list)).get(query_hash(TEST_QUERY)) == TEST_QUERY
+
+def test_invalid_persisted_query_fails_at_boot():
+    app = create_app()
+    sub_manager = SubscriptionManager(Schema, PubSub(), {})
+    store = InMemoryQueryStore({'good': TEST_QUERY, 'bad': 'query test{ unknownField }'})
+    with pytest.raises(ValueError, match='bad'):
+        SubscriptionServer(app, sub_manager, query_store=store)
+
+def test_persisted_queries_warm_document_cache():
+    app = create_app()
+    sub_manager = SubscriptionManager(Schema, PubSub(), {})
+    ss = SubscriptionServer(app, sub_manager, document_cache_size=10,
+                            query_store=InMemoryQueryStore([TEST_QUERY]))
+    assert TEST_QUERY in ss.document_cache
+
+def test_subscription_started_by_query_id(persisted_ss):
+    app, ss = persisted_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_persisted_subscription(test_client, ss, 1, query_hash(TEST_QUERY))
+    assert received_messages(test_client, ss) == [{'type': SUBSCRIPTION_SUCCESS, 'id': 1}]
+    ss.subscription_manager.publish('test_subscription', 'a')
+    assert received_data(test_client, ss) == [{'test_subscription': 'a'}]
+
+def test_unknown_query_id_fails(persisted_ss):
+    app, ss = persisted_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_persisted_subscription(test_client, ss, 1, 'nope')
+    assert received_messages(test_client, ss) == [{'type': SUBSCRIPTION_FAIL,
+                                                   'id': 1,
+                                                   'payload': PERSISTED_QUERY_NOT_FOUND}]
+    assert len(ss.subscription_manager.subscriptions) == 0
+
+def test_full_query_still_accepted_with_query_store(persisted_ss):
+    app, ss = persisted_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_shared_subscription(test_client, ss, 1)
+    assert len(ss.subscription_manager.subscriptions) == 1
+
+###
+# per-connection context
+###
+@pytest.fixture
+def context_ss(basic_ss):
+    app, ss = basic_ss
+    ss.context_per_connection = True
+    ss.parse_context = Mock(side_effect=lambda request, payload: {'payload': payload})
+    return (app, ss)
+
+def test_context_parsed_once_per_connection(context_ss):
+    app, ss = context_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    init_client(test_client, ss)
+    for i in range(100):
+        start_shared_subscription(test_client, ss, i)
+    assert len(ss.subscription_manager.subscriptions) == 100
+    assert ss.parse_context.call_count == 1
+    # the INIT payload is handed to parse_context
+    assert ss.parse_context.call_args[0][1] == 'foo'
+
+def test_context_parsed_lazily_without_init(context_ss):
+    app, ss = context_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    for i in range(3):
+        start_shared_subscription(test_client, ss, i)
+    assert ss.parse_context.call_count == 1
+    assert ss.parse_context.call_args[0][1] is None
+
+def test_invalidated_context_parsed_again(context_ss):
+    app, ss = context_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    init_client(test_client, ss)
+    start_shared_subscription(test_client, ss, 1)
+    sid = list(ss.connections)[0]
+    ss.invalidate_context(sid)
+    start_shared_subscription(test_client, ss, 2)
+    start_shared_subscription(test_client, ss, 3)
+    assert ss.parse_context.call_count == 2
+
+def test_context_parse_failure_fails_init(context_ss):
+    app, ss = context_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    ss.parse_context.side_effect = ValueError('bad token')
+    init_client(test_client, ss)
+    assert [message['type'] for message in received_messages(test_client, ss)] == [INIT_FAIL]
+
+def test_context_dropped_on_disconnect(context_ss):
+    app, ss = context_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    init_client(test_client, ss)
+    test_client.disconnect(namespace=ss.namespace)
+    assert ss.connections == {}
+
+###
+# multi-process mode
+###
+def broker_server(broker):
+    app = create_app()
+    sub_manager = SubscriptionManager(Schema, PubSub(), {})
+    # the listener is a background task, so don't let an installed
+    # eventlet or gevent be picked without monkey patching
+    return (app, SubscriptionServer(app, sub_manager, broker=broker, async_mode='threading'))
+
+def wait_for_data(test_client, ss, count, timeout=10):
+    data = []
+    deadline = time.time() + timeout
+    while len(data) < count and time.time() < deadline:
+        data += received_data(test_client, ss)
+        time.sleep(0.01)
+    return data
+
+@pytest.fixture
+def broker_servers():
+    servers = [broker_server(broker) for broker in make_queue_brokers(2, queue.Queue)]
+    yield servers
+    for app, ss in servers:
+        ss.broker.close()
+
+def test_socket_options_reach_socketio():
+    app = create_app()
+    sub_manager = SubscriptionManager(Schema, PubSub(), {})
+    ss = SubscriptionServer(app, sub_manager, ping_interval=7)
+    assert ss.socketio.server.eio.ping_interval == 7
+
+def test_publish_without_broker_is_local(basic_ss):
+    app, ss = basic_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_shared_subscription(test_client, ss, 1)
+    ss.publish('test_subscription', 'a')
+    assert received_data(test_client, ss) == [{'test_subscription': 'a'}]
+
+def test_publish_reaches_every_worker(broker_servers):
+    clients = []
+    for app, ss in broker_servers:
+        test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+        start_shared_subscription(test_client, ss, 1)
+        clients.append((test_client, ss))
+    # published on one worker, executed on both
+    broker_servers[0][1].publish('test_subscription', 'a')
+    for test_client, ss in clients:
+        assert wait_for_data(test_client, ss, 1) == [{'test_subscription': 'a'}]
+
+def test_subscriptions_owned_by_socket_worker(broker_servers):
+    (app, ss), (other_app, other_ss) = broker_servers
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_shared_subscription(test_client, ss, 1)
+    sid = list(ss.connections)[0]
+    assert ss.owns(sid)
+    assert not other_ss.owns(sid)
+    assert len(ss.subscription_manager.subscriptions) == 1
+    assert len(other_ss.subscription_manager.subscriptions) == 0
+
+def test_emit_forwarded_to_owning_worker(broker_servers):
+    (app, ss), (other_app, other_ss) = broker_servers
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    test_client.get_received(ss.namespace)
+    sid = list(ss.connections)[0]
+    other_ss.send_message({'type': KEEPALIVE}, sid)
+    deadline = time.time() + 10
+    received = []
+    while not received and time.time() < deadline:
+        received = received_messages(test_client, ss)
+        time.sleep(0.01)
+    assert received == [{'type': KEEPALIVE}]
+
+def run_broker_worker(broker, ready, go, results, publisher):
+    # one worker process: a server, a client on it and one subscription
+    app, ss = broker_server(broker)
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_shared_subscription(test_client, ss, 1)
+    ready.put(broker.worker_id)
+    if publisher:
+        go.get()
+        ss.publish('test_subscription', 'hello')
+    results.put((broker.worker_id, wait_for_data(test_client, ss, 1)))
+    broker.close()
+
+def test_publish_across_worker_processes():
+    context = multiprocessing.get_context('spawn')
+    brokers = make_queue_brokers(3, context.Queue)
+    ready, go, results = context.Queue(), context.Queue(), context.Queue()
+    workers = [context.Process(target=run_broker_worker, args=(broker, ready, go, results, i == 0))
+               for i, broker in enumerate(brokers)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            ready.get(timeout=60)
+        go.put(True)
+        received = dict(results.get(timeout=60) for worker in workers)
+    finally:
+        for worker in workers:
+            worker.join(10)
+            if worker.is_alive():
+                worker.terminate()
+    assert received == {broker.worker_id: [{'test_subscription': 'hello'}] for broker in brokers}
+
+###
+# executor pool
+###
+@pytest.fixture
+def pooled_ss():
+    app = create_app()
+    sub_manager = SubscriptionManager(Schema, PubSub(), {})
+    ss = SubscriptionServer(app, sub_manager, executor_size=2, executor_queue=3)
+    # drive the pool by hand
+    ss.executor.start_background_task = None
+    return (app, ss)
+
+def test_no_executor_by_default(basic_ss):
+    app, ss = basic_ss
+    assert ss.executor is None
+    assert isinstance(ss.subscription_manager.pubsub, PubSub)
+
+def test_executor_keeps_order_per_key():
+    executor = Executor(4, 100, threading_task)
+    done = threading.Event()
+    results = {key: [] for key in range(5)}
+    for i in range(20):
+        for key in range(5):
+            executor.submit(key, results[key].append, i)
+    executor.submit('done', done.set)
+    assert done.wait(10)
+    deadline = time.time() + 10
+    while executor.completed < 101 and time.time() < deadline:
+        time.sleep(0.01)
+    assert results == {key: list(range(20)) for key in range(5)}
+
+def test_executor_runs_keys_in_parallel():
+    executor = Executor(2, 100, threading_task)
+    barrier = threading.Barrier(2, timeout=10)
+    executor.submit('a', barrier.wait)
+    executor.submit('b', barrier.wait)
+    deadline = time.time() + 10
+    while executor.completed < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    assert executor.stats()['failed'] == 0
+
+def test_executor_metrics():
+    clock = FakeClock()
+    executor = Executor(1, 100, clock=clock)
+    def slow():
+        clock.now += 2
+    executor.submit('a', slow)
+    executor.submit('a', slow)
+    assert executor.stats()['queued'] == 2
+    clock.now = 1
+    executor.run_pending()
+    stats = executor.stats()
+    assert stats['queued'] == 0
+    assert stats['max_depth'] == 2
+    assert stats['completed'] == 2
+    # the second task waited behind the first
+    assert stats['max_wait'] == 3
+    assert stats['avg_run'] == 2
+
+def threading_task(func, *args):
+    thread = threading.Thread(target=func, args=args, daemon=True)
+    thread.start()
+    return thread
+
+def test_publish_returns_before_resolvers_run(pooled_ss):
+    app, ss = pooled_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_shared_subscription(test_client, ss, 1)
+    test_client.get_received(ss.namespace)
+    ss.subscription_manager.publish('test_subscription', 'a')
+    assert received_data(test_client, ss) == []
+    assert len(ss.executor) == 1
+    ss.executor.run_pending()
+    assert received_data(test_client, ss) == [{'test_subscription': 'a'}]
+
+def test_pool_keeps_order_per_subscription(pooled_ss):
+    app, ss = pooled_ss
+    clients = [SocketIOTestClient(app, ss.socketio, namespace=ss.namespace) for i in range(3)]
+    for test_client in clients:
+        start_shared_subscription(test_client, ss, 1)
+    for value in ['a', 'b', 'c']:
+        ss.subscription_manager.publish('test_subscription', value)
+        ss.executor.run_pending()
+    for test_client in clients:
+        assert received_data(test_client, ss) == [{'test_subscription': value} for value in 'abc']
+
+def test_pool_queue_stays_bounded(pooled_ss):
+    app, ss = pooled_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_shared_subscription(test_client, ss, 1)
+    for value in 'abcdefgh':
+        ss.subscription_manager.publish('test_subscription', value)
+    ss.executor.run_pending()
+    assert ss.executor.max_depth <= ss.executor.max_queued + 1
+    assert received_data(test_client, ss) == [{'test_subscription': value} for value in 'abcdefgh']
+
+def test_pool_skips_payloads_for_ended_subscriptions(pooled_ss):
+    app, ss = pooled_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_shared_subscription(test_client, ss, 1)
+    ss.subscription_manager.publish('test_subscription', 'a')
+    test_client.emit('message', json.dumps({'type': SUBSCRIPTION_END, 'id': 1}), namespace=ss.namespace)
+    ss.executor.run_pending()
+    assert received_data(test_client, ss) == []
+
+def test_pool_with_background_workers():
+    app = create_app()
+    sub_manager = SubscriptionManager(Schema, PubSub(), {})
+    ss = SubscriptionServer(app, sub_manager, executor_size=4, async_mode='threading')
+    clients = [SocketIOTestClient(app, ss.socketio, namespace=ss.namespace) for i in range(5)]
+    for test_client in clients:
+        start_shared_subscription(test_client, ss, 1)
+    for i in range(20):
+        ss.subscription_manager.publish('test_subscription', str(i))
+    for test_client in clients:
+        assert wait_for_data(test_client, ss, 20) == [{'test_subscription': str(i)} for i in range(20)]
+
+###
+# instrumentation
+###
+@pytest.fixture
+def instrumented_ss(basic_ss):
+    app, ss = basic_ss
+    ss.instrumentation = InMemoryInstrumentation()
+    return (app, ss)
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram((0.1, 1.0))
+    for value in [0.05, 0.5, 0.5, 5]:
+        histogram.observe(value)
+    snapshot = histogram.snapshot()
+    assert snapshot['buckets'] == {'0.1': 1, '1.0': 3, '+Inf': 4}
+    assert snapshot['count'] == 4
+    assert snapshot['max'] == 5
+
+def test_instrumentation_counts_connections_and_subscriptions(instrumented_ss):
+    app, ss = instrumented_ss
+    clients = [SocketIOTestClient(app, ss.socketio, namespace=ss.namespace) for i in range(3)]
+    for test_client in clients:
+        start_shared_subscription(test_client, ss, 1)
+        start_shared_subscription(test_client, ss, 2)
+    clients[0].emit('message', json.dumps({'type': SUBSCRIPTION_END, 'id': 1}), namespace=ss.namespace)
+    clients[1].disconnect(namespace=ss.namespace)
+    snapshot = ss.instrumentation.snapshot()
+    assert snapshot['active_connections'] == 2
+    assert snapshot['active_subscriptions'] == 3
+
+def test_instrumentation_counts_messages_and_bytes(instrumented_ss):
+    app, ss = instrumented_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_shared_subscription(test_client, ss, 1)
+    ss.subscription_manager.publish('test_subscription', 'a')
+    frames = [received['args'][0]['data'] for received in test_client.get_received(ss.namespace)
+              if received['name'] == SUBSCRIPTION_MESSAGE]
+    snapshot = ss.instrumentation.snapshot()
+    assert snapshot['messages_in'] == {SUBSCRIPTION_START: 1}
+    assert snapshot['messages_out'] == {SUBSCRIPTION_SUCCESS: 1, SUBSCRIPTION_DATA: 1}
+    assert snapshot['frames_out'] == 2
+    assert snapshot['bytes_out'] == sum(len(frame) for frame in frames)
+
+def test_instrumentation_times_the_hot_path(instrumented_ss):
+    app, ss = instrumented_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_shared_subscription(test_client, ss, 1)
+    timings = ss.instrumentation.snapshot()['timings']
+    assert set(timings) == {'handle_message', 'decode', 'parse_context', 'subscribe', 'emit'}
+    assert all(timing['count'] == 1 for timing in timings.values())
+
+def test_metrics_snapshot_includes_server_counters(instrumented_ss):
+    app, ss = instrumented_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_shared_subscription(test_client, ss, 1)
+    snapshot = ss.metrics_snapshot()
+    assert snapshot['connections'] == 1
+    assert snapshot['subscriptions'] == 1
+    assert snapshot['dropped_frames'] == 0
+    assert snapshot['instrumentation']['active_subscriptions'] == 1
+    # served as is from a Flask route
+    json.dumps(snapshot)
+
+def test_metrics_snapshot_without_instrumentation(basic_ss):
+    app, ss = basic_ss
+    assert 'instrumentation' not in ss.metrics_snapshot()
+
+###
+# admission control
+###
+def fail_payloads(test_client, ss):
+    return [message['payload'] for message in received_messages(test_client, ss)
+            if message['type'] == SUBSCRIPTION_FAIL]
+
+def test_token_bucket():
+    bucket = TokenBucket(2, 3, 0)
+    assert [bucket.take(0) for i in range(4)] == [True, True, True, False]
+    # two tokens a second
+    assert bucket.take(0.5)
+    assert not bucket.take(0.5)
+    # never more than the burst
+    assert [bucket.take(100) for i in range(4)] == [True, True, True, False]
+
+def test_subscriptions_capped_per_connection(basic_ss):
+    app, ss = basic_ss
+    ss.max_subscriptions_per_connection = 2
+    ss.subscription_manager.subscribe = Mock(side_effect=range(1, 100))
+    ss.subscription_manager.unsubscribe = Mock()
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    for i in range(3):
+        start_shared_subscription(test_client, ss, i)
+    assert ss.subscription_manager.subscribe.call_count == 2
+    assert fail_payloads(test_client, ss) == [TOO_MANY_SUBSCRIPTIONS]
+    assert ss.rejected_connection_cap == 1
+    # restarting an id is not a new subscription
+    start_shared_subscription(test_client, ss, 1)
+    assert ss.subscription_manager.subscribe.call_count == 3
+    # other connections have their own allowance
+    other_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_shared_subscription(other_client, ss, 1)
+    assert fail_payloads(other_client, ss) == []
+
+def test_subscriptions_capped_per_server(basic_ss):
+    app, ss = basic_ss
+    ss.max_subscriptions = 2
+    clients = [SocketIOTestClient(app, ss.socketio, namespace=ss.namespace) for i in range(3)]
+    ss.parse_context = Mock(return_value={})
+    for test_client in clients:
+        start_shared_subscription(test_client, ss, 1)
+    assert fail_payloads(clients[2], ss) == [SERVER_AT_CAPACITY]
+    assert ss.rejected_server_cap == 1
+    # rejected before any expensive work
+    assert ss.parse_context.call_count == 2
+    # room again once one ends
+    clients[0].emit('message', json.dumps({'type': SUBSCRIPTION_END, 'id': 1}), namespace=ss.namespace)
+    start_shared_subscription(clients[2], ss, 1)
+    assert fail_payloads(clients[2], ss) == []
+    assert ss.subscription_count == 2
+
+def test_subscription_count_follows_disconnects(basic_ss):
+    app, ss = basic_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    for i in range(3):
+        start_shared_subscription(test_client, ss, i)
+    assert ss.subscription_count == 3
+    test_client.disconnect(namespace=ss.namespace)
+    assert ss.subscription_count == 0
+
+def test_inbound_messages_rate_limited(basic_ss):
+    app, ss = basic_ss
+    clock = FakeClock()
+    ss.scheduler = Scheduler(clock=clock)
+    ss.rate_limit = 1
+    ss.rate_burst = 2
+    ss.on_subscribe = Mock(side_effect=lambda parsed_message, base_params: base_params)
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    for i in range(4):
+        start_shared_subscription(test_client, ss, i)
+    assert ss.on_subscribe.call_count == 2
+    assert fail_payloads(test_client, ss) == [RATE_LIMITED, RATE_LIMITED]
+    assert ss.rate_limited_messages == 2
+    # ends always get through
+    test_client.emit('message', json.dumps({'type': SUBSCRIPTION_END, 'id': 0}), namespace=ss.namespace)
+    assert ss.get_subscription(list(ss.connections)[0], 0) is None
+    clock.now = 1
+    start_shared_subscription(test_client, ss, 5)
+    assert ss.on_subscribe.call_count == 3
+
+def test_admission_counters_in_snapshot(basic_ss):
+    app, ss = basic_ss
+    snapshot = ss.metrics_snapshot()
+    assert snapshot['rate_limited_messages'] == 0
+    assert snapshot['rejected_connection_cap'] == 0
+    assert snapshot['rejected_server_cap'] == 0
+
+###
+# batched subscribe / unsubscribe
+###
+def start_operation(sub_id, query='subscription test{ test_subscription }'):
+    return {'type': SUBSCRIPTION_START, 'id': sub_id, 'query': query, 'variables': {}}
+
+def send_operations(test_client, ss, operations):
+    test_client.emit('message',
+                     json.dumps({'type': SUBSCRIPTION_BATCH, 'payload': operations}),
+                     namespace=ss.namespace)
+
+def test_batch_starts_answered_in_one_frame(basic_ss):
+    app, ss = basic_ss
+    ss.parse_context = Mock(return_value={})
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    send_operations(test_client, ss, [start_operation(i) for i in range(30)])
+    assert received_messages(test_client, ss) == [{
+        'type': SUBSCRIPTION_BATCH_RESULT,
+        'payload': [{'type': SUBSCRIPTION_SUCCESS, 'id': i} for i in range(30)],
+    }]
+    assert len(ss.subscription_manager.subscriptions) == 30
+    # one context for the whole batch
+    assert ss.parse_context.call_count == 1
+    ss.subscription_manager.publish('test_subscription', 'a')
+    assert len(received_data(test_client, ss)) == 30
+
+def test_batch_mixes_starts_ends_and_failures(basic_ss):
+    app, ss = basic_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_shared_subscription(test_client, ss, 1)
+    test_client.get_received(ss.namespace)
+    send_operations(test_client, ss, [
+        {'type': SUBSCRIPTION_END, 'id': 1},
+        start_operation(2),
+        start_operation(3, 'subscription test{ test_subscription'),
+        {'type': 'nonsense', 'id': 4},
+    ])
+    message, = received_messages(test_client, ss)
+    assert [(result['type'], result['id']) for result in message['payload']] == [
+        (SUBSCRIPTION_END, 1),
+        (SUBSCRIPTION_SUCCESS, 2),
+        (SUBSCRIPTION_FAIL, 3),
+        (SUBSCRIPTION_FAIL, 4),
+    ]
+    assert len(ss.subscription_manager.subscriptions) == 1
+
+def test_batch_starts_respect_caps(basic_ss):
+    app, ss = basic_ss
+    ss.max_subscriptions_per_connection = 2
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    send_operations(test_client, ss, [start_operation(i) for i in range(3)])
+    message, = received_messages(test_client, ss)
+    assert message['payload'][2] == {'type': SUBSCRIPTION_FAIL, 'id': 2, 'payload': TOO_MANY_SUBSCRIPTIONS}
+    assert ss.rejected_connection_cap == 1
+
+def test_batch_starts_each_take_a_rate_limit_token(basic_ss):
+    app, ss = basic_ss
+    ss.scheduler = Scheduler(clock=FakeClock())
+    ss.rate_limit = 1
+    ss.rate_burst = 2
+    ss.on_subscribe = Mock(side_effect=lambda parsed_message, base_params: base_params)
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    send_operations(test_client, ss, [start_operation(i) for i in range(500)] + [{'type': SUBSCRIPTION_END, 'id': 0}])
+    message, = received_messages(test_client, ss)
+    assert [result['type'] for result in message['payload'][:3]] == [SUBSCRIPTION_SUCCESS, SUBSCRIPTION_SUCCESS,
+                                                                     SUBSCRIPTION_FAIL]
+    assert message['payload'][2]['payload'] == RATE_LIMITED
+    # ends are never limited
+    assert message['payload'][-1] == {'type': SUBSCRIPTION_END, 'id': 0}
+    assert ss.on_subscribe.call_count == 2
+    assert ss.rate_limited_messages == 498
+
+def test_batch_context_failure_fails_every_start(basic_ss):
+    app, ss = basic_ss
+    ss.parse_context = Mock(side_effect=ValueError('bad token'))
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    send_operations(test_client, ss, [start_operation(i) for i in range(3)])
+    message, = received_messages(test_client, ss)
+    assert [result['type'] for result in message['payload']] == [SUBSCRIPTION_FAIL] * 3
+    assert ss.parse_context.call_count == 1
+
+def test_batch_payload_must_be_a_list(basic_ss):
+    app, ss = basic_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    send_operations(test_client, ss, {'not': 'a list'})
+    assert received_messages(test_client, ss) == [{'type': SUBSCRIPTION_FAIL,
+                                                   'id': None,
+                                                   'payload': BATCH_PAYLOAD_MUST_BE_LIST}]
+
+###
+# resumable sessions
+###
+@pytest.fixture
+def session_ss(basic_ss):
+    app, ss = basic_ss
+    clock = FakeClock()
+    ss.scheduler = Scheduler(clock=clock)
+    ss.replay_buffer_size = 3
+    ss.session_ttl = 30
+    return app, ss, clock
+
+def open_session(test_client, ss, **options):
+    init_client(test_client, ss, **options)
+    message, = received_messages(test_client, ss)
+    assert message['type'] == INIT_SUCCESS
+    return message['payload']
+
+def test_replay_buffer_reports_evicted_frames():
+    buffer = ReplayBuffer(2)
+    for seq in [1, 2, 3]:
+        buffer.append(seq, seq)
+    assert buffer.since(2) == [(3, 3)]
+    assert buffer.since(1) == [(2, 2), (3, 3)]
+    assert buffer.since(0) is None
+
+def test_session_numbers_across_subscriptions():
+    session = Session('sid', 2)
+    assert [session.record(sub_id, 'x') for sub_id in [1, 2, 1]] == [1, 2, 3]
+    frames, stale = session.missed(1)
+    assert frames == [(2, 2, 'x'), (3, 1, 'x')]
+    assert stale == []
+
+def test_session_token_issued_at_init(session_ss):
+    app, ss, clock = session_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    payload = open_session(test_client, ss)
+    assert payload['session'] in ss.sessions
+    assert ss.metrics_snapshot()['sessions'] == 1
+
+def test_no_session_without_replay_buffer(basic_ss):
+    app, ss = basic_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    assert open_session(test_client, ss) == {}
+
+def test_data_frames_carry_sequence_numbers(session_ss):
+    app, ss, clock = session_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    open_session(test_client, ss)
+    start_shared_subscription(test_client, ss, 1)
+    start_shared_subscription(test_client, ss, 2, {'other': 1})
+    test_client.get_received(ss.namespace)
+    ss.subscription_manager.publish('test_subscription', 'a')
+    frames = received_messages(test_client, ss)
+    assert sorted(frame['seq'] for frame in frames) == [1, 2]
+
+def test_resume_replays_missed_frames(session_ss):
+    app, ss, clock = session_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    token = open_session(test_client, ss)['session']
+    start_shared_subscription(test_client, ss, 1)
+    test_client.get_received(ss.namespace)
+    ss.subscription_manager.publish('test_subscription', 'a')
+    last_seen = received_messages(test_client, ss)[-1]['seq']
+    test_client.disconnect(namespace=ss.namespace)
+    # the subscription outlives the socket
+    assert len(ss.subscription_manager.subscriptions) == 1
+    ss.subscription_manager.publish('test_subscription', 'b')
+    ss.subscription_manager.publish('test_subscription', 'c')
+
+    ss.subscription_manager.subscribe = Mock(wraps=ss.subscription_manager.subscribe)
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    init_client(test_client, ss, session=token, last_seen=last_seen)
+    messages = received_messages(test_client, ss)
+    assert messages[0] == {'type': INIT_SUCCESS, 'payload': {'session': token, 'resumed': True, 'stale': []}}
+    assert [(frame['seq'], frame['payload']['data']) for frame in messages[1:]] == [
+        (2, {'test_subscription': 'b'}),
+        (3, {'test_subscription': 'c'}),
+    ]
+    # nothing was subscribed or executed again
+    ss.subscription_manager.subscribe.assert_not_called()
+    assert ss.metrics_snapshot()['resumed_sessions'] == 1
+    # and live data flows to the new socket
+    ss.subscription_manager.publish('test_subscription', 'd')
+    assert received_data(test_client, ss) == [{'test_subscription': 'd'}]
+    clock.now = 60
+    ss.scheduler.run_pending()
+    assert len(ss.subscription_manager.subscriptions) == 1
+
+def test_resume_reports_overflowed_subscriptions_stale(session_ss):
+    app, ss, clock = session_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    token = open_session(test_client, ss)['session']
+    start_shared_subscription(test_client, ss, 1)
+    test_client.disconnect(namespace=ss.namespace)
+    for value in ['a', 'b', 'c', 'd']:
+        ss.subscription_manager.publish('test_subscription', value)
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    init_client(test_client, ss, session=token, last_seen=0)
+    messages = received_messages(test_client, ss)
+    assert messages == [{'type': INIT_SUCCESS, 'payload': {'session': token, 'resumed': True, 'stale': [1]}}]
+
+def test_resume_ends_clashing_subscriptions_started_before_init(session_ss):
+    app, ss, clock = session_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    token = open_session(test_client, ss)['session']
+    start_shared_subscription(test_client, ss, 1)
+    test_client.disconnect(namespace=ss.namespace)
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    # a legacy client may start before its INIT
+    start_shared_subscription(test_client, ss, 1)
+    start_shared_subscription(test_client, ss, 2)
+    assert len(ss.subscription_manager.subscriptions) == 3
+    init_client(test_client, ss, session=token, last_seen=0)
+    # the socket's own id 1 made way for the session's
+    assert len(ss.subscription_manager.subscriptions) == 2
+    assert ss.subscription_count == 2
+    test_client.disconnect(namespace=ss.namespace)
+    clock.now = 30
+    ss.scheduler.run_pending()
+    assert ss.subscription_manager.subscriptions == {}
+    assert ss.subscription_count == 0
+    assert ss.connection_subscriptions == {}
+
+def test_unknown_session_starts_over(session_ss):
+    app, ss, clock = session_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    payload = open_session(test_client, ss, session='nope', last_seen=4)
+    assert payload['resumed'] is False
+    assert payload['session'] != 'nope'
+
+def test_detached_session_expires(session_ss):
+    app, ss, clock = session_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    token = open_session(test_client, ss)['session']
+    start_shared_subscription(test_client, ss, 1)
+    test_client.disconnect(namespace=ss.namespace)
+    clock.now = 29
+    ss.scheduler.run_pending()
+    assert len(ss.subscription_manager.subscriptions) == 1
+    clock.now = 30
+    ss.scheduler.run_pending()
+    assert ss.subscription_manager.subscriptions == {}
+    assert ss.subscription_count == 0
+    assert ss.sessions == {}
+    assert ss.sid_sessions == {}
+    assert ss.metrics_snapshot()['expired_sessions'] == 1
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    assert open_session(test_client, ss, session=token)['resumed'] is False
+
+def test_ending_a_subscription_drops_its_buffer(session_ss):
+    app, ss, clock = session_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    token = open_session(test_client, ss)['session']
+    start_shared_subscription(test_client, ss, 1)
+    ss.subscription_manager.publish('test_subscription', 'a')
+    test_client.emit('message', json.dumps({'type': SUBSCRIPTION_END, 'id': 1}), namespace=ss.namespace)
+    assert ss.sessions[token].buffers == {}
+
+###
+# delta delivery
+###
+def nested_payload(price=10, count=20):
+    # only the first order's prices change between pushes
+    return {'data': {'orders': [{'id': i,
+                                 'customer': {'name': 'customer %d' % i, 'tier': 'gold'},
+                                 'lines': [{'sku': 'sku-%d' % j, 'price': price if i == 0 else 10}
+                                           for j in range(3)]}
+                                for i in range(count)]}}
+
+@pytest.fixture
+def delta_ss(basic_ss):
+    app, ss = basic_ss
+    ss.delta_threshold = 100
+    ss.delta_snapshot_interval = 3
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    init_client(test_client, ss, delta=True)
+    assert received_messages(test_client, ss) == [{'type': INIT_SUCCESS, 'payload': {'delta': True}}]
+    start_shared_subscription(test_client, ss, 1)
+    test_client.get_received(ss.namespace)
+    return app, ss, test_client, list(ss.connections)[0]
+
+def test_diff_round_trips():
+    cases = [
+        ({'a': 1, 'b': {'c': [1, 2, 3]}}, {'a': 2, 'b': {'c': [1, 5]}, 'd': None}),
+        ({'a': [1]}, {'a': [1, {'x': 'y'}, 3]}),
+        ({'a/b': 1, 'm~n': 2}, {'a/b': 3}),
+        ([1, 2], {'a': 1}),
+    ]
+    for old, new in cases:
+        patch = json.loads(json.dumps(diff(old, new)))
+        assert apply_patch(json.loads(json.dumps(old)), patch) == new
+    assert diff({'a': [1, 2]}, {'a': [1, 2]}) == []
+
+def test_delta_not_offered_when_disabled(basic_ss):
+    app, ss = basic_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    init_client(test_client, ss, delta=True)
+    assert received_messages(test_client, ss) == [{'type': INIT_SUCCESS, 'payload': {}}]
+
+def test_delta_sends_snapshot_then_patches(delta_ss):
+    app, ss, test_client, sid = delta_ss
+    document = None
+    types = []
+    for price in range(1, 7):
+        ss.send_subscription_data(1, nested_payload(price), sid)
+        message, = received_messages(test_client, ss)
+        types.append(message['type'])
+        if message['type'] == SUBSCRIPTION_DATA:
+            document = message['payload']
+        else:
+            assert len(message['payload']) == 3
+            document = apply_patch(document, message['payload'])
+        assert document == nested_payload(price)
+    # a full snapshot every delta_snapshot_interval patches
+    assert types == [SUBSCRIPTION_DATA] + [SUBSCRIPTION_PATCH] * 3 + [SUBSCRIPTION_DATA, SUBSCRIPTION_PATCH]
+    snapshot = ss.metrics_snapshot()
+    assert snapshot['delta_patches'] == 4
+    assert snapshot['delta_chars_saved'] > 0
+
+def test_delta_sends_small_payloads_in_full(delta_ss):
+    app, ss, test_client, sid = delta_ss
+    for value in ['a', 'b']:
+        ss.subscription_manager.publish('test_subscription', value)
+    assert [message['type'] for message in received_messages(test_client, ss)] == [SUBSCRIPTION_DATA] * 2
+
+def test_delta_falls_back_when_the_patch_is_bigger(delta_ss):
+    app, ss, test_client, sid = delta_ss
+    ss.send_subscription_data(1, nested_payload(1), sid)
+    # everything moved, the patch would carry the whole result and then some
+    ss.send_subscription_data(1, {'data': {'renamed': nested_payload(2)['data']['orders']}}, sid)
+    assert [message['type'] for message in received_messages(test_client, ss)] == [SUBSCRIPTION_DATA] * 2
+
+def test_delta_restart_begins_with_a_snapshot(delta_ss):
+    app, ss, test_client, sid = delta_ss
+    ss.send_subscription_data(1, nested_payload(1), sid)
+    test_client.emit('message', json.dumps({'type': SUBSCRIPTION_END, 'id': 1}), namespace=ss.namespace)
+    assert ss.delta_states == {}
+    start_shared_subscription(test_client, ss, 1)
+    test_client.get_received(ss.namespace)
+    ss.send_subscription_data(1, nested_payload(2), sid)
+    assert [message['type'] for message in received_messages(test_client, ss)] == [SUBSCRIPTION_DATA]
+
+def test_delta_fan_out_diffs_once(delta_ss):
+    app, ss, test_client, sid = delta_ss
+    other = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    init_client(other, ss, delta=True)
+    start_shared_subscription(other, ss, 7)
+    other.get_received(ss.namespace)
+    other_sid = [request_id for request_id in ss.connections if request_id != sid][0]
+    subscribers = [(sid, 1), (other_sid, 7)]
+    first = nested_payload(1)
+    ss.fan_out_subscription_data(subscribers, first)
+    with patch('flask_graphql_subscriptions_transport.flask_graphql_subscriptions_transport.diff',
+               wraps=diff) as counted:
+        ss.fan_out_subscription_data(subscribers, nested_payload(2))
+    assert counted.call_count == 1
+    for client in [test_client, other]:
+        full, delta = received_messages(client, ss)
+        assert apply_patch(full['payload'], delta['payload']) == nested_payload(2)
+
+def test_delta_fan_out_counts_frames_by_type(delta_ss):
+    app, ss, test_client, sid = delta_ss
+    other = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    start_shared_subscription(other, ss, 7)
+    other.get_received(ss.namespace)
+    other_sid = [request_id for request_id in ss.connections if request_id != sid][0]
+    ss.instrumentation = InMemoryInstrumentation()
+    for price in [1, 2]:
+        ss.fan_out_subscription_data([(sid, 1), (other_sid, 7)], nested_payload(price))
+    assert [message['type'] for message in received_messages(test_client, ss)] == [SUBSCRIPTION_DATA, SUBSCRIPTION_PATCH]
+    assert [message['type'] for message in received_messages(other, ss)] == [SUBSCRIPTION_DATA] * 2
+    assert ss.instrumentation.snapshot()['messages_out'] == {SUBSCRIPTION_DATA: 3, SUBSCRIPTION_PATCH: 1}
+
+def keyed_payload(keys):
+    # every key is an add or a remove in the patch
+    return {'data': {'orders': {'order %d' % i: 'x' * 40 for i in keys}}}
+
+@pytest.mark.parametrize('policy', [OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST])
+def test_delta_dropped_frame_resyncs_with_a_snapshot(queued_ss, policy):
+    app, ss, clock = queued_ss
+    ss.delta_threshold = 100
+    ss.max_queued_frames = 2
+    ss.overflow_policy = policy
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    init_client(test_client, ss, delta=True)
+    start_shared_subscription(test_client, ss, 1)
+    test_client.get_received(ss.namespace)
+    sid = list(ss.connections)[0]
+    ss.send_subscription_data(1, keyed_payload(range(3)), sid)
+    stall(ss)
+    # one of the three frames is dropped
+    for count in [4, 5, 6]:
+        ss.send_subscription_data(1, keyed_payload(range(count)), sid)
+    unstall(ss)
+    clock.now = ss.drain_interval
+    ss.scheduler.run_pending()
+    ss.send_subscription_data(1, keyed_payload(range(7)), sid)
+    ss.send_subscription_data(1, keyed_payload([0, 1, 2, 3, 4, 6]), sid)
+    document = None
+    types = []
+    for message in received_messages(test_client, ss):
+        types.append(message['type'])
+        if message['type'] == SUBSCRIPTION_DATA:
+            document = message['payload']
+        else:
+            document = apply_patch(document, message['payload'])
+    assert types == [SUBSCRIPTION_DATA, SUBSCRIPTION_PATCH, SUBSCRIPTION_PATCH, SUBSCRIPTION_DATA, SUBSCRIPTION_PATCH]
+    assert document == keyed_payload([0, 1, 2, 3, 4, 6])
+
+def test_delta_object_envelope(delta_ss):
+    app, ss, test_client, sid = delta_ss
+    ss.envelope = ENVELOPE_OBJECT
+    ss.send_subscription_data(1, nested_payload(1), sid)
+    ss.send_subscription_data(1, nested_payload(2), sid)
+    full, delta = [received['args'][0] for received in test_client.get_received(ss.namespace)]
+    assert delta['type'] == SUBSCRIPTION_PATCH
+    assert apply_patch(full['payload'], delta['payload']) == nested_payload(2)
+
+def test_delta_patches_replay_after_resume(session_ss):
+    app, ss, clock = session_ss
+    ss.delta_threshold = 100
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    token = open_session(test_client, ss, delta=True)['session']
+    start_shared_subscription(test_client, ss, 1)
+    test_client.get_received(ss.namespace)
+    sid = list(ss.connections)[0]
+    ss.send_subscription_data(1, nested_payload(1), sid)
+    full, = received_messages(test_client, ss)
+    test_client.disconnect(namespace=ss.namespace)
+    ss.send_subscription_data(1, nested_payload(2), sid)
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    init_client(test_client, ss, delta=True, session=token, last_seen=full['seq'])
+    init, delta = received_messages(test_client, ss)
+    assert delta['type'] == SUBSCRIPTION_PATCH
+    assert apply_patch(full['payload'], delta['payload']) == nested_payload(2)
+
+###
+# compression
+###
+@pytest.fixture
+def compressed_ss(basic_ss):
+    app, ss = basic_ss
+    ss.share_subscriptions = True
+    # an empty context, the same for everyone
+    ss.parse_context = None
+    ss.compressors = make_compressors(['zstd', 'zlib'])
+    ss.compression_threshold = 100
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    init_client(test_client, ss, compression=['gzip', 'zlib'])
+    assert received_messages(test_client, ss) == [{'type': INIT_SUCCESS, 'payload': {'compression': 'zlib'}}]
+    start_shared_subscription(test_client, ss, 1)
+    test_client.get_received(ss.namespace)
+    return app, ss, test_client
+
+def decompressed_messages(test_client, ss):
+    messages = []
+    for received in test_client.get_received(ss.namespace):
+        frame = received['args'][0]
+        message = json.loads(frame['data']) if ss.envelope == ENVELOPE_STRING else dict(frame)
+        if 'compression' in message:
+            assert message['compression'] == 'zlib'
+            compressed = frame['payload']
+            assert isinstance(compressed, bytes)
+            message['payload'] = json.loads(zlib.decompress(compressed).decode('utf-8'))
+        messages.append(message)
+    return messages
+
+def test_make_compressors():
+    assert list(make_compressors(None)) == []
+    assert list(make_compressors('zlib')) == ['zlib']
+    compressor = ZlibCompressor(1)
+    assert make_compressors([compressor])['zlib'] is compressor
+    with pytest.raises(ValueError):
+        make_compressors('lzma')
+    with pytest.raises(ValueError):
+        make_compressors([object()])
+
+def test_choose_compressor():
+    compressors = make_compressors('zlib')
+    assert choose_compressor(compressors, 'zlib') is compressors['zlib']
+    assert choose_compressor(compressors, ['br', 'zlib']) is compressors['zlib']
+    assert choose_compressor(compressors, ['br']) is None
+    assert choose_compressor(compressors, {'zlib': True}) is None
+
+def test_compression_not_offered_when_disabled(basic_ss):
+    app, ss = basic_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    init_client(test_client, ss, compression=['zlib'])
+    assert received_messages(test_client, ss) == [{'type': INIT_SUCCESS, 'payload': {}}]
+
+def test_large_payloads_compressed(compressed_ss):
+    app, ss, test_client = compressed_ss
+    ss.subscription_manager.publish('test_subscription', 'small')
+    ss.subscription_manager.publish('test_subscription', 'x' * 1000)
+    small, large = decompressed_messages(test_client, ss)
+    assert 'compression' not in small
+    assert large == {'type': SUBSCRIPTION_DATA, 'id': 1, 'compression': 'zlib',
+                     'payload': {'data': {'test_subscription': 'x' * 1000}}}
+    snapshot = ss.metrics_snapshot()
+    assert snapshot['compressed_payloads'] == 1
+    assert snapshot['compression_bytes_saved'] > 900
+
+def test_fan_out_compresses_once(compressed_ss):
+    app, ss, test_client = compressed_ss
+    clients = [test_client]
+    for i in range(3):
+        client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+        init_client(client, ss, compression='zlib')
+        start_shared_subscription(client, ss, 1)
+        client.get_received(ss.namespace)
+        clients.append(client)
+    with patch('zlib.compress', wraps=zlib.compress) as counted:
+        ss.subscription_manager.publish('test_subscription', 'y' * 1000)
+    assert counted.call_count == 1
+    for client in clients:
+        message, = decompressed_messages(client, ss)
+        assert message['payload'] == {'data': {'test_subscription': 'y' * 1000}}
+
+def test_compressed_frames_keep_batch_order(compressed_ss):
+    app, ss, test_client = compressed_ss
+    ss.batch_window = 1
+    list(ss.connections.values())[0].batch = []
+    ss.subscription_manager.publish('test_subscription', 'small')
+    ss.subscription_manager.publish('test_subscription', 'z' * 1000)
+    messages = decompressed_messages(test_client, ss)
+    assert [message['payload']['data']['test_subscription'][0] for message in messages] == ['s', 'z']
+
+def test_compression_object_envelope(compressed_ss):
+    app, ss, test_client = compressed_ss
+    ss.envelope = ENVELOPE_OBJECT
+    ss.subscription_manager.publish('test_subscription', 'x' * 1000)
+    message, = decompressed_messages(test_client, ss)
+    assert message['payload'] == {'data': {'test_subscription': 'x' * 1000}}
+
+def test_instrumentation_counts_compressed_bytes(compressed_ss):
+    app, ss, test_client = compressed_ss
+    ss.instrumentation = InMemoryInstrumentation()
+    ss.subscription_manager.publish('test_subscription', 'x' * 10000)
+    assert ss.instrumentation.snapshot()['bytes_out'] < 1000
+
+###
+# MessagePack protocol
+###
+@pytest.fixture
+def msgpack_ss(basic_ss):
+    msgpack = pytest.importorskip('msgpack')
+    app, ss = basic_ss
+    ss.packer = MsgpackProtocol()
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    init_client(test_client, ss, msgpack=True)
+    # INIT_SUCCESS still comes as JSON
+    assert received_messages(test_client, ss) == [{'type': INIT_SUCCESS, 'payload': {'msgpack': True}}]
+    return app, ss, test_client, msgpack
+
+def unpacked_messages(test_client, ss, msgpack):
+    messages = []
+    for received in test_client.get_received(ss.namespace):
+        if received['name'] != SUBSCRIPTION_MESSAGE:
+            continue
+        data = received['args'][0]['data']
+        assert isinstance(data, bytes)
+        messages.append(msgpack.unpackb(data, raw=False))
+    return messages
+
+def send_packed(test_client, ss, msgpack, message):
+    test_client.emit('message', msgpack.packb(message, use_bin_type=True), namespace=ss.namespace)
+
+def test_msgpack_encode_data_matches_packb():
+    msgpack = pytest.importorskip('msgpack')
+    packer = MsgpackProtocol()
+    payload = {'data': {'values': [1.5, 2, None, 'x' * 40]}}
+    packed = packer.encode_data(SUBSCRIPTION_DATA, 7, packer.dumps(payload))
+    assert packed == msgpack.packb({'type': SUBSCRIPTION_DATA, 'id': 7, 'payload': payload}, use_bin_type=True)
+    packed = packer.encode_data(SUBSCRIPTION_PATCH, 'a', packer.dumps(b'zz'), seq=3, compression='zlib')
+    assert packer.loads(packed) == {'type': SUBSCRIPTION_PATCH, 'id': 'a', 'seq': 3,
+                                    'compression': 'zlib', 'payload': b'zz'}
+
+def test_msgpack_not_offered_when_disabled(basic_ss):
+    app, ss = basic_ss
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    init_client(test_client, ss, msgpack=True)
+    assert received_messages(test_client, ss) == [{'type': INIT_SUCCESS, 'payload': {}}]
+
+def test_msgpack_round_trip(msgpack_ss):
+    app, ss, test_client, msgpack = msgpack_ss
+    send_packed(test_client, ss, msgpack, {'type': SUBSCRIPTION_START,
+                                           'id': 1,
+                                           'query': 'subscription test{ test_subscription }',
+                                           'variables': {}})
+    assert unpacked_messages(test_client, ss, msgpack) == [{'type': SUBSCRIPTION_SUCCESS, 'id': 1}]
+    ss.subscription_manager.publish('test_subscription', 'telemetry')
+    assert unpacked_messages(test_client, ss, msgpack) == [{'type': SUBSCRIPTION_DATA,
+                                                            'id': 1,
+                                                            'payload': {'data': {'test_subscription': 'telemetry'}}}]
+    send_packed(test_client, ss, msgpack, {'type': SUBSCRIPTION_END, 'id': 1})
+    assert ss.subscription_manager.subscriptions == {}
+
+def test_msgpack_bad_binary_frame_fails(msgpack_ss):
+    app, ss, test_client, msgpack = msgpack_ss
+    test_client.emit('message', b'\xc1', namespace=ss.namespace)
+    message, = unpacked_messages(test_client, ss, msgpack)
+    assert message['type'] == SUBSCRIPTION_FAIL
+
+def test_msgpack_fan_out_packs_once(msgpack_ss):
+    app, ss, test_client, msgpack = msgpack_ss
+    ss.share_subscriptions = True
+    # an empty context, the same for everyone
+    ss.parse_context = None
+    json_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    for client in [test_client, json_client]:
+        start_shared_subscription(client, ss, 1)
+        client.get_received(ss.namespace)
+    with patch.object(ss.packer, 'dumps', wraps=ss.packer.dumps) as counted:
+        ss.subscription_manager.publish('test_subscription', 'shared')
+    # the payload once, plus the id of the one data frame
+    assert counted.call_count == 3
+    assert unpacked_messages(test_client, ss, msgpack)[0]['payload'] == {'data': {'test_subscription': 'shared'}}
+    # JSON clients on the same subscription are unaffected
+    assert received_data(json_client, ss) == [{'test_subscription': 'shared'}]
+
+def test_msgpack_with_compression_and_object_envelope(msgpack_ss):
+    app, ss, test_client, msgpack = msgpack_ss
+    ss.envelope = ENVELOPE_OBJECT
+    ss.compressors = make_compressors('zlib')
+    ss.compression_threshold = 100
+    init_client(test_client, ss, msgpack=True, compression='zlib')
+    test_client.get_received(ss.namespace)
+    start_shared_subscription(test_client, ss, 1)
+    test_client.get_received(ss.namespace)
+    ss.subscription_manager.publish('test_subscription', 'x' * 1000)
+    message, = unpacked_messages(test_client, ss, msgpack)
+    assert message['compression'] == 'zlib'
+    assert msgpack.unpackb(zlib.decompress(message['payload']), raw=False) == {'data': {'test_subscription': 'x' * 1000}}
+
+def test_msgpack_replays_json_buffers(session_ss):
+    msgpack = pytest.importorskip('msgpack')
+    app, ss, clock = session_ss
+    ss.packer = MsgpackProtocol()
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    token = open_session(test_client, ss)['session']
+    start_shared_subscription(test_client, ss, 1)
+    test_client.disconnect(namespace=ss.namespace)
+    ss.subscription_manager.publish('test_subscription', 'missed')
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace)
+    init_client(test_client, ss, msgpack=True, session=token, last_seen=0)
+    init, replayed = [received['args'][0]['data'] for received in test_client.get_received(ss.namespace)
+                      if received['name'] == SUBSCRIPTION_MESSAGE]
+    assert json.loads(init)['payload']['resumed'] is True
+    replayed = msgpack.unpackb(replayed, raw=False)
+    assert replayed == {'type': SUBSCRIPTION_DATA, 'id': 1, 'seq': 1,
+                        'payload': {'data': {'test_subscription': 'missed'}}}
+
+###
+# every transport: Flask-SocketIO, the asyncio AsyncServer over ASGI, and
+# plain websockets over ASGI
+###
+class FlaskTransportClient(object):
+    def __init__(self, app, ss, protocol=None):
+        self.ss = ss
+        self.client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace,
+                                         auth={'protocol': protocol} if protocol else None)
+
+    def send(self, message):
+        self.client.emit('message', json.dumps(message), namespace=self.ss.namespace)
+
+    def receive(self):
+        return received_messages(self.client, self.ss)
+
+    def disconnect(self):
+        self.client.disconnect(namespace=self.ss.namespace)
+
+    def connected(self):
+        return self.client.is_connected(self.ss.namespace)
+
+
+class AsgiTransportClient(object):
+    """
+    a websocket client talking to AsyncSubscriptionServer.asgi_app in process
+    """
+    def __init__(self, ss, loop, protocol=None):
+        self.ss = ss
+        self.loop = loop
+        self.inbox = asyncio.Queue()
+        self.sent = []
+        self.prefix = '42%s,' % ss.namespace
+        self.is_connected = False
+        scope = {'type': 'websocket',
+                 'asgi': {'version': '3.0'},
+                 'scheme': 'ws',
+                 'path': '/socket.io/',
+                 'query_string': b'EIO=4&transport=websocket',
+                 'headers': [(b'upgrade', b'websocket'), (b'connection', b'Upgrade')],
+                 'server': ('127.0.0.1', 80),
+                 'client': ('127.0.0.1', 5000)}
+        self.task = loop.create_task(ss.asgi_app(scope, self.inbox.get, self.record))
+        self.push({'type': 'websocket.connect'})
+        auth = json.dumps({'protocol': protocol}) if protocol else ''
+        self.push({'type': 'websocket.receive', 'text': '40%s,%s' % (ss.namespace, auth)})
+
+    async def record(self, message):
+        # namespace connect, disconnect and connect error packets
+        text = message.get('text', None) or ''
+        if text.startswith('40%s,' % self.ss.namespace):
+            self.is_connected = True
+        elif text.startswith('41%s,' % self.ss.namespace) or text.startswith('44%s,' % self.ss.namespace):
+            self.is_connected = False
+        self.sent.append(message)
+
+    def push(self, message):
+        self.inbox.put_nowait(message)
+        run_loop(self.loop)
+
+    def send(self, message):
+        self.push({'type': 'websocket.receive',
+                   'text': self.prefix + json.dumps(['message', json.dumps(message)])})
+
+    def receive(self):
+        run_loop(self.loop)
+        sent, self.sent = self.sent, []
+        messages = []
+        for message in sent:
+            text = message.get('text', None) or ''
+            if text.startswith(self.prefix):
+                event, frame = json.loads(text[len(self.prefix):])
+                if event == SUBSCRIPTION_MESSAGE:
+                    messages.append(json.loads(frame['data']))
+        return messages
+
+    def disconnect(self):
+        self.push({'type': 'websocket.disconnect'})
+
+    def connected(self):
+        run_loop(self.loop)
+        return self.is_connected
+
+
+class WebSocketTransportClient(object):
+    """
+    a websocket client talking to WebSocketSubscriptionServer.asgi_app in
+    process, offering protocol as its subprotocol
+    """
+    def __init__(self, ss, loop, protocol=None):
+        self.ss = ss
+        self.loop = loop
+        self.inbox = asyncio.Queue()
+        self.sent = []
+        self.subprotocol = None
+        self.close_code = None
+        scope = {'type': 'websocket',
+                 'asgi': {'version': '3.0'},
+                 'scheme': 'ws',
+                 'path': '/graphql',
+                 'query_string': b'',
+                 'headers': [],
+                 'subprotocols': [protocol] if protocol else [],
+                 'server': ('127.0.0.1', 80),
+                 'client': ('127.0.0.1', 5000)}
+        self.task = loop.create_task(ss.asgi_app(scope, self.inbox.get, self.record))
+        self.push({'type': 'websocket.connect'})
+
+    async def record(self, message):
+        if message['type'] == 'websocket.accept':
+            self.subprotocol = message.get('subprotocol', None)
+        elif message['type'] == 'websocket.close':
+            self.close_code = message['code']
+        else:
+            self.sent.append(message)
+
+    def push(self, message):
+        self.inbox.put_nowait(message)
+        run_loop(self.loop)
+
+    def send(self, message):
+        self.push({'type': 'websocket.receive', 'text': json.dumps(message)})
+
+    def receive(self):
+        run_loop(self.loop)
+        sent, self.sent = self.sent, []
+        return [json.loads(message['text']) for message in sent if 'text' in message]
+
+    def disconnect(self):
+        self.push({'type': 'websocket.disconnect'})
+
+    def connected(self):
+        run_loop(self.loop)
+        return self.close_code is None
+
+
+def run_loop(loop):
+    # long enough for the server, its writer task and thread callbacks
+    loop.run_until_complete(asyncio.sleep(0.01))
+
+
+@pytest.fixture(params=['flask', 'asgi', 'websocket'])
+def transport(request):
+    """
+    (make_server, connect) for each transport
+    make_server(**options) builds a server, connect(ss, protocol=None) a
+    client for it, asking for protocol if given
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    app = create_app()
+
+    def make_server(**options):
+        sub_manager = SubscriptionManager(Schema, PubSub(), {})
+        if request.param == 'flask':
+            return SubscriptionServer(app, sub_manager, namespace='/foo', async_mode='threading', **options)
+        if request.param == 'asgi':
+            return AsyncSubscriptionServer(sub_manager, namespace='/foo', **options)
+        return WebSocketSubscriptionServer(sub_manager, namespace='/foo', **options)
+
+    def connect(ss, protocol=None):
+        if request.param == 'flask':
+            return FlaskTransportClient(app, ss, protocol)
+        if request.param == 'asgi':
+            return AsgiTransportClient(ss, loop, protocol)
+        return WebSocketTransportClient(ss, loop, protocol)
+
+    yield make_server, connect
+    tasks = asyncio.all_tasks(loop)
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    loop.close()
+    asyncio.set_event_loop(None)
+
+def test_transport_init(transport):
+    make_server, connect = transport
+    # on_connect also runs on the socket connect, without a payload
+    ss = make_server(on_connect=lambda payload=None: payload != 'nope')
+    client = connect(ss)
+    client.send({'type': INIT, 'payload': 'ok'})
+    assert client.receive() == [{'type': INIT_SUCCESS, 'payload': {}}]
+    client.send({'type': INIT, 'payload': 'nope'})
+    assert [message['type'] for message in client.receive()] == [INIT_FAIL]
+
+def test_transport_subscription_lifecycle(transport):
+    make_server, connect = transport
+    ss = make_server()
+    client = connect(ss)
+    client.send(start_operation(1))
+    assert client.receive() == [{'type': SUBSCRIPTION_SUCCESS, 'id': 1}]
+    ss.subscription_manager.publish('test_subscription', 'a')
+    assert client.receive() == [{'type': SUBSCRIPTION_DATA, 'id': 1, 'payload': {'data': {'test_subscription': 'a'}}}]
+    client.send({'type': SUBSCRIPTION_END, 'id': 1})
+    ss.subscription_manager.publish('test_subscription', 'b')
+    assert client.receive() == []
+    assert ss.subscription_manager.subscriptions == {}
+
+def test_transport_invalid_query_fails(transport):
+    make_server, connect = transport
+    ss = make_server()
+    client = connect(ss)
+    client.send(start_operation(1, 'subscription test{ test_subscription'))
+    message, = client.receive()
+    assert message['type'] == SUBSCRIPTION_FAIL
+    assert message['id'] == 1
+
+def test_transport_disconnect_cleans_up(transport):
+    make_server, connect = transport
+    ss = make_server()
+    client = connect(ss)
+    client.send(start_operation(1))
+    client.receive()
+    assert len(ss.connections) == 1
+    client.disconnect()
+    assert ss.connections == {}
+    assert ss.subscription_manager.subscriptions == {}
+
+def test_transport_clients_are_isolated(transport):
+    make_server, connect = transport
+    ss = make_server()
+    first, second = connect(ss), connect(ss)
+    first.send(start_operation(1))
+    first.receive()
+    second.receive()
+    ss.subscription_manager.publish('test_subscription', 'a')
+    assert len(first.receive()) == 1
+    assert second.receive() == []
+
+def test_transport_parse_context_sees_the_request(transport):
+    make_server, connect = transport
+    seen = []
+    ss = make_server(parse_context=lambda request: seen.append(request) or {})
+    client = connect(ss)
+    client.send(start_operation(1))
+    assert client.receive() == [{'type': SUBSCRIPTION_SUCCESS, 'id': 1}]
+    assert len(seen) == 1 and seen[0] is not None
+
+def test_transport_batched_operations(transport):
+    make_server, connect = transport
+    ss = make_server()
+    client = connect(ss)
+    client.send({'type': SUBSCRIPTION_BATCH, 'payload': [start_operation(1), start_operation(2)]})
+    message, = client.receive()
+    assert message['payload'] == [{'type': SUBSCRIPTION_SUCCESS, 'id': 1}, {'type': SUBSCRIPTION_SUCCESS, 'id': 2}]
+
+def test_transport_subscription_caps(transport):
+    make_server, connect = transport
+    ss = make_server(max_subscriptions_per_connection=1)
+    client = connect(ss)
+    client.send(start_operation(1))
+    client.send(start_operation(2))
+    assert client.receive() == [{'type': SUBSCRIPTION_SUCCESS, 'id': 1},
+                                {'type': SUBSCRIPTION_FAIL, 'id': 2, 'payload': TOO_MANY_SUBSCRIPTIONS}]
+
+def test_transport_publish_from_another_thread(transport):
+    make_server, connect = transport
+    ss = make_server()
+    client = connect(ss)
+    client.send(start_operation(1))
+    client.receive()
+    thread = threading.Thread(target=ss.subscription_manager.publish, args=('test_subscription', 'a'))
+    thread.start()
+    thread.join()
+    assert client.receive() == [{'type': SUBSCRIPTION_DATA, 'id': 1, 'payload': {'data': {'test_subscription': 'a'}}}]
+
+def test_async_server_has_no_sid_outside_events():
+    ss = AsyncSubscriptionServer(SubscriptionManager(Schema, PubSub(), {}))
+    assert ss.current_sid() is None
+    assert ss.current_request() is None
+
+###
+# wire protocols: graphql-ws alongside the legacy protocol
+###
+GRAPHQL_WS_QUERY = 'subscription test{ test_subscription }'
+
+
+def acknowledged_protocol():
+    protocol = GraphQLWSProtocol()
+    protocol.receive({'type': 'connection_init'})
+    protocol.send({'type': INIT_SUCCESS, 'payload': {}})
+    return protocol
+
+
+def test_make_protocols():
+    assert list(make_protocols()) == [PROTOCOL_LEGACY]
+    assert list(make_protocols([PROTOCOL_GRAPHQL_WS, LegacyProtocol])) == [PROTOCOL_GRAPHQL_WS, PROTOCOL_LEGACY]
+    with pytest.raises(ValueError):
+        make_protocols('graphql-ws-v9')
+    with pytest.raises(ValueError):
+        make_protocols([])
+
+def test_choose_protocol():
+    both = make_protocols([PROTOCOL_LEGACY, PROTOCOL_GRAPHQL_WS])
+    # asking for nothing means the legacy protocol
+    assert choose_protocol(both, None) is LegacyProtocol
+    assert choose_protocol(both, []) is LegacyProtocol
+    assert choose_protocol(both, ['graphql-ws-v9', PROTOCOL_GRAPHQL_WS]) is GraphQLWSProtocol
+    assert choose_protocol(both, 'graphql-ws-v9') is None
+    assert choose_protocol(make_protocols(PROTOCOL_GRAPHQL_WS), None) is None
+
+def test_legacy_protocol_passes_messages_through():
+    protocol = LegacyProtocol()
+    message = {'type': SUBSCRIPTION_START, 'id': 1}
+    assert protocol.receive(message) == [(HANDLE, message)]
+    assert protocol.send(message) == [(SEND, message)]
+    assert json.loads(protocol.data_frame(1, '{"data": 1}')) == {'type': SUBSCRIPTION_DATA, 'id': 1, 'payload': {'data': 1}}
+
+def test_graphql_ws_protocol_handshake():
+    protocol = GraphQLWSProtocol()
+    assert protocol.receive({'type': 'connection_init', 'payload': {'token': 't'}}) == \
+        [(HANDLE, {'type': INIT, 'payload': {'token': 't'}})]
+    assert protocol.send({'type': INIT_SUCCESS, 'payload': {}}) == [(SEND, {'type': 'connection_ack'})]
+    assert protocol.receive({'type': 'ping'}) == [(SEND, {'type': 'pong'})]
+    assert protocol.receive({'type': 'pong'}) == []
+    assert protocol.send({'type': KEEPALIVE}) == [(SEND, {'type': 'ping'})]
+    assert protocol.receive({'type': 'connection_init'}) == [(CLOSE, 4429, 'Too many initialisation requests')]
+    # nothing more once closed
+    assert protocol.receive({'type': 'ping'}) == []
+
+def test_graphql_ws_protocol_rejected_init_closes():
+    protocol = GraphQLWSProtocol()
+    protocol.receive({'type': 'connection_init'})
+    assert protocol.send({'type': INIT_FAIL, 'payload': 'Prohibited connection!'}) == [(CLOSE, 4403, 'Forbidden')]
+
+def test_graphql_ws_protocol_violations_close():
+    subscribe = {'type': 'subscribe', 'id': 'a', 'payload': {'query': GRAPHQL_WS_QUERY}}
+    assert GraphQLWSProtocol().receive(subscribe) == [(CLOSE, 4401, 'Unauthorized')]
+    protocol = acknowledged_protocol()
+    protocol.receive(subscribe)
+    assert protocol.receive(subscribe) == [(CLOSE, 4409, 'Subscriber for a already exists')]
+    for message in ({'type': 'subscribe', 'id': 1, 'payload': {'query': GRAPHQL_WS_QUERY}},
+                    {'type': 'subscribe', 'id': 'b', 'payload': {}},
+                    {'type': 'complete'},
+                    {'type': SUBSCRIPTION_START},
+                    ['not', 'a', 'message']):
+        action, = acknowledged_protocol().receive(message)
+        assert action[:2] == (CLOSE, 4400)
+    # an unparseable message fails without an id
+    action, = acknowledged_protocol().send({'type': SUBSCRIPTION_FAIL, 'id': None, 'payload': 'x' * 200})
+    assert action[:2] == (CLOSE, 4400)
+    assert len(action[2]) == 123
+
+def test_graphql_ws_protocol_operation_lifecycle():
+    protocol = acknowledged_protocol()
+    assert protocol.receive({'type': 'subscribe', 'id': 'a', 'payload': {
+        'query': GRAPHQL_WS_QUERY, 'variables': {'x': 1}, 'operationName': 'test'}}) == \
+        [(HANDLE, {'type': SUBSCRIPTION_START, 'id': 'a', 'query': GRAPHQL_WS_QUERY,
+                   'variables': {'x': 1}, 'operation_name': 'test'})]
+    # nothing stands for SUBSCRIPTION_SUCCESS
+    assert protocol.send({'type': SUBSCRIPTION_SUCCESS, 'id': 'a'}) == []
+    payload = {'data': {'test_subscription': 'a'}}
+    assert protocol.send({'type': SUBSCRIPTION_DATA, 'id': 'a', 'payload': payload}) == \
+        [(SEND, {'type': 'next', 'id': 'a', 'payload': payload})]
+    assert json.loads(protocol.data_frame('a', json.dumps(payload))) == {'type': 'next', 'id': 'a', 'payload': payload}
+    assert protocol.receive({'type': 'complete', 'id': 'a'}) == [(HANDLE, {'type': SUBSCRIPTION_END, 'id': 'a'})]
+    # completed operations get nothing more, and completing again is fine
+    assert protocol.send({'type': SUBSCRIPTION_DATA, 'id': 'a', 'payload': payload}) == []
+    assert protocol.data_frame('a', json.dumps(payload)) is None
+    assert protocol.receive({'type': 'complete', 'id': 'a'}) == []
+
+def test_graphql_ws_protocol_error_ends_operation():
+    protocol = acknowledged_protocol()
+    protocol.receive({'type': 'subscribe', 'id': 'a', 'payload': {'query': GRAPHQL_WS_QUERY}})
+    assert protocol.send({'type': SUBSCRIPTION_FAIL, 'id': 'a', 'payload': 'bad'}) == [
+        (SEND, {'type': 'error', 'id': 'a', 'payload': [{'message': 'bad'}]}),
+        (HANDLE, {'type': SUBSCRIPTION_END, 'id': 'a'}),
+    ]
+    assert protocol.send({'type': SUBSCRIPTION_DATA, 'id': 'a', 'payload': {}}) == []
+    # the id can be used again
+    assert protocol.receive({'type': 'subscribe', 'id': 'a', 'payload': {'query': GRAPHQL_WS_QUERY}})[0][0] == HANDLE
+
+def graphql_ws_subscribe(sub_id, query=GRAPHQL_WS_QUERY):
+    return {'type': 'subscribe', 'id': sub_id, 'payload': {'query': query}}
+
+def test_transport_graphql_ws(transport):
+    make_server, connect = transport
+    ss = make_server(protocols=[PROTOCOL_LEGACY, PROTOCOL_GRAPHQL_WS])
+    client = connect(ss, PROTOCOL_GRAPHQL_WS)
+    client.send({'type': 'connection_init', 'payload': {}})
+    assert client.receive() == [{'type': 'connection_ack'}]
+    client.send(graphql_ws_subscribe('a'))
+    assert client.receive() == []
+    ss.subscription_manager.publish('test_subscription', 'a')
+    assert client.receive() == [{'type': 'next', 'id': 'a', 'payload': {'data': {'test_subscription': 'a'}}}]
+    client.send({'type': 'ping'})
+    assert client.receive() == [{'type': 'pong'}]
+    client.send({'type': 'complete', 'id': 'a'})
+    ss.subscription_manager.publish('test_subscription', 'b')
+    assert client.receive() == []
+    assert ss.subscription_manager.subscriptions == {}
+
+def test_transport_graphql_ws_error_ends_operation(transport):
+    make_server, connect = transport
+    ss = make_server(protocols=[PROTOCOL_GRAPHQL_WS])
+    client = connect(ss, PROTOCOL_GRAPHQL_WS)
+    client.send({'type': 'connection_init'})
+    client.send(graphql_ws_subscribe('a', 'subscription test{ test_subscription'))
+    ack, error = client.receive()
+    assert error['type'] == 'error' and error['id'] == 'a'
+    assert ss.connection_subscriptions.get(list(ss.connections)[0], {}) == {}
+    client.send(graphql_ws_subscribe('a'))
+    assert client.receive() == []
+    assert len(ss.subscription_manager.subscriptions) == 1
+
+def test_transport_protocol_per_connection(transport):
+    make_server, connect = transport
+    ss = make_server(protocols=[PROTOCOL_LEGACY, PROTOCOL_GRAPHQL_WS], share_subscriptions=True)
+    legacy, modern = connect(ss), connect(ss, PROTOCOL_GRAPHQL_WS)
+    legacy.send(start_operation(1))
+    modern.send({'type': 'connection_init'})
+    modern.send(graphql_ws_subscribe('a'))
+    legacy.receive()
+    modern.receive()
+    # one shared subscription, framed for each client
+    assert len(ss.subscription_manager.subscriptions) == 1
+    ss.subscription_manager.publish('test_subscription', 'x')
+    payload = {'data': {'test_subscription': 'x'}}
+    assert legacy.receive() == [{'type': SUBSCRIPTION_DATA, 'id': 1, 'payload': payload}]
+    assert modern.receive() == [{'type': 'next', 'id': 'a', 'payload': payload}]
+
+def test_transport_refuses_unoffered_protocol(transport):
+    make_server, connect = transport
+    ss = make_server()
+    client = connect(ss, PROTOCOL_GRAPHQL_WS)
+    assert not client.connected()
+    assert ss.connections == {}
+
+def test_transport_graphql_ws_violation_closes(transport):
+    make_server, connect = transport
+    ss = make_server(protocols=[PROTOCOL_GRAPHQL_WS])
+    client = connect(ss, PROTOCOL_GRAPHQL_WS)
+    assert client.connected()
+    # subscribing before connection_init
+    client.send(graphql_ws_subscribe('a'))
+    assert not client.connected()
+
+def test_graphql_ws_gets_no_session(session_ss):
+    app, ss, clock = session_ss
+    ss.protocols = make_protocols([PROTOCOL_LEGACY, PROTOCOL_GRAPHQL_WS])
+    ss.translating = True
+    test_client = SocketIOTestClient(app, ss.socketio, namespace=ss.namespace,
+                                     auth={'protocol': PROTOCOL_GRAPHQL_WS})
+    test_client.emit('message', json.dumps({'type': 'connection_init'}), namespace=ss.namespace)
+    assert received_messages(test_client, ss) == [{'type': 'connection_ack'}]
+    assert ss.sessions == {}
+
+def test_websocket_server_close_codes():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    ss = WebSocketSubscriptionServer(SubscriptionManager(Schema, PubSub(), {}),
+                                     protocols=[PROTOCOL_GRAPHQL_WS, PROTOCOL_LEGACY],
+                                     on_connect=lambda payload=None: payload != {'token': 'bad'})
+    try:
+        client = WebSocketTransportClient(ss, loop, PROTOCOL_GRAPHQL_WS)
+        assert client.subprotocol == PROTOCOL_GRAPHQL_WS
+        client.send({'type': 'connection_init', 'payload': {'token': 'bad'}})
+        assert client.close_code == 4403
+        # the server hears back once the close handshake is done
+        client.disconnect()
+        client = WebSocketTransportClient(ss, loop, 'graphql-ws-v9')
+        assert client.close_code == 4406
+        # no subprotocol is the legacy protocol
+        client = WebSocketTransportClient(ss, loop)
+        assert client.subprotocol is None
+        client.send({'type': INIT, 'payload': {}})
+        assert client.receive() == [{'type': INIT_SUCCESS, 'payload': {}}]
+        client.disconnect()
+        assert ss.connections == {}
+    finally:
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        loop.close()
+        asyncio.set_event_loop(None)
+
+class StalledWebSocketClient(WebSocketTransportClient):
+    """
+    a client that never reads what it is sent, only the close gets through
+    """
+    async def record(self, message):
+        if message['type'] == 'websocket.send':
+            await asyncio.Event().wait()
+        await super(StalledWebSocketClient, self).record(message)
+
+@pytest.fixture
+def websocket_loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    tasks = asyncio.all_tasks(loop)
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    loop.close()
+    asyncio.set_event_loop(None)
+
+def stalled_websocket_client(ss, loop):
+    """
+    a StalledWebSocketClient with a subscription, and its session id
+    """
+    client = StalledWebSocketClient(ss, loop)
+    sid, = ss.outboxes
+    # the writer is now stuck on SUBSCRIPTION_SUCCESS
+    client.send(start_operation(1))
+    return client, sid
+
+def publish_on_loop(ss, loop, values):
+    """
+    publish from the event loop, where frames are queued right away
+    """
+    async def publish():
+        for value in values:
+            ss.subscription_manager.publish('test_subscription', value)
+    loop.run_until_complete(publish())
+
+def test_websocket_server_stalled_client_holds_up_only_itself(websocket_loop):
+    ss = WebSocketSubscriptionServer(SubscriptionManager(Schema, PubSub(), {}))
+    stalled, stalled_sid = stalled_websocket_client(ss, websocket_loop)
+    client = WebSocketTransportClient(ss, websocket_loop)
+    client.send(start_operation(1))
+    assert client.receive() == [{'type': SUBSCRIPTION_SUCCESS, 'id': 1}]
+    for value in ['a', 'b', 'c']:
+        ss.subscription_manager.publish('test_subscription', value)
+    assert [message['payload']['data']['test_subscription'] for message in client.receive()] == ['a', 'b', 'c']
+    assert ss.transport_backlog(stalled_sid) == 3
+
+def test_websocket_server_bounded_queue_waits_on_the_writer(websocket_loop):
+    ss = WebSocketSubscriptionServer(SubscriptionManager(Schema, PubSub(), {}),
+                                     max_queued_frames=10,
+                                     max_transport_backlog=2)
+    stalled, sid = stalled_websocket_client(ss, websocket_loop)
+    publish_on_loop(ss, websocket_loop, ['a', 'b', 'c', 'd', 'e'])
+    assert ss.transport_backlog(sid) == 2
+    assert len(ss.connections[sid].outbox) == 3
+
+def test_websocket_server_closes_a_client_that_falls_behind(websocket_loop):
+    ss = WebSocketSubscriptionServer(SubscriptionManager(Schema, PubSub(), {}), max_pending_writes=2)
+    stalled, sid = stalled_websocket_client(ss, websocket_loop)
+    publish_on_loop(ss, websocket_loop, ['a', 'b', 'c', 'd'])
+    assert stalled.connected() is False
+    assert stalled.close_code == 1013
+    assert ss.evicted_connections == 1
+    assert ss.transport_backlog(sid) == 0
+
+def test_websocket_server_refuses_compression():
+    with pytest.raises(ValueError):
+        WebSocketSubscriptionServer(SubscriptionManager(Schema, PubSub(), {}), compression='zlib')